@@ -3,11 +3,11 @@
 from __future__ import print_function, absolute_import, division, unicode_literals
 
 import argparse
-import boto3
 import datetime
-import glob
 import hashlib
+import importlib
 import json
+import logging
 import os
 import shutil
 import subprocess
@@ -15,26 +15,23 @@ import sys
 import zipfile
 import signal
 import time
-import PIL
-from six.moves.urllib.request import urlopen, Request
-from PIL import Image
 import mimetypes
 from zipfile import ZipFile
 
 from hyp3lib import __version__ as _hyp3lib_version
 from hyp3lib.file_subroutines import mkdir_p
-from hyp3lib.draw_polygon_on_raster import draw_polygon_from_shape_on_raster
-from hyp3lib.simplify_shapefile import simplify_shapefile
-from hyp3lib.subset_geotiff_shape import subset_geotiff_shape
-from hyp3lib.asf_geometry import get_latlon_extent
 
+from hyp3proclib.browse import build_browse_pyramid, render_variants, warp_to_png
 from hyp3proclib.config import get_config, is_config, load_all_general_config, is_yes
-from hyp3proclib.db import get_db_connection, query_database, get_db_config
+from hyp3proclib.db import get_db_connection, query_database, get_db_config, load_db_configs, transaction  # noqa: F401
 from hyp3proclib.emailer import notify_user, notify_user_failure
-from hyp3proclib.logger import log, setup_logger
+from hyp3proclib.logger import log, set_log_context, setup_logger
 from hyp3proclib.file_system import setup_workdir, cleanup_lockfile, cleanup_workdir, check_stop  # noqa: F401
 from hyp3proclib.instance_tracking import add_instance_record, update_instance_record
-from hyp3proclib.process_ids import get_process_id_dict
+from hyp3proclib.job import JobConfig, JobRecord, job_columns, use_job  # noqa: F401
+from hyp3proclib.lease import reap_expired_leases, start_heartbeat, stop_heartbeat
+from hyp3proclib.queries import execute_query, register_dynamic_query
+from hyp3proclib.process_ids import get_process_id_dict  # noqa: F401
 
 # FIXME: Python 3.8+ this should be `from importlib.metadata...`
 from importlib_metadata import PackageNotFoundError, version
@@ -49,6 +46,31 @@ except PackageNotFoundError:
     #    python setup.py --version
     pass
 
+# NOTE: boto3, PIL, six.moves.urllib and the GDAL backed hyp3lib modules are slow
+#       to import and most workers never touch them, so they are imported in the
+#       functions that use them. These names used to be importable from here.
+_lazy_imports = {
+    'boto3': ('boto3', None),
+    'PIL': ('PIL', None),
+    'Image': ('PIL.Image', None),
+    'urlopen': ('six.moves.urllib.request', 'urlopen'),
+    'Request': ('six.moves.urllib.request', 'Request'),
+    'draw_polygon_from_shape_on_raster': ('hyp3lib.draw_polygon_on_raster', 'draw_polygon_from_shape_on_raster'),
+    'simplify_shapefile': ('hyp3lib.simplify_shapefile', 'simplify_shapefile'),
+    'subset_geotiff_shape': ('hyp3lib.subset_geotiff_shape', 'subset_geotiff_shape'),
+    'get_latlon_extent': ('hyp3lib.asf_geometry', 'get_latlon_extent'),
+}
+
+
+def __getattr__(name):
+    # PEP 562 module attributes; only used for the _lazy_imports names on python 3.7+
+    if name not in _lazy_imports:
+        raise AttributeError("module {0!r} has no attribute {1!r}".format(__name__, name))
+    module_name, attr = _lazy_imports[name]
+    module = importlib.import_module(module_name)
+    return module if attr is None else getattr(module, attr)
+
+
 # FIXME: really should refactor to eliminate package globals
 # Package globals
 default_cfg = None
@@ -57,6 +79,15 @@ default_lock_dir = os.path.join(os.path.expanduser('~'), '.hyp3', 'lock')
 default_log_dir = os.path.join(os.path.expanduser('~'), '.hyp3', 'log')
 default_config_file = os.path.join(os.path.expanduser('~'), '.hyp3',  'proc.cfg')
 
+# Commands currently being run by execute
+running_processes = set()
+
+# hyp3-db config table keys loaded by setup
+db_config_keys = (
+    'product_hash_type', 'bucket_lifecycle', 'hyp3_product_url', 'hyp3-data-url',
+    'hyp3-browse-url', 'download_from_esa', 'jers_whitelist',
+)
+
 
 def signal_handler(signum, frame):
     # this ugly line creates a lookup table between signal numbers and their "nice" names
@@ -64,6 +95,8 @@ def signal_handler(signum, frame):
         signal) if n.startswith('SIG') and '_' not in n)
     log.critical("Received a {0}; bailing out.".format(
         signum_to_names[signum]))
+    # Commands run in their own session (spot workers) don't get the signal themselves
+    terminate_running_processes(signum)
     sys.exit(1)
 
 
@@ -108,6 +141,10 @@ def setup(name, cli_args=None, airgap=False, sci_version='Unknown'):
         "--input", type=str, dest="input_type", default='RTC',
         help="For generic processors (time series), select input type, RTC or InSAR.",
     )
+    parser.add_argument(
+        "--daemon", action="store_true",
+        help="Keep running and processing jobs as they are queued, instead of stopping after --num products",
+    )
     parser.add_argument(
         '--version', action='store_true',
         help="Show the HyP3 plugin and libraries version numbers and exit",
@@ -130,21 +167,8 @@ def setup(name, cli_args=None, airgap=False, sci_version='Unknown'):
         )
         sys.exit()
 
-    cfg = dict()
-    load_all_general_config(cfg)
-
-    if 'lock_dir' not in cfg:
-        cfg['lock_dir'] = default_lock_dir
-    mkdir_p(cfg['lock_dir'])
-    if 'notify_fail' not in cfg:
-        cfg['notify_fail'] = False
-    if 'write_log_file' not in cfg:
-        cfg['write_log_file'] = True
-    mkdir_p(default_log_dir)
-    if 'workdir' not in cfg:
-        cfg['workdir'] = '/tmp'
-    if 'default_rtc_resolution' not in cfg:
-        cfg['default_rtc_resolution'] = '30m'
+    cfg = JobConfig()
+    load_general_config(cfg)
 
     # Update proc name in case of generic wrapper
     if name == 'generic_ts':
@@ -162,6 +186,7 @@ def setup(name, cli_args=None, airgap=False, sci_version='Unknown'):
     cfg["queue_id"] = args.queue_id
     cfg['allow_non_sentinel'] = (name == 'rtc_gamma')  # TODO: Move to the DB?
     cfg['attachment'] = None
+    cfg['daemon'] = args.daemon
     cfg['lag'] = ''
     cfg['Legacy'] = False
     cfg['log'] = ''
@@ -193,22 +218,10 @@ def setup(name, cli_args=None, airgap=False, sci_version='Unknown'):
     cfg['oracle-pass'] = get_config('oracle', 'pass', '')
 
     if not airgap:
-        with get_db_connection('hyp3-db') as conn:
-            cfg['product_hash_type'] = get_db_config(conn, "product_hash_type")
-            cfg['bucket_lifecycle'] = get_db_config(conn, "bucket_lifecycle")
-            cfg['hyp3_product_url'] = get_db_config(conn, "hyp3_product_url")
-            cfg['hyp3-data-url'] = get_db_config(conn, "hyp3-data-url")
-            cfg['hyp3-browse-url'] = get_db_config(conn, "hyp3-browse-url")
-            cfg['from_esa'] = is_yes(get_db_config(conn, 'download_from_esa'))
-            jwl = get_db_config(conn, "jers_whitelist")
-            if jwl is None:
-                jwl = []
-            else:
-                jwl = [int(x) for x in jwl.split(',') if x.strip().isdigit()]
-            cfg['jers_whitelist'] = jwl
-
-        cfg['process_ids'] = get_process_id_dict()
+        load_db_config(cfg)
 
+    # Kept so a configuration reload (see proc_base) can tell where verbose came from
+    cfg['cli_verbose'] = args.verbose
     if is_config('general', 'verbose'):
         args.verbose = True
     setup_logger(cfg, args.verbose)
@@ -229,6 +242,85 @@ def setup(name, cli_args=None, airgap=False, sci_version='Unknown'):
     return cfg
 
 
+def load_general_config(cfg):
+    """Load the [general] section of proc.cfg into cfg, with defaults and normalized types"""
+    load_all_general_config(cfg)
+
+    if 'lock_dir' not in cfg:
+        cfg['lock_dir'] = default_lock_dir
+    mkdir_p(cfg['lock_dir'])
+    if 'lock_slots' not in cfg:
+        cfg['lock_slots'] = 1
+    cfg['lock_slots'] = int(cfg['lock_slots'])
+    if 'notify_fail' not in cfg:
+        cfg['notify_fail'] = False
+    if 'write_log_file' not in cfg:
+        cfg['write_log_file'] = True
+    if 'log_format' not in cfg:
+        cfg['log_format'] = 'text'
+    cfg['log_format'] = cfg['log_format'].lower()
+    mkdir_p(default_log_dir)
+    if 'workdir' not in cfg:
+        cfg['workdir'] = '/tmp'
+    if 'default_rtc_resolution' not in cfg:
+        cfg['default_rtc_resolution'] = '30m'
+    if 'db_config_ttl' not in cfg:
+        cfg['db_config_ttl'] = 300
+    cfg['db_config_ttl'] = int(cfg['db_config_ttl'])
+    if 'lease_seconds' not in cfg:
+        cfg['lease_seconds'] = 600
+    cfg['lease_seconds'] = int(cfg['lease_seconds'])
+    if 'heartbeat_interval' not in cfg:
+        cfg['heartbeat_interval'] = 60
+    cfg['heartbeat_interval'] = float(cfg['heartbeat_interval'])
+    if 'retry_max_attempts' not in cfg:
+        cfg['retry_max_attempts'] = 2
+    cfg['retry_max_attempts'] = int(cfg['retry_max_attempts'])
+    if 'retry_backoff' not in cfg:
+        cfg['retry_backoff'] = 300
+    cfg['retry_backoff'] = int(cfg['retry_backoff'])
+    if 'retry_max_backoff' not in cfg:
+        cfg['retry_max_backoff'] = 21600
+    cfg['retry_max_backoff'] = int(cfg['retry_max_backoff'])
+    if 'prefetch_depth' not in cfg:
+        cfg['prefetch_depth'] = 0
+    cfg['prefetch_depth'] = int(cfg['prefetch_depth'])
+    if 'daemon_idle_sleep' not in cfg:
+        cfg['daemon_idle_sleep'] = 5
+    cfg['daemon_idle_sleep'] = float(cfg['daemon_idle_sleep'])
+    if 'daemon_max_idle_sleep' not in cfg:
+        cfg['daemon_max_idle_sleep'] = 300
+    cfg['daemon_max_idle_sleep'] = float(cfg['daemon_max_idle_sleep'])
+    if 'clip_workers' not in cfg:
+        cfg['clip_workers'] = min(4, os.cpu_count() or 1)
+    cfg['clip_workers'] = int(cfg['clip_workers'])
+    if 'digest_window' not in cfg:
+        cfg['digest_window'] = 0
+    cfg['digest_window'] = int(cfg['digest_window'])
+
+
+def load_db_config(cfg, use_cache=True):
+    """Load the hyp3-db backed config values and process ids into cfg"""
+    ttl = cfg['db_config_ttl'] if use_cache else 0
+    db_cfg, cfg['process_ids'] = load_db_configs(
+        db_config_keys,
+        cache_file=os.path.join(cfg['lock_dir'], 'db_config.json'),
+        ttl=ttl,
+    )
+    cfg['product_hash_type'] = db_cfg.get("product_hash_type")
+    cfg['bucket_lifecycle'] = db_cfg.get("bucket_lifecycle")
+    cfg['hyp3_product_url'] = db_cfg.get("hyp3_product_url")
+    cfg['hyp3-data-url'] = db_cfg.get("hyp3-data-url")
+    cfg['hyp3-browse-url'] = db_cfg.get("hyp3-browse-url")
+    cfg['from_esa'] = is_yes(db_cfg.get('download_from_esa'))
+    jwl = db_cfg.get("jers_whitelist")
+    if jwl is None:
+        jwl = []
+    else:
+        jwl = [int(x) for x in jwl.split(',') if x.strip().isdigit()]
+    cfg['jers_whitelist'] = jwl
+
+
 def get_looks(dir_):
     for subdir, dirs, files in os.walk(dir_):
         for file in files:
@@ -298,16 +390,37 @@ def contains_allowable_error(s):
     return any([i in s for i in l])
 
 
+def terminate_running_processes(signum=signal.SIGTERM):
+    """Signal the commands currently being run by execute, e.g. from another thread"""
+    for pipe in list(running_processes):
+        log.warning('Stopping running command, PID {0}'.format(pipe.pid))
+        try:
+            # Signal the whole process group when the command has its own, so
+            # the programs run by the shell are stopped too
+            if os.getpgid(pipe.pid) == pipe.pid:
+                os.killpg(pipe.pid, signum)
+            else:
+                pipe.send_signal(signum)
+        except OSError:
+            pass
+
+
 def execute(cfg, cmd, expected=None):
     print_cmd = obscure_pwd(cfg, cmd)
 
-    log.debug('Running command: ' + print_cmd)
+    log.debug('Running command: %s', print_cmd)
     rcmd = cmd + ' 2>&1'
 
-    pipe = subprocess.Popen(rcmd, shell=True, stdout=subprocess.PIPE)
-    output = pipe.communicate()[0]
+    # Spot workers run commands in their own session so an interruption can
+    # stop everything they started (see hyp3proclib.spot)
+    pipe = subprocess.Popen(rcmd, shell=True, stdout=subprocess.PIPE, start_new_session=bool(cfg.get('spot')))
+    running_processes.add(pipe)
+    try:
+        output = pipe.communicate()[0]
+    finally:
+        running_processes.discard(pipe)
     return_val = pipe.returncode
-    log.debug('subprocess return value was ' + str(return_val))
+    log.debug('subprocess return value was %s', return_val)
 
     # Sometimes processes have weird output, leading to this
     output = output.decode('iso8859-1')
@@ -319,14 +432,14 @@ def execute(cfg, cmd, expected=None):
         if '** Error: **' in line:
             print_warnings = True
         if (print_warnings):
-            log.warn('Proc: ' + line)
+            log.warning('Proc: %s', line)
         else:
             if len(line.rstrip()) > 0 and line[0:7] != "Process":
-                log.debug('Proc: ' + line)
+                log.debug('Proc: %s', line)
         if '** End of error **' in line:
             print_warnings = False
 
-    log.debug('Finished: ' + print_cmd)
+    log.debug('Finished: %s', print_cmd)
 
     if return_val != 0:
         log.debug('Nonzero return value!')
@@ -356,11 +469,11 @@ def execute(cfg, cmd, expected=None):
         raise Exception(tool + ': ' + last)
 
     if expected is not None:
-        log.debug('Checking for expected output: ' + expected)
+        log.debug('Checking for expected output: %s', expected)
         if os.path.isfile(expected):
-            log.debug('Found: ' + expected)
+            log.debug('Found: %s', expected)
         else:
-            log.warn('Expected output file not found: ' + expected)
+            log.warning('Expected output file not found: %s', expected)
             raise Exception("Expected output file not found: " + expected)
 
     return output
@@ -391,7 +504,11 @@ def upload_to_s3(product_path, cfg, bucket, is_public=False):
 
     log.info("Uploading product: " + product_path)
 
-    s3_client = boto3.client(
+    import boto3.session
+    import boto3.s3.transfer
+
+    # A session per upload: the default session isn't safe to share between threads
+    s3_client = boto3.session.Session().client(
         "s3",
         aws_access_key_id=cfg["aws_access_key_id"],
         aws_secret_access_key=cfg["aws_secret_access_key"],
@@ -467,6 +584,10 @@ def reproject_image(cfg, in_image, out_image, epsg):
         raise Exception("JPG not yet implemented for Mercator browses")
 
     try:
+        if warp_to_png(in_image, out_image, epsg):
+            return True
+
+        log.debug('No GDAL Python bindings; reprojecting with gdalwarp')
         tmpTiff = out_image.replace('.png', '.tif')
         execute(cfg, "gdalwarp -t_srs EPSG:{0} {1} {2}".format(
             epsg, in_image, tmpTiff), expected=tmpTiff)
@@ -520,6 +641,7 @@ def find_browses(cfg, dir_):
         if ok and os.path.isfile(geo_merc):
             add_browse(cfg, 'GEO-IMAGE', geo_merc)
 
+            from hyp3lib.asf_geometry import get_latlon_extent
             lat_min, lat_max, lon_min, lon_max = get_latlon_extent(geo)
 
             cfg['browse_lat_min'] = lat_min
@@ -571,11 +693,7 @@ def add_thumbnail(cfg):
 
     thumb_path = os.path.splitext(f)[0] + ".thumb.png"
     s = int(get_config('general', 'thumbnail_size', 200))
-    size = (s, s)
-
-    im = Image.open(f)
-    im.thumbnail(size, Image.ANTIALIAS)
-    im.save(thumb_path, "PNG")
+    render_variants(f, [(thumb_path, (s, s), 'PNG')])
 
     log.info('Thumbnail: ' + thumb_path)
     bd['THUMBNAIL'] = [thumb_path, ]
@@ -650,13 +768,9 @@ def insert_browse(cfg, conn):
         log.info('Adding record for {0}: {1}'.format(browse_type, url))
 
         if browse_type == 'GEO-IMAGE':
-            query_database(
+            execute_query(
                 conn,
-                '''
-                INSERT INTO browse(type, product_id, name, url, lat_min, lat_max, lon_min, lon_max, epsg)
-                VALUES (%(browse_type)s, %(product_id)s, %(name)s, %(url)s,
-                                 %(lat_min)s, %(lat_max)s, %(lon_min)s, %(lon_max)s, %(epsg)s)
-                ''',
+                'browse_insert_geo',
                 {
                     "browse_type": browse_type,
                     "product_id": product_id,
@@ -670,12 +784,9 @@ def insert_browse(cfg, conn):
                 },
                 commit=True)
         else:
-            query_database(
+            execute_query(
                 conn,
-                '''
-                INSERT INTO browse(type, product_id, name, url)
-                VALUES (%(browse_type)s, %(product_id)s, %(name)s, %(url)s)
-                ''',
+                'browse_insert',
                 {
                     "browse_type": browse_type,
                     "product_id": product_id,
@@ -793,6 +904,15 @@ def upload_product(product_path, cfg, conn, browse_path=None, skip_notify=False)
 
     This function return True if it succeeds and False if it fails.
     """
+    if cfg.get('spot_interrupted'):
+        raise Exception('Spot instance interrupted; not uploading ' + str(product_path))
+
+    set_log_context(stage='upload')
+
+    # Uploading is the last stage of a job; claim the next one in the background
+    if cfg.get('prefetcher') is not None:
+        cfg['prefetcher'].start()
+
     sub_id = None
     if cfg['sub_id'] > 0:
         sub_id = cfg['sub_id']
@@ -801,12 +921,19 @@ def upload_product(product_path, cfg, conn, browse_path=None, skip_notify=False)
     if browse_path is None and 'attachment' in cfg:
         browse_path = cfg['attachment']
 
-    add_browse(cfg, 'LOW-RES', browse_path)
+    if browse_path is not None and not browse_path.endswith('.pdf'):
+        browse_path = build_browse_pyramid(cfg, browse_path)['LOW-RES']
+    else:
+        add_browse(cfg, 'LOW-RES', browse_path)
 
     product_url = upload_to_s3(
         product_path, cfg, cfg['bucket'], is_public=False)
     browse_url = upload_to_s3(
         browse_path, cfg, cfg['browse_bucket'], is_public=True)
+    # The downscaled copy shown inline in the notification email
+    cfg['email_browse_url'] = None
+    if cfg.get('email_browse'):
+        cfg['email_browse_url'] = upload_to_s3(cfg['email_browse'], cfg, cfg['browse_bucket'], is_public=True)
 
     stage_product_locally(product_path, cfg)
 
@@ -823,9 +950,6 @@ def upload_product(product_path, cfg, conn, browse_path=None, skip_notify=False)
 
     cfg['filename'] = os.path.basename(product_path)
 
-    res = query_database(conn, "select id, name, url, browse_url from products where local_queue_id = %(local_queue_id)s",
-                         {"local_queue_id": cfg['id']})
-
     params = {
         "sub_id": sub_id,
         "name": os.path.basename(product_path),
@@ -842,102 +966,74 @@ def upload_product(product_path, cfg, conn, browse_path=None, skip_notify=False)
         "frame": pathFrame['frame']
     }
 
-    product_id = None
-    if len(res) == 0:
-        log.debug("No product for this job yet")
+    # The product, browse and email records are written in one transaction
+    with transaction(conn):
+        res = query_database(conn, "select id, name, url, browse_url from products where local_queue_id = %(local_queue_id)s",
+                             {"local_queue_id": cfg['id']})
 
-        query_database(
-            conn,
-            '''
-            INSERT INTO products (subscription_id, name, url, browse_url, hash, hash_type,
-                      size, creation_date, user_id, process_id, proc_node_type, local_queue_id,
-                                      ok_to_duplicate, path, frame)
-            VALUES (%(sub_id)s, %(name)s, %(url)s, %(browse_url)s,
-                %(hash)s, %(hash_type)s, %(size)s, current_timestamp, %(user_id)s, %(process_id)s,
-                %(proc_node_type)s, %(local_queue_id)s, True, %(path)s, %(frame)s)
-            ''',
-            params,
-            commit=True,
-        )
+        product_id = None
+        if len(res) == 0:
+            log.debug("No product for this job yet")
 
-        product_id = int(query_database(conn, "select id from products where local_queue_id = %(local_queue_id)s",
-                                        {"local_queue_id": cfg['id']})[0][0])
-    else:
-        log.info("Already have a product for this job -- updating")
-        product_id = int(res[0][0])
-        params['id'] = product_id
-        log.debug("Existing ID = {0}".format(params['id']))
-
-        existing_name = res[0][1]
-        existing_url = res[0][2]
-        existing_browse_url = res[0][3]
-        log.debug("Existing product: {0} {1}".format(
-            existing_name, existing_url))
-        log.debug("Existing browse: {0}".format(existing_browse_url))
-
-        if existing_name == params['name'] and existing_url == params['url']:
-            log.info("Existing product matches current, will be overwritten")
+            execute_query(conn, 'product_insert', params, commit=True)
+
+            product_id = int(query_database(conn, "select id from products where local_queue_id = %(local_queue_id)s",
+                                            {"local_queue_id": cfg['id']})[0][0])
         else:
-            log.info("Removing existing product: {0}".format(existing_url))
-            remove_from_s3(existing_url, cfg, cfg['bucket'])
-
-        if existing_browse_url == params['browse_url']:
-            log.info("Existing browse matches current, will be overwritten")
-        elif existing_browse_url is not None:
-            log.info("Removing existing product: {0}".format(
-                existing_browse_url))
-            remove_from_s3(existing_browse_url, cfg, cfg['browse_bucket'])
-
-        query_database(
-            conn,
-            '''
-            UPDATE products
-                SET
-                    subscription_id = %(sub_id)s,
-                    name = %(name)s,
-                    url = %(url)s,
-                    browse_url = %(browse_url)s,
-                    hash = %(hash)s,
-                    hash_type = %(hash_type)s,
-                    size = %(size)s,
-                    creation_date = current_timestamp,
-                    user_id = %(user_id)s,
-                    process_id = %(process_id)s,
-                    proc_node_type = %(proc_node_type)s,
-                    local_queue_id = %(local_queue_id)s,
-                    path = %(path)s,
-                    frame = %(frame)s
-                WHERE id = %(id)s
-            ''',
-            params,
-            commit=True
-        )
+            log.info("Already have a product for this job -- updating")
+            product_id = int(res[0][0])
+            params['id'] = product_id
+            log.debug("Existing ID = {0}".format(params['id']))
+
+            existing_name = res[0][1]
+            existing_url = res[0][2]
+            existing_browse_url = res[0][3]
+            log.debug("Existing product: {0} {1}".format(
+                existing_name, existing_url))
+            log.debug("Existing browse: {0}".format(existing_browse_url))
+
+            if existing_name == params['name'] and existing_url == params['url']:
+                log.info("Existing product matches current, will be overwritten")
+            else:
+                log.info("Removing existing product: {0}".format(existing_url))
+                remove_from_s3(existing_url, cfg, cfg['bucket'])
 
-    log.debug('Product ID is ' + str(product_id))
-    if product_id is None or product_id <= 0:
-        raise Exception("Invalid product id: " + str(product_id))
-    cfg['product_id'] = product_id
+            if existing_browse_url == params['browse_url']:
+                log.info("Existing browse matches current, will be overwritten")
+            elif existing_browse_url is not None:
+                log.info("Removing existing product: {0}".format(
+                    existing_browse_url))
+                remove_from_s3(existing_browse_url, cfg, cfg['browse_bucket'])
 
-    if browse_path is not None:
-        insert_browse(cfg, conn)
-    update_completed_time(cfg)
+            execute_query(conn, 'product_update', params, commit=True)
 
-    if not skip_notify:
-        notify_user(product_url, sub_id, cfg, conn)
+        log.debug('Product ID is ' + str(product_id))
+        if product_id is None or product_id <= 0:
+            raise Exception("Invalid product id: " + str(product_id))
+        cfg['product_id'] = product_id
 
+        if browse_path is not None:
+            insert_browse(cfg, conn)
+        update_completed_time(cfg)
+
+        if not skip_notify:
+            notify_user(product_url, sub_id, cfg, conn)
 
-def get_top_queue_items(num=1, retry=False, procs=None):
-    status = 'QUEUED'
-    if retry:
-        status = 'RETRY'
 
+def queue_backlog_filter(retry=False, procs=None):
+    """SQL from/where clause (and its params) selecting the processable backlog.
+
+    Shared by get_top_queue_items and get_queue_stats. Meant to be served by
+    an index on local_queue (status, process_id):
+
+        CREATE INDEX local_queue_status_process_idx ON local_queue (status, process_id);
+    """
     sql = '''
-        select u.username, u.priority, lq.priority, p.text_id, s.name
         from local_queue lq
                left join subscriptions s on lq.sub_id = s.id
                join users u on lq.user_id = u.id
                join processes p on lq.process_id = p.id
-        where lq.status = '{0}' and
+        where lq.status = %(status)s and
                lq.granule like 'S%%' and
                u.system_access_id > 1 and
                (u.max_granules <= 0 or u.max_granules is null or
@@ -945,46 +1041,83 @@ def get_top_queue_items(num=1, retry=False, procs=None):
                u.priority > 10 and
                p.enabled = True and
                (s.enabled = True or lq.sub_id is null) and
-    '''.format(status)
+               (lq.not_before is null or lq.not_before <= current_timestamp) and
+    '''
+    params = {'status': 'RETRY' if retry else 'QUEUED'}
 
     if procs:
-        # TODO: Fix SQL injection vulnerability (use %s and pass in procs as argument)
-        sql += '''
-               p.text_id in ({0})
-        '''.format(','.join(["'" + x + "'" for x in procs]))
+        sql += "p.text_id = any(%(procs)s)"
+        params['procs'] = list(procs)
     else:
         sql += "p.text_id != 'notify_only'"
 
-    sql += '''
-        order by coalesce(s.priority,10) desc, u.priority desc, lq.priority desc
-        limit {0} '''.format(num)
+    return sql, params
 
-    with get_db_connection('hyp3-db') as conn:
-        recs = query_database(conn, sql, {})
 
-    n = 0
-    items = dict()
-    for r in recs:
-        n += 1
-        log.debug('{0}: {2: <3} {3: <3} {1} -- {4} {5}'.format(n,
-                                                               r[0], r[1], r[2], r[3], r[4]))
-        if r[3] in items:
-            items[r[3]] += 1
-        else:
-            items[r[3]] = 1
+def get_top_queue_items(num=1, retry=False, procs=None):
+    """Return the process type with the most jobs among the num highest priority jobs"""
+    backlog_sql, params = queue_backlog_filter(retry=retry, procs=procs)
+
+    # Ties go to the process type with the highest priority job, like before
+    # the counting moved into the database
+    sql = '''
+        select text_id, count(*) as n
+        from (
+            select p.text_id,
+                   row_number() over (
+                       order by coalesce(s.priority,10) desc, u.priority desc, lq.priority desc) as rn
+            {0}
+            order by rn
+            limit %(num)s
+        ) top
+        group by text_id
+        order by n desc, min(rn) asc
+    '''.format(backlog_sql)
+    params['num'] = num
+
+    with get_db_connection('hyp3-db') as conn:
+        recs = query_database(conn, sql, params)
 
-    top = None
-    top_n = 0
-    for k in items:
-        log.debug('{0}: {1}'.format(k, items[k]))
-        if top_n < items[k]:
-            top = k
-            top_n = items[k]
+    for text_id, n in recs:
+        log.debug('{0}: {1}'.format(text_id, n))
 
+    top = recs[0][0] if recs else None
     log.info('Top: ' + str(top))
     return top
 
 
+def get_queue_stats(retry=False, procs=None):
+    """Per process type backlog depth and age, aggregated in the database.
+
+    Returns a list of dicts with the text_id, depth (number of jobs),
+    weighted_depth (jobs weighted by subscription priority, NORMAL = 1) and
+    the 50th/90th percentile and maximum job age in hours, deepest first.
+    Cheap enough to poll every few seconds, e.g. from an autoscaler.
+    """
+    backlog_sql, params = queue_backlog_filter(retry=retry, procs=procs)
+
+    sql = '''
+        select p.text_id,
+               count(*) as depth,
+               sum(coalesce(s.priority,10)) / 10.0 as weighted_depth,
+               percentile_cont(0.5) within group (order by {0}) as age_p50,
+               percentile_cont(0.9) within group (order by {0}) as age_p90,
+               max({0}) as age_max
+        {1}
+        group by p.text_id
+        order by weighted_depth desc, depth desc
+    '''.format('extract(epoch from current_timestamp - lq.request_time) / 3600', backlog_sql)
+
+    with get_db_connection('hyp3-db') as conn:
+        recs = query_database(conn, sql, params)
+
+    keys = ('text_id', 'depth', 'weighted_depth', 'age_p50', 'age_p90', 'age_max')
+    stats = list()
+    for r in recs:
+        stats.append(dict(zip(keys, [r[0], int(r[1])] + [float(x) if x is not None else None for x in r[2:]])))
+    return stats
+
+
 def sub_priority_string(sub_priority):
     if sub_priority == 10 or sub_priority is None:
         return "NORMAL"
@@ -996,24 +1129,19 @@ def sub_priority_string(sub_priority):
         return "???"
 
 
-def get_queue_item(cfg, exit=True, make_workdir=True):
-    check_stop(cfg)
+def get_queue_item(cfg, exit=True, make_workdir=True, stop_check=True):
+    set_log_context(stage='claim', local_queue_id=None, granule=None)
+    if stop_check:
+        check_stop(cfg)
 
     sql = '''
-        select lq.granule, lq.granule_url, lq.other_granules, lq.other_granule_urls, lq.id,
-               s.priority as sub_priority, u.priority as user_priority, lq.priority as item_priority,
-               s.name as sub_name, s.id, u.username, u.id, p.name, p.suffix, p.id,
-               st_ymin(s.location) as min_lat, st_ymax(s.location) as max_lat,
-               st_xmin(s.location) as min_lon, st_xmax(s.location) as max_lon,
-               s.crop_to_selection, s.project_id, s.description,
-               round((EXTRACT(EPOCH FROM current_timestamp) - EXTRACT(EPOCH FROM request_time))/3600) as age_hours,
-               lq.extra_arguments
+        select {0}
         from local_queue lq
                left join subscriptions s on lq.sub_id = s.id
                join users u on lq.user_id = u.id
                join processes p on lq.process_id = p.id
         where
-    '''
+    '''.format(job_columns)
 
     wanted_status = 'QUEUED'
     found = False
@@ -1064,11 +1192,17 @@ def get_queue_item(cfg, exit=True, make_workdir=True):
             sql += '''
                 and p.text_id = %(text_id)s
                 and lq.status = %(status)s
+                and (lq.not_before is null or lq.not_before <= current_timestamp)
                 and ((p.enabled = True and s.enabled = True) or lq.sub_id is null)
             '''
 
             vals = {'text_id': cfg['proc_name'], 'status': wanted_status }
 
+            # Piggyback lease reaping on claims, at most once per lease length
+            if time.time() - cfg.get('last_lease_reap', 0) > cfg['lease_seconds']:
+                reap_expired_leases(conn, cfg)
+                cfg['last_lease_reap'] = time.time()
+
             if 'test_mode' in cfg and is_yes(cfg['test_mode']) and 'test_user_id' in cfg:
                 sql += '''
                     and u.id = %(test_user_id)s
@@ -1089,82 +1223,32 @@ def get_queue_item(cfg, exit=True, make_workdir=True):
                 limit 30
             '''
 
-        recs = query_database(conn, sql, vals)
+        recs = execute_query(conn, register_dynamic_query('queue_candidates', sql).name, vals)
 
         if len(recs) == 0:
-            log.debug('No records found. SQL = ' + sql)
+            log.debug('No records found. SQL = %s', sql)
 
         for r in recs:
             if r and r[0] and len(r[0]) > 0:
-                id_ = int(r[4])
-                if r[5] is not None:
-                    sub_priority = int(r[5])
-                else:
-                    sub_priority = None
-                user_priority = int(r[6])
-                item_priority = int(r[7])
-                granule = r[0]
-                username = r[10]
-                log.debug('Trying to grab lock for granule {0} for user {1}.'.format(
-                    granule, username))
-                log.debug('  Subscription priority={0}, User priority={1}, job priority={2}'.format(
-                    sub_priority_string(sub_priority), user_priority, item_priority))
-
-                sql = "update local_queue set status = 'PROCESSING', processed_time = current_timestamp where id = %(id)s and status = %(status)s"
-                count = query_database(
-                    conn, sql, {'id': id_, 'status': wanted_status}, commit=True)
+                job = JobRecord.from_row(r)
+                log.debug('Trying to grab lock for granule %s for user %s.', job.granule, job.username)
+                if log.isEnabledFor(logging.DEBUG):
+                    log.debug('  Subscription priority=%s, User priority=%s, job priority=%s',
+                              sub_priority_string(job.sub_priority), job.user_priority, job.item_priority)
+
+                count = execute_query(
+                    conn, 'claim_job', {'id': job.id, 'status': wanted_status, 'lease': cfg['lease_seconds']},
+                    commit=True)
 
                 if count < 1:
-                    log.debug('Failed to obtain lock to process ' + granule)
+                    log.debug('Failed to obtain lock to process %s', job.granule)
                     continue
                 else:
-                    log.info('Obtained processing lock for ' + granule)
-                    log.debug('local_queue id is {0}'.format(r[4]))
-                    cfg['granule'] = granule
-                    cfg['granule_url'] = r[1]
-                    cfg['other_granules'] = r[2].split(',') if (
-                        r[2] is not None and len(r[2]) > 0) else None
-                    cfg['other_granule_urls'] = r[3].split(',') if (
-                        r[3] is not None and len(r[3]) > 0) else None
-
-                    cfg['id'] = int(r[4])
-
-                    cfg['user_priority'] = user_priority
-                    cfg['item_priority'] = item_priority
-                    if r[9] is not None:
-                        cfg['sub_name'] = r[8]
-                        cfg['sub_id'] = int(r[9])
-                        cfg['min_lat'] = float(r[15])
-                        cfg['max_lat'] = float(r[16])
-                        cfg['min_lon'] = float(r[17])
-                        cfg['max_lon'] = float(r[18])
-                    else:
-                        cfg['sub_name'] = 'One-Time'
-                        cfg['sub_id'] = 0
-                        cfg['min_lat'] = -90.0
-                        cfg['max_lat'] = 90.0
-                        cfg['min_lon'] = -180.0
-                        cfg['max_lon'] = 180.0
-                    cfg['user_id'] = int(r[11])
-                    cfg['username'] = username
-                    cfg['process_name'] = r[12]
-                    cfg['suffix'] = r[13]
-                    cfg['proc_id'] = int(r[14])
-                    # cfg['crop_to_selection'] = False
-                    cfg['crop_to_selection'] = bool(r[19])
-                    if r[20] is None:
-                        cfg['project_id'] = -1
-                    else:
-                        cfg['project_id'] = int(r[20])
-                        log.debug('Project ID: ' + str(cfg['project_id']))
-                    if r[21] is None:
-                        cfg['description'] = ''
-                    else:
-                        cfg['description'] = r[21]
-                    if r[23] is None or len(str(r[23])) <= 2:
-                        cfg['extra_arguments'] = dict()
-                    else:
-                        cfg['extra_arguments'] = json.loads(r[23])
+                    log.info('Obtained processing lock for %s', job.granule)
+                    log.debug('local_queue id is %s', job.id)
+                    if job.project_id >= 0:
+                        log.debug('Project ID: %s', job.project_id)
+                    use_job(cfg, job)
                     found = True
                     break
 
@@ -1185,6 +1269,7 @@ def get_queue_item(cfg, exit=True, make_workdir=True):
                 return False
 
         cfg['process_start_time'] = datetime.datetime.now()
+        start_heartbeat(cfg)
 
         if make_workdir:
             setup_workdir(cfg)
@@ -1196,6 +1281,8 @@ def get_queue_item(cfg, exit=True, make_workdir=True):
 
 
 def findPathFrame(granule):
+    from six.moves.urllib.request import urlopen, Request
+
     url = "https://api.daac.asf.alaska.edu/services/search/param?granule_list={0}&output=json".format(granule)
     req = Request(url, headers={'content-type': 'application/json'})
     response = urlopen(req)
@@ -1324,7 +1411,8 @@ def record_metrics(cfg, conn):
 
 
 def success(conn, cfg):
-    update_queue_status(conn, cfg, 'COMPLETE')
+    with transaction(conn):
+        update_queue_status(conn, cfg, 'COMPLETE')
 
 
 def is_permanent_fail(cfg, error_msg):
@@ -1344,46 +1432,70 @@ def is_permanent_fail(cfg, error_msg):
     return False
 
 
+def retry_delay(cfg, attempts):
+    """Seconds to wait before retrying a job that has already failed attempts times"""
+    return min(cfg['retry_max_backoff'], cfg['retry_backoff'] * 2 ** attempts)
+
+
 def failure(cfg, error_msg):
-    with get_db_connection('hyp3-db') as conn:
-        if 'id' in cfg and cfg['id'] is not None:
-            # TODO: Should this be checking cfg['retry'] is False?
-            if cfg['retry'] is True or is_permanent_fail(cfg, error_msg):
-                update_queue_status(conn, cfg, 'FAILED', msg=error_msg)
-                notify_user_failure(cfg, conn, error_msg)
-            else:
-                log.info('Marking job for RETRY')
-                update_queue_status(conn, cfg, 'RETRY', msg=error_msg)
+    if cfg.get('spot_interrupted'):
+        log.info('Spot instance interrupted; job was already requeued')
+        return
+
+    set_log_context(stage='failure')
+    # On its own connection: the job's may be in a failed transaction, or one its caller will roll back
+    conn = get_db_connection('hyp3-db', shared=False)
+    try:
+        with conn, transaction(conn):
+            if 'id' in cfg and cfg['id'] is not None:
+                attempts = cfg.get('attempts', 0)
+                if cfg['retry']:
+                    # Anything in RETRY has failed at least once, even if queued before attempts were counted
+                    attempts = max(attempts, 1)
+                if is_permanent_fail(cfg, error_msg):
+                    update_queue_status(conn, cfg, 'FAILED', msg=error_msg)
+                    notify_user_failure(cfg, conn, error_msg)
+                elif attempts + 1 >= cfg['retry_max_attempts']:
+                    log.info('Job failed {0} times; giving up'.format(attempts + 1))
+                    update_queue_status(conn, cfg, 'FAILED', msg=error_msg)
+                    notify_user_failure(cfg, conn, error_msg)
+                else:
+                    delay = retry_delay(cfg, attempts)
+                    log.info('Marking job for RETRY in {0} seconds'.format(delay))
+                    update_queue_status(conn, cfg, 'RETRY', msg=error_msg, retry_delay=delay)
+    finally:
+        conn.close()
 
 
-def update_queue_status(conn, cfg, new_status, msg=None, queue_id=None):
+def update_queue_status(conn, cfg, new_status, msg=None, queue_id=None, retry_delay=None):
     if queue_id is None:
         queue_id = cfg['id']
 
-    log.debug('Updating status of local_queue id={0} to {1}'.format(
-        queue_id, new_status))
+    log.debug('Updating status of local_queue id=%s to %s', queue_id, new_status)
+
+    if queue_id == cfg.get('id'):
+        stop_heartbeat(cfg)
 
     # wow this is the worst
     if new_status == 'COMPLETE':
-        log.debug(
-            'Updating completed_time for local_queue id={0}'.format(queue_id))
-        sql = "update local_queue set status = %(status)s, completed_time = current_timestamp where id = %(id)s"
-        query_database(
-            conn, sql, {'status': new_status, 'id': queue_id}, commit=True)
+        log.debug('Updating completed_time for local_queue id=%s', queue_id)
+        execute_query(
+            conn, 'queue_status_complete', {'status': new_status, 'id': queue_id}, commit=True)
+    elif new_status == 'RETRY' and retry_delay is not None:
+        log.debug('Scheduling retry of local_queue id=%s in %s seconds', queue_id, retry_delay)
+        execute_query(
+            conn, 'queue_status_retry', {'status': new_status, 'msg': msg, 'delay': retry_delay, 'id': queue_id},
+            commit=True)
     elif msg is None:
-        sql = "update local_queue set status = %(status)s where id = %(id)s"
-        query_database(
-            conn, sql, {'status': new_status, 'id': queue_id}, commit=True)
+        execute_query(
+            conn, 'queue_status', {'status': new_status, 'id': queue_id}, commit=True)
     elif new_status == 'FAILED':
-        log.debug(
-            'Updating completed_time for local_queue id={0}'.format(queue_id))
-        sql = "update local_queue set status = %(status)s, message = %(msg)s, completed_time = current_timestamp where id = %(id)s"
-        query_database(
-            conn, sql, {'status': new_status, 'msg': msg, 'id': queue_id}, commit=True)
+        log.debug('Updating completed_time for local_queue id=%s', queue_id)
+        execute_query(
+            conn, 'queue_status_failed', {'status': new_status, 'msg': msg, 'id': queue_id}, commit=True)
     else:
-        sql = "update local_queue set status = %(status)s, message = %(msg)s where id = %(id)s"
-        query_database(
-            conn, sql, {'status': new_status, 'msg': msg, 'id': queue_id}, commit=True)
+        execute_query(
+            conn, 'queue_status_message', {'status': new_status, 'msg': msg, 'id': queue_id}, commit=True)
 
     if cfg['proc_name'] != "notify":
         update_instance_record(cfg, conn)
@@ -1424,16 +1536,15 @@ def unzip(file, dir_):
 def resize_image(filename, width):
     if filename.endswith('.pdf'):
         return filename
-    img = Image.open(filename).convert('RGB')
+
+    from PIL import Image
+    img = Image.open(filename)
     if img.size[0] <= width * 2:
         # Don't enlarge an image, or shrink if already pretty small
         return filename
 
-    pct = float(width) / float(img.size[0])
-    height = int(float(img.size[1]) * pct)
-    img = img.resize((width, height), PIL.Image.ANTIALIAS)
     newname = filename + '.small.jpg'
-    img.save(newname, "JPEG")
+    render_variants(img, [(newname, (width, None), 'JPEG')])
     return newname
 
 
@@ -1486,27 +1597,15 @@ def get_extra_arg(cfg, key, default):
 
 
 def generate_shapefile(conn, cfg, shapefile):
-    host = get_config('hyp3-db', 'host')
-    dbname = get_config('hyp3-db', 'db')
-    user = get_config('hyp3-db', 'user')
-    password = get_config('hyp3-db', 'pass')
+    """Write the subscription's simplified ROI to shapefile, from the node's ROI cache"""
+    from hyp3proclib.roi import get_shapefile_cache
 
     log.debug('Generating shapefile')
-    cmd = 'ogr2ogr -f "ESRI Shapefile" {0} "PG:host={1} dbname={2} user={3} password={4}" -sql "select location from subscriptions where id={5}"'.format(
-        shapefile, host, dbname, user, password, cfg['sub_id'])
-
-    execute(cfg, cmd, expected=shapefile)
-
-    # Simplify complex shape files (over 300 points)
-    tmpshape = "tmp_shape_{}.shp".format(os.getpid())
-    simplify_shapefile(shapefile, tmpshape)
-    base_dir, base = os.path.split(tmpshape)
-    base1, ext = os.path.splitext(base)
-    for myfile in glob.glob("{}*".format(base1)):
-        ext = os.path.splitext(myfile)[1]
-        infile = os.path.join(base_dir, myfile)
-        outfile = os.path.join(base_dir, base1+ext)
-        shutil.move(infile, outfile)
+    if conn is None:
+        with get_db_connection('hyp3-db') as conn:
+            get_shapefile_cache().copy(conn, cfg['sub_id'], shapefile)
+    else:
+        get_shapefile_cache().copy(conn, cfg['sub_id'], shapefile)
 
 
 def clip_geotiff(conn, cfg, geotiff, shapefile=None):
@@ -1517,6 +1616,7 @@ def clip_geotiff(conn, cfg, geotiff, shapefile=None):
         shapefile = os.path.join(cfg['workdir'], 'roi.shp')
         generate_shapefile(conn, cfg, shapefile)
 
+    from hyp3lib.subset_geotiff_shape import subset_geotiff_shape
     subset_geotiff_shape(in_geotiff, shapefile, out_geotiff)
 
     do_rename(out_geotiff, in_geotiff)
@@ -1545,6 +1645,7 @@ def clip_geo_jpg(conn, cfg, jpeg, shapefile=None):
         generate_shapefile(conn, cfg, shapefile)
 
     log.debug('Drawing boundary: {0} -> {1}'.format(in_jpeg, out_jpeg))
+    from hyp3lib.draw_polygon_on_raster import draw_polygon_from_shape_on_raster
     draw_polygon_from_shape_on_raster(in_jpeg, shapefile, 'red', out_jpeg)
 
     do_rename(out_jpeg, in_jpeg)
@@ -1568,6 +1669,7 @@ def clip_geo_png(conn, cfg, png, shapefile=None):
         generate_shapefile(conn, cfg, shapefile)
 
     log.debug('Drawing boundary: {0} -> {1}'.format(in_png, out_png))
+    from hyp3lib.draw_polygon_on_raster import draw_polygon_from_shape_on_raster
     draw_polygon_from_shape_on_raster(in_png, shapefile, 'red', out_png)
 
     do_rename(out_png, in_png)
@@ -1586,31 +1688,64 @@ def do_rename(i, o):
     shutil.move(i, o)
 
 
+def _clip_file(kind, path, shapefile):
+    """Clip one file for clip_tiffs_to_roi, maybe in a worker process; returns the seconds it took"""
+    start = time.time()
+    if kind == 'tif':
+        clip_geotiff(None, None, path, shapefile=shapefile)
+    elif kind == 'jpg':
+        clip_geo_jpg(None, None, path, shapefile=shapefile)
+    else:
+        clip_geo_png(None, None, path, shapefile=shapefile)
+    return time.time() - start
+
+
 def clip_tiffs_to_roi(cfg, conn, path):
+    """Clip the rasters in path to the subscription's region of interest.
+
+    Files are clipped in up to clip_workers processes at once, all sharing
+    one ROI shapefile. Returns {file: seconds taken to clip it}.
+    """
     if 'crop_to_selection' in cfg and cfg['crop_to_selection'] is True:
         log.info('Clipping geotiffs in ' + path)
 
         shapefile = os.path.join(cfg['workdir'], 'roi.shp')
         generate_shapefile(conn, cfg, shapefile)
 
+        clips = []
         for file in os.listdir(path):
             full = os.path.join(path, file)
-            log.debug("Possibly clipping: " + full)
+            log.debug('Possibly clipping: %s', full)
             if file.endswith(".tif"):
-                clip_geotiff(conn, cfg, full, shapefile=shapefile)
+                clips.append(('tif', full))
             elif file.endswith(".jpg"):
                 aux_file = full.replace(".jpg", ".jpg.aux.xml")
                 if os.path.isfile(aux_file):
-                    clip_geo_jpg(conn, cfg, full, shapefile=shapefile)
+                    clips.append(('jpg', full))
                 else:
                     log.info("No aux file: " + aux_file)
             elif file.endswith(".png") and 'large' not in file:
                 aux_file = full.replace(".png", ".png.aux.xml")
                 if os.path.isfile(aux_file):
-                    clip_geo_png(conn, cfg, full, shapefile=shapefile)
+                    clips.append(('png', full))
                 else:
                     log.info("No aux file: " + aux_file)
+
+        workers = min(len(clips), cfg.get('clip_workers', 1))
+        if workers > 1:
+            from concurrent.futures import ProcessPoolExecutor
+
+            log.debug('Clipping %s files in %s processes', len(clips), workers)
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = [(full, pool.submit(_clip_file, kind, full, shapefile)) for kind, full in clips]
+                timings = [(full, future.result()) for full, future in futures]
+        else:
+            timings = [(full, _clip_file(kind, full, shapefile)) for kind, full in clips]
+
+        for full, elapsed in timings:
+            log.info('Clipped %s in %.1f seconds', os.path.basename(full), elapsed)
         log.debug('Done')
+        return dict(timings)
     else:
         log.info('Cropping not enabled for this subscription.')
-
+        return {}
@@ -0,0 +1,187 @@
+"""Module for proc_lib asyncio functions
+
+Coroutine versions of the database, job, S3 and HTTP helpers, so bookkeeping
+workers (notify, the email sender, instance tracking) can overlap many of them
+in one process:
+
+    async with AsyncConnectionPool() as pool:
+        await asyncio.gather(*[
+            query_database(pool, sql, {'id': id_}, commit=True) for id_ in ids
+        ])
+
+psycopg2, boto3 and urllib only block, so the work is run on bounded thread
+executors. Each database executor thread keeps its own connection (see
+hyp3proclib.db.get_db_connection), which makes the executor a pool of
+db_pool_size connections; S3 and HTTP calls share io_pool_size threads. Both
+sizes are read from the [general] section of proc.cfg.
+"""
+
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import asyncio
+import functools
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from hyp3proclib import db
+from hyp3proclib.config import get_config, is_yes
+from hyp3proclib.db import get_db_connection
+from hyp3proclib.logger import log
+
+_io_executor = None
+_io_executor_lock = threading.Lock()
+
+
+class AsyncConnectionPool(object):
+    """Run database work for coroutines on up to size connections"""
+
+    def __init__(self, section='hyp3-db', size=None):
+        if size is None:
+            size = int(get_config('general', 'db_pool_size', '8'))
+        self.section = section
+        self.size = size
+        self._connections = []
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix='hyp3proclib-db')
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        self.close()
+
+    async def call(self, func, *args, **kwargs):
+        """Await func(*args, **kwargs) on a pool thread; its get_db_connection calls use the pooled connection"""
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    async def run(self, func, *args, **kwargs):
+        """Await func(conn, *args, **kwargs) with a pooled connection
+
+        Like `with get_db_connection(section) as conn:`, the work is committed
+        if func returns and rolled back if it raises.
+        """
+        return await self.call(self._with_connection, func, args, kwargs)
+
+    def _with_connection(self, func, args, kwargs):
+        conn = get_db_connection(self.section)
+        if not is_yes(get_config('general', 'reuse_db_connections', 'yes')):
+            # A new connection per call; nothing to keep for close()
+            try:
+                with conn:
+                    return func(conn, *args, **kwargs)
+            finally:
+                conn.close()
+
+        with self._lock:
+            if conn not in self._connections:
+                self._connections.append(conn)
+
+        with conn:
+            return func(conn, *args, **kwargs)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+
+
+async def query_database(pool, query, params=None, commit=False, returning=False):
+    """Coroutine version of hyp3proclib.db.query_database"""
+    return await pool.run(db.query_database, query, params, commit=commit, returning=returning)
+
+
+async def claim_job(pool, cfg, make_workdir=False, stop_check=False):
+    """Coroutine version of hyp3proclib.get_queue_item; returns whether a job was claimed into cfg
+
+    cfg holds a single job, so concurrent claims each need their own copy
+    (see hyp3proclib.prefetch.new_job_cfg). Only the claim runs on a pool
+    thread: check_stop (which may exit) and making the work directory happen
+    on the calling thread, and the process' working directory isn't changed.
+    """
+    from hyp3proclib import get_queue_item
+    from hyp3proclib.file_system import check_stop, setup_workdir
+
+    if stop_check:
+        check_stop(cfg)
+
+    found = await pool.call(get_queue_item, cfg, exit=False, make_workdir=False, stop_check=False)
+    if found and make_workdir:
+        setup_workdir(cfg, chdir=False)
+    return found
+
+
+async def complete_job(pool, cfg, product_path, browse_path=None, skip_notify=False):
+    """Upload the job's product and mark it COMPLETE, in one transaction"""
+    from hyp3proclib import success, upload_product
+
+    def complete(conn):
+        with db.transaction(conn):
+            upload_product(product_path, cfg, conn, browse_path=browse_path, skip_notify=skip_notify)
+            success(conn, cfg)
+
+    await pool.run(complete)
+
+
+async def fail_job(pool, cfg, error_msg):
+    """Coroutine version of hyp3proclib.failure"""
+    from hyp3proclib import failure
+    await pool.call(failure, cfg, error_msg)
+
+
+def get_io_executor():
+    global _io_executor
+    with _io_executor_lock:
+        if _io_executor is None:
+            size = int(get_config('general', 'io_pool_size', '16'))
+            _io_executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix='hyp3proclib-io')
+    return _io_executor
+
+
+async def run_io(func, *args, **kwargs):
+    """Await blocking I/O func(*args, **kwargs) on the shared I/O executor"""
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(get_io_executor(), functools.partial(func, *args, **kwargs))
+
+
+async def upload_to_s3(product_path, cfg, bucket, is_public=False):
+    """Coroutine version of hyp3proclib.upload_to_s3"""
+    import hyp3proclib
+    return await run_io(hyp3proclib.upload_to_s3, product_path, cfg, bucket, is_public=is_public)
+
+
+def _http_get(url, headers, timeout):
+    from six.moves.urllib.request import urlopen, Request
+
+    response = urlopen(Request(url, headers=headers or {}), timeout=timeout)
+    try:
+        return response.read()
+    finally:
+        response.close()
+
+
+async def http_get(url, headers=None, timeout=30):
+    """GET url and return the response body"""
+    log.debug('GET ' + url)
+    return await run_io(_http_get, url, headers, timeout)
+
+
+async def find_path_frame(granule):
+    """Coroutine version of hyp3proclib.findPathFrame"""
+    url = "https://api.daac.asf.alaska.edu/services/search/param?granule_list={0}&output=json".format(granule)
+    parsed_json = json.loads((await http_get(url, headers={'content-type': 'application/json'})).decode('utf8'))
+
+    if parsed_json[0]:
+        return {'path': parsed_json[0][1]['track'], 'frame': parsed_json[0][1]['frameNumber']}
+
+    log.debug("Could not locate granule: {0}".format(granule))
+    return {'path': None, 'frame': None}
+
+
+async def get_instance_identity():
+    """Coroutine version of hyp3proclib.instance_metadata.get_instance_identity"""
+    from hyp3proclib.instance_metadata import get_instance_identity
+    return await run_io(get_instance_identity)
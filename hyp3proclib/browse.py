@@ -0,0 +1,161 @@
+"""Module for proc_lib browse image functions
+
+render_variants makes several downscaled copies of an image while decoding it
+only once: JPEGs are decoded straight at a reduced scale with draft(), and
+every variant is shrunk from the next larger one, first by an integer
+reduce() and then with a LANCZOS resize to the exact size.
+"""
+
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import os
+from contextlib import contextmanager
+
+from hyp3proclib.config import get_config
+from hyp3proclib.logger import log
+
+
+def fit_size(size, box):
+    """The size of an image of size scaled down (never up) to fit within box
+
+    Either side of box may be None for no limit.
+    """
+    width, height = size
+    scale = min(float(box[0] or width) / width, float(box[1] or height) / height, 1.0)
+    return max(1, int(round(width * scale))), max(1, int(round(height * scale)))
+
+
+def shrink(im, box):
+    """Return im scaled down to fit within box"""
+    from PIL import Image
+
+    if im.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+        im = im.convert('RGBA' if 'transparency' in im.info or im.mode == 'PA' else 'RGB')
+
+    size = fit_size(im.size, box)
+    if size == im.size:
+        return im
+
+    # Cheap box filter down to about twice the final size, then resample properly
+    factor = min(im.size[0] // size[0], im.size[1] // size[1]) // 2
+    if factor > 1:
+        im = im.reduce(factor)
+
+    return im.resize(size, Image.LANCZOS)
+
+
+def render_variants(im, variants):
+    """Write downscaled copies of an image, decoding it once.
+
+    im is a path or a PIL image that hasn't been loaded yet. variants is a
+    list of (output path, (max width, max height), PIL format) and may be in
+    any order.
+    """
+    from PIL import Image
+
+    if not isinstance(im, Image.Image):
+        im = Image.open(im)
+    original_size = im.size
+
+    ordered = sorted(variants, key=lambda v: fit_size(original_size, v[1]), reverse=True)
+    if im.format == 'JPEG' and ordered:
+        largest = fit_size(original_size, ordered[0][1])
+        im.draft('RGB', (largest[0] * 2, largest[1] * 2))
+        log.debug('Decoding at %s instead of %s', im.size, original_size)
+
+    for out_path, box, format_ in ordered:
+        im = shrink(im, box)
+        out = im
+        if format_ == 'JPEG' and out.mode != 'RGB':
+            out = out.convert('RGB')
+        out.save(out_path, format_)
+        log.debug('Wrote %sx%s browse: %s', out.size[0], out.size[1], out_path)
+
+
+@contextmanager
+def gdal_exceptions(gdal):
+    """Have GDAL raise errors inside the block only, leaving the process wide setting as it was"""
+    if hasattr(gdal, 'ExceptionMgr'):
+        with gdal.ExceptionMgr(useExceptions=True):
+            yield
+        return
+
+    was_using = gdal.GetUseExceptions()
+    gdal.UseExceptions()
+    try:
+        yield
+    finally:
+        if not was_using:
+            gdal.DontUseExceptions()
+
+
+def warp_to_png(in_image, out_image, epsg):
+    """Reproject in_image to a PNG in EPSG:epsg with the GDAL Python bindings.
+
+    The warp is only described by an in-memory VRT and runs as the PNG is
+    written, so there is no intermediate GeoTIFF and no gdalwarp or
+    gdal_translate process. Returns False, without doing anything, if the
+    bindings aren't installed.
+    """
+    try:
+        from osgeo import gdal
+    except ImportError:
+        return False
+
+    with gdal_exceptions(gdal):
+        vrt = gdal.Warp('', in_image, format='VRT', dstSRS='EPSG:{0}'.format(epsg))
+        try:
+            gdal.Translate(out_image, vrt, format='PNG')
+        finally:
+            vrt = None
+
+    return True
+
+
+def build_browse_pyramid(cfg, path):
+    """Make the browse variants of the image at path and add them with add_browse
+
+    LOW-RES is path itself, or a copy fitting low_res_browse_size when that is
+    set (in the [general] section of proc.cfg) and the image is larger.
+    THUMBNAIL fits thumbnail_size (200) and is only made if cfg has none yet.
+    The email sized copy, browse_email_width (800) wide, is set as
+    cfg['email_browse'] rather than added as a browse type. Returns
+    {type: path} for LOW-RES and THUMBNAIL.
+
+    Any image PIL can't render (a format or mode it doesn't handle, or a
+    browse over Image.MAX_IMAGE_PIXELS it refuses as a decompression bomb)
+    is added as LOW-RES as is, without the other variants.
+    """
+    from PIL import Image
+    from hyp3proclib import add_browse
+
+    base, ext = os.path.splitext(path)
+    low_res_size = int(get_config('general', 'low_res_browse_size', 0))
+    thumbnail_size = int(get_config('general', 'thumbnail_size', 200))
+    email_width = int(get_config('general', 'browse_email_width', 800))
+
+    cfg.pop('email_browse', None)
+    paths = {'LOW-RES': path}
+    try:
+        im = Image.open(path)
+
+        variants = [(base + '.email.jpg', (email_width, None), 'JPEG')]
+        if 'THUMBNAIL' not in cfg.get('browse_images', {}):
+            paths['THUMBNAIL'] = base + '.thumb.png'
+            variants.append((paths['THUMBNAIL'], (thumbnail_size, thumbnail_size), 'PNG'))
+        if 0 < low_res_size < max(im.size):
+            paths['LOW-RES'] = base + '.low' + ext
+            format_ = 'JPEG' if im.format == 'JPEG' else 'PNG'
+            variants.append((paths['LOW-RES'], (low_res_size, low_res_size), format_))
+
+        render_variants(im, variants)
+    except Exception:
+        log.exception('Could not make browse variants of %s', path)
+        add_browse(cfg, 'LOW-RES', path)
+        return {'LOW-RES': path}
+
+    cfg['email_browse'] = base + '.email.jpg'
+    for type_, variant_path in sorted(paths.items()):
+        add_browse(cfg, type_, variant_path)
+
+    return paths
@@ -2,23 +2,69 @@
 
 from __future__ import print_function, absolute_import, division, unicode_literals
 
+import itertools
+import json
+import os
+import threading
 import time
+import weakref
+from contextlib import contextmanager
 
-import psycopg2
-
-from hyp3proclib.config import get_config
+from hyp3proclib.config import get_config, is_yes
 from hyp3proclib.logger import log
 
+# Open connections by config section, kept per thread for reuse by get_db_connection
+_connections = threading.local()
+
+# Depth of the open transaction() blocks on each connection
+_transactions = weakref.WeakKeyDictionary()
+
+# Numbers the server side cursors opened by stream_query
+_cursor_ids = itertools.count(1)
+
+_connection_class = None
+
+
+def get_db_connection(s, tries=0, shared=True):
+    """Return a connection to the database configured in section s of proc.cfg.
+
+    The connection is reused by later calls from the same thread and process,
+    which saves a connection handshake per query and keeps statements prepared
+    by hyp3proclib.queries. Set reuse_db_connections = no in the [general]
+    section to get a new connection every time. A reused connection that has
+    sat idle for db_ping_interval seconds (30) is pinged first, and replaced
+    if the server dropped it.
+
+    Only the outermost `with conn:` block on a connection (outside any
+    transaction() block) commits or rolls back, so helpers can use
+    `with get_db_connection(s) as conn:` without ending their caller's work.
+    With shared=False the connection is a new one, not reused, for the
+    caller to close.
+    """
+    reuse = shared and is_yes(get_config('general', 'reuse_db_connections', 'yes'))
+    if reuse:
+        cached = getattr(_connections, 'by_section', {}).get(s)
+        if cached is not None and cached[0] == os.getpid():
+            if is_alive(cached[1], float(get_config('general', 'db_ping_interval', '30'))):
+                return cached[1]
+            log.warning('Lost the connection to db: %s; reconnecting', get_config(s, 'host'))
+            del _connections.by_section[s]
+            try:
+                cached[1].close()
+            except Exception:
+                pass
 
-def get_db_connection(s, tries=0):
     connection_string =\
         "host='" + get_config(s, 'host') + "' " + \
         "dbname='" + get_config(s, 'db') + "' " + \
         "user='" + get_config(s, 'user') + "' " + \
         "password='" + get_config(s, 'pass') + "'"
     log.info("Connected to db: {0}".format(get_config(s, 'host')))
+    # psycopg2 is imported here so importing hyp3proclib stays cheap
+    import psycopg2
+
     try:
-        conn = psycopg2.connect(connection_string)
+        conn = psycopg2.connect(connection_string, connection_factory=get_connection_class())
     except Exception as e:
         if (tries > 4):
             log.exception('DB connection problem: '+str(e))
@@ -27,11 +73,130 @@ def get_db_connection(s, tries=0):
             log.warning("Problem connecting to DB: "+str(e))
             log.info("Retrying in {0} seconds...".format(30*(tries+1)))
             time.sleep(30*(tries+1))
-            return get_db_connection(s, tries=tries+1)
+            return get_db_connection(s, tries=tries+1, shared=shared)
+
+    if reuse:
+        if not hasattr(_connections, 'by_section'):
+            _connections.by_section = dict()
+        _connections.by_section[s] = (os.getpid(), conn)
 
     return conn
 
 
+def get_connection_class():
+    """The psycopg2 connection class used by get_db_connection"""
+    global _connection_class
+    if _connection_class is not None:
+        return _connection_class
+
+    import psycopg2.extensions
+
+    class Connection(psycopg2.extensions.connection):
+        def __init__(self, *args, **kwargs):
+            super(Connection, self).__init__(*args, **kwargs)
+            self.with_depth = 0
+            self.checked_at = time.time()
+
+        def __enter__(self):
+            self.with_depth += 1
+            return self
+
+        def __exit__(self, exc_type, exc_value, tb):
+            # psycopg2 ends the whole session here, which would end the work of an enclosing block
+            self.with_depth -= 1
+            if self.with_depth > 0 or in_transaction(self):
+                return False
+            return super(Connection, self).__exit__(exc_type, exc_value, tb)
+
+    _connection_class = Connection
+    return _connection_class
+
+
+def is_alive(conn, ping_interval):
+    """Whether the connection still works; pings it if it has been idle for ping_interval seconds"""
+    import psycopg2
+    from psycopg2.extensions import TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_UNKNOWN
+
+    if conn.closed:
+        return False
+
+    status = conn.get_transaction_status()
+    if status == TRANSACTION_STATUS_UNKNOWN:
+        return False
+    if getattr(conn, 'with_depth', 0) > 0 or in_transaction(conn):
+        # In use; if it was lost, the caller's own queries fail
+        return True
+    if status != TRANSACTION_STATUS_IDLE:
+        # Left open, or aborted, by a query that failed outside any with or transaction() block
+        log.debug('Rolling back an unfinished transaction on a reused DB connection')
+        try:
+            conn.rollback()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+            log.warning('Could not roll back DB connection: %s', e)
+            return False
+    if time.time() - getattr(conn, 'checked_at', 0) < ping_interval:
+        return True
+
+    try:
+        _execute(conn, 'SELECT 1')
+        conn.rollback()
+    except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+        log.warning('DB connection failed a ping: %s', e)
+        return False
+
+    conn.checked_at = time.time()
+    return True
+
+
+def in_transaction(conn):
+    """Return whether conn is inside a transaction() block"""
+    try:
+        return _transactions.get(conn, 0) > 0
+    except TypeError:
+        return False
+
+
+@contextmanager
+def transaction(conn):
+    """Unit of work: run the queries made on conn in the block as one transaction.
+
+    query_database neither commits nor rolls back while the block is open, so
+    all the writes are committed once at the end, or not at all if the block
+    raises. Nested blocks use savepoints, so a failure inside one that is
+    caught only undoes that block's writes.
+    """
+    depth = _transactions.get(conn, 0)
+    savepoint = 'hyp3proclib_{0}'.format(depth) if depth > 0 else None
+    if savepoint:
+        _execute(conn, 'SAVEPOINT ' + savepoint)
+
+    _transactions[conn] = depth + 1
+    try:
+        yield conn
+    except BaseException:
+        if savepoint:
+            _execute(conn, 'ROLLBACK TO SAVEPOINT ' + savepoint)
+        else:
+            conn.rollback()
+        raise
+    else:
+        if savepoint:
+            _execute(conn, 'RELEASE SAVEPOINT ' + savepoint)
+        else:
+            conn.commit()
+    finally:
+        if depth > 0:
+            _transactions[conn] = depth
+        else:
+            del _transactions[conn]
+
+
+def _execute(conn, sql):
+    cur = conn.cursor()
+    cur.execute(sql)
+    cur.close()
+
+
 def query_database(conn, query, params=None, commit=False, returning=False):
     """Query a database.
 
@@ -39,27 +204,71 @@ def query_database(conn, query, params=None, commit=False, returning=False):
     parameters represented by a list, and a boolean representing
     whether the query makes changes to the database, and returns the
     results of the query if the boolean is False.
+
+    Inside a transaction() block nothing is committed or rolled back here.
     """
     if params is None:
         params = []
     cur = conn.cursor()
     cur.execute(query, params)
 
+    deferred = in_transaction(conn)
+
     ret = None
     if commit:
-        conn.commit()
+        if not deferred:
+            conn.commit()
         if returning:
             ret = cur.fetchall()
         else:
             ret = cur.rowcount
 
     else:
-        conn.rollback()
+        if not deferred:
+            conn.rollback()
         ret = cur.fetchall()
     cur.close()
     return ret
 
 
+def stream_query(conn, query, params=None, fetch_size=None, name=None):
+    """Query a database, yielding the result rows as they are fetched.
+
+    Like query_database for a select, but the rows are read through a named
+    (server side) cursor fetch_size at a time, so arbitrarily large results
+    are handled in constant memory. fetch_size defaults to db_fetch_size in
+    the [general] section of proc.cfg (1000).
+
+    The cursor is declared WITH HOLD, but it only outlives the transaction it
+    was declared in once that transaction commits: the caller may commit
+    queries on conn while iterating, but a rollback before the first commit
+    (including the one query_database does after a select outside
+    transaction()) closes the cursor and the next fetch fails. Run other
+    queries on another connection when that can happen.
+    """
+    if params is None:
+        params = []
+    if fetch_size is None:
+        fetch_size = int(get_config('general', 'db_fetch_size', '1000'))
+    if name is None:
+        name = 'hyp3proclib_stream_{0}'.format(next(_cursor_ids))
+
+    cur = conn.cursor(name=name, withhold=True)
+    cur.itersize = fetch_size
+    try:
+        cur.execute(query, params)
+        while True:
+            rows = cur.fetchmany(fetch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+    finally:
+        cur.close()
+        if not in_transaction(conn):
+            conn.rollback()
+
+
 def get_db_config(conn, key):
     r = query_database(
         conn, "SELECT value FROM config WHERE key = %s", (key,))
@@ -69,6 +278,83 @@ def get_db_config(conn, key):
         return None
 
 
+def get_db_configs(conn, keys):
+    """Fetch several config table values and the process id map in one round trip.
+
+    Returns a (config, process_ids) pair of dicts; keys without a (truthy)
+    value are left out of config, matching get_db_config returning None.
+    """
+    recs = query_database(
+        conn,
+        '''
+            SELECT 'config', key, value FROM config WHERE key = ANY(%(keys)s)
+            UNION ALL
+            SELECT 'process', text_id, id::text FROM processes
+        ''',
+        {'keys': list(keys)},
+    )
+
+    config = dict()
+    process_ids = dict()
+    for kind, key, value in recs:
+        if kind == 'process':
+            process_ids[key] = int(value)
+        elif value:
+            config[key] = value
+
+    return config, process_ids
+
+
+def load_db_configs(keys, cache_file=None, ttl=0):
+    """Like get_db_configs, but shared between workers through a cache file.
+
+    A cache younger than ttl seconds that covers all the requested keys is
+    used instead of querying hyp3-db, so a burst of short-lived workers on one
+    node only hits the database once per ttl.
+    """
+    keys = sorted(set(keys))
+
+    if cache_file and ttl > 0:
+        cached = read_db_config_cache(cache_file, ttl, keys)
+        if cached is not None:
+            log.debug('Using cached DB config: ' + cache_file)
+            return cached
+
+    with get_db_connection('hyp3-db') as conn:
+        config, process_ids = get_db_configs(conn, keys)
+
+    if cache_file and ttl > 0:
+        write_db_config_cache(cache_file, keys, config, process_ids)
+
+    return config, process_ids
+
+
+def read_db_config_cache(cache_file, ttl, keys):
+    try:
+        if time.time() - os.stat(cache_file).st_mtime > ttl:
+            return None
+        with open(cache_file) as f:
+            cache = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+    if not set(keys).issubset(cache.get('keys', [])):
+        return None
+
+    return cache['config'], cache['process_ids']
+
+
+def write_db_config_cache(cache_file, keys, config, process_ids):
+    # Write and rename so other workers never read a partial file
+    tmp_file = '{0}.{1}.tmp'.format(cache_file, os.getpid())
+    try:
+        with open(tmp_file, 'w') as f:
+            json.dump({'keys': keys, 'config': config, 'process_ids': process_ids}, f)
+        os.rename(tmp_file, cache_file)
+    except (IOError, OSError) as e:
+        log.warning('Could not write DB config cache: ' + str(e))
+
+
 def get_user_email(user_id, conn):
     recs = query_database(conn, "SELECT email, username, wants_email FROM users WHERE id = %s", (user_id,))
     if recs and len(recs) > 0 and len(recs[0]) > 0:
@@ -0,0 +1,146 @@
+"""Module for proc_lib notification digests
+
+With digest_window (seconds, in the [general] section of proc.cfg) above 0,
+notify_user records each new subscription product as a row in
+notification_events instead of emailing it. send_digests, run periodically
+(e.g. by the notify worker), then sends each user one email per subscription
+listing every product recorded since their oldest pending event became
+digest_window old. One-time processing requests are still emailed right away.
+Requires:
+
+    CREATE TABLE notification_events (
+        id serial PRIMARY KEY,
+        local_queue_id integer,
+        user_id integer NOT NULL,
+        sub_id integer NOT NULL,
+        product_url text NOT NULL,
+        filename text,
+        created timestamp NOT NULL DEFAULT current_timestamp
+    );
+    CREATE INDEX notification_events_sub_idx ON notification_events (user_id, sub_id);
+"""
+
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import collections
+
+from hyp3proclib.config import get_config
+from hyp3proclib.db import get_db_connection, query_database, transaction
+from hyp3proclib.emailer import (
+    disable_subscription_url, get_email_footer, get_email_header, get_notification_info, queue_email, urlify, usr
+)
+from hyp3proclib.logger import log
+
+
+def record_notification_event(conn, cfg, product_url):
+    """Record the job's new product for the next digest"""
+    log.info('Recording product for the digest of subscription {0}'.format(cfg['sub_id']))
+    query_database(
+        conn,
+        '''
+            insert into notification_events (local_queue_id, user_id, sub_id, product_url, filename)
+            values (%(id)s, %(user_id)s, %(sub_id)s, %(product_url)s, %(filename)s)
+        ''',
+        {
+            'id': cfg['id'],
+            'user_id': cfg['user_id'],
+            'sub_id': cfg['sub_id'],
+            'product_url': product_url,
+            'filename': cfg.get('filename'),
+        },
+        commit=True,
+    )
+
+
+def take_due_events(conn, window):
+    """Remove and return the events of every subscription with one older than window seconds
+
+    Returns {(user_id, sub_id): [(local_queue_id, product_url, filename), ...]}
+    with each list oldest first.
+    """
+    recs = query_database(
+        conn,
+        '''
+            delete from notification_events
+            where (user_id, sub_id) in (
+                select user_id, sub_id from notification_events
+                group by user_id, sub_id
+                having min(created) <= current_timestamp - %(window)s * interval '1 second'
+            )
+            returning user_id, sub_id, local_queue_id, product_url, filename, created
+        ''',
+        {'window': window},
+        commit=True,
+        returning=True,
+    )
+
+    events = collections.OrderedDict()
+    for user_id, sub_id, lqid, product_url, filename, created in sorted(recs, key=lambda r: (r[0], r[1], r[5])):
+        events.setdefault((user_id, sub_id), []).append((lqid, product_url, filename))
+    return events
+
+
+def send_digest(cfg, conn, user_id, sub_id, products):
+    """Queue one email listing products, a list of (local_queue_id, product_url, filename)
+
+    Returns False, without queueing anything, if the user or subscription no
+    longer exists.
+    """
+    job = {'user_id': user_id, 'sub_id': sub_id}
+    info = get_notification_info(job, conn, by_subscription=True)
+    if info is None:
+        log.warning('Dropping digest of {0} product(s): user {1} has no subscription {2}'.format(
+            len(products), user_id, sub_id))
+        return False
+
+    username, email, wants_email, subscription_name, process_name, id_, hashval = info
+
+    title = "{0} new '{1}' product(s) for your subscription '{2}' are ready.".format(
+        len(products), process_name, subscription_name)
+    subject = "[{0}] {1} new product(s) for subscription '{2}'".format(
+        cfg['subject_prefix'], len(products), subscription_name)
+
+    message = [get_email_header(title), "<p>Hello HyP3-User!", "<p>" + title + "\n", "<p>"]
+    for _, product_url, filename in products:
+        if filename:
+            message.append('<a href="{0}">{1}</a><br>\n'.format(product_url, filename))
+        else:
+            message.append(urlify(product_url) + "<br>\n")
+
+    message.append("<p>You can find all of your products at the HyP3 website:<br>{0}/products<br>\n".format(
+        cfg['hyp3_product_url']))
+    message.append("<p>Done with this subscription?  Disable it with this link:<br>" +
+                   disable_subscription_url(id_, hashval) + "<br><br>\n")
+    message.append(get_email_footer())
+    message = usr(''.join(message), username)
+
+    if wants_email:
+        log.info('Emailing digest of {0} product(s) to {1}'.format(len(products), email))
+        queue_email(conn, None, email, subject, message)
+    else:
+        log.info("Email will not be sent to user {0} due to user preference".format(username))
+
+        bcc = get_config('general', 'bcc', default='')
+        if len(bcc) > 0:
+            # We only have to do the first one, the rest will be bcc'ed :)
+            queue_email(conn, None, bcc.split(',')[0], subject, message)
+
+    return True
+
+
+def send_digests(cfg, window=None):
+    """Queue the digest emails that are due; returns how many subscriptions were digested"""
+    if window is None:
+        window = cfg['digest_window']
+
+    sent = 0
+    with get_db_connection('hyp3-db') as conn, transaction(conn):
+        events = take_due_events(conn, window)
+        for (user_id, sub_id), products in events.items():
+            if send_digest(cfg, conn, user_id, sub_id, products):
+                sent += 1
+
+    if not events:
+        log.info('No notification digests are due')
+
+    return sent
@@ -0,0 +1,317 @@
+"""Module for proc_lib queued email delivery
+
+EmailDispatcher drains email_queue rows over a small pool of persistent SMTP
+sessions, sending from email_workers threads at no more than email_rate
+messages a second, and writes the resulting statuses back email_batch_size
+rows per UPDATE. All of these are read from the [general] section of proc.cfg
+along with smtp_host and smtp_port.
+
+Several senders can drain the queue at once: each claims a batch of QUEUED
+rows (skipping rows locked by the others) into SENDING with a lease of
+email_lease_seconds, and SENDING rows whose lease ran out, left by a sender
+that died, are returned to QUEUED by reclaim_stale_emails. Requires:
+
+    ALTER TABLE email_queue ADD COLUMN lease_expires timestamp;
+    CREATE INDEX email_queue_status_idx ON email_queue (status, id);
+"""
+
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import collections
+import smtplib
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+from six.moves import queue
+
+from hyp3proclib.config import get_config
+from hyp3proclib.db import query_database
+from hyp3proclib.logger import log
+
+
+def is_connection_error(e):
+    """Whether e means the SMTP session is gone (smtplib errors are socket errors too)"""
+    return isinstance(e, smtplib.SMTPServerDisconnected) or not isinstance(e, smtplib.SMTPException)
+
+
+def build_message(from_address, to_address, subject, body):
+    """Return the MIME text of a HyP3 notification email with an HTML body"""
+    msg = MIMEMultipart('related')
+    msg["Subject"] = subject
+    msg["From"] = from_address
+    msg["To"] = to_address
+    msg.preamble = 'This is a multi-part message in MIME format.'
+
+    msgAlt = MIMEMultipart('alternative')
+    msg.attach(msgAlt)
+
+    msgText = MIMEText('HyP3 product notification email')
+    msgAlt.attach(msgText)
+
+    msgText = MIMEText(body)
+    msgText.replace_header('Content-Type', 'text/html')
+    msgAlt.attach(msgText)
+
+    return msg.as_string()
+
+
+def get_bcc_addresses():
+    bcc = get_config('general', 'bcc', default='')
+    return bcc.split(',') if len(bcc) > 0 else []
+
+
+def claim_emails(conn, batch_size, lease_seconds):
+    """Claim up to batch_size QUEUED emails into SENDING, for lease_seconds.
+
+    Rows another sender has locked are skipped, not waited for. Returns the
+    claimed (id, local_queue_id, recipients, subject, message) rows.
+    """
+    return query_database(
+        conn,
+        '''
+            update email_queue e
+                set status = 'SENDING', lease_expires = current_timestamp + %(lease)s * interval '1 second'
+            from (
+                select id from email_queue where status = 'QUEUED'
+                order by id limit %(limit)s
+                for update skip locked
+            ) c
+            where e.id = c.id
+            returning e.id, e.local_queue_id, e.recipients, e.subject, e.message
+        ''',
+        {'lease': lease_seconds, 'limit': batch_size},
+        commit=True,
+        returning=True,
+    )
+
+
+def reclaim_stale_emails(conn):
+    """Return SENDING emails with an expired lease to QUEUED; returns their ids"""
+    recs = query_database(
+        conn,
+        '''
+            update email_queue set status = 'QUEUED', lease_expires = null
+            where status = 'SENDING' and lease_expires < current_timestamp
+            returning id
+        ''',
+        commit=True,
+        returning=True,
+    )
+    ids = [int(r[0]) for r in recs]
+
+    if ids:
+        log.info('Returned {0} email(s) with expired leases to QUEUED: {1}'.format(len(ids), ids))
+
+    return ids
+
+
+def update_email_statuses(conn, statuses):
+    """Write (id, status, system_message) tuples to email_queue in one statement"""
+    if not statuses:
+        return 0
+
+    values = ', '.join(['(%s, %s, %s)'] * len(statuses))
+    sql = '''
+        update email_queue e
+            set status = v.status, system_message = v.msg, processed_time = current_timestamp,
+                lease_expires = null
+        from (values {0}) as v(id, status, msg)
+        where e.id = v.id
+    '''.format(values)
+    params = [v for status in statuses for v in status]
+    return query_database(conn, sql, params, commit=True)
+
+
+class RateLimiter(object):
+    """Spaces out callers of wait() to at most rate per second (no limit if rate <= 0)"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.next_time = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if self.interval <= 0:
+            return
+        with self.lock:
+            now = time.time()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class SMTPSessionPool(object):
+    """Persistent SMTP sessions, opened on demand and reused between messages"""
+
+    def __init__(self, host='localhost', port=0, timeout=60):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.idle = queue.LifoQueue()
+
+    def _connect(self):
+        log.debug('Opening SMTP session to %s:%s', self.host, self.port)
+        return smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+
+    def sendmail(self, from_address, to_addresses, message):
+        """Send message on an idle session, reconnecting once if the session was dropped"""
+        try:
+            smtp = self.idle.get_nowait()
+        except queue.Empty:
+            smtp = self._connect()
+
+        try:
+            try:
+                smtp.sendmail(from_address, to_addresses, message)
+            except socket.error as e:
+                if not is_connection_error(e):
+                    raise
+                log.info('SMTP session lost ({0}); reconnecting'.format(e))
+                self._discard(smtp)
+                smtp = self._connect()
+                smtp.sendmail(from_address, to_addresses, message)
+        except socket.error as e:
+            if is_connection_error(e):
+                self._discard(smtp)
+                raise
+            # The message was refused; reset the session so it can be reused
+            try:
+                smtp.rset()
+            except socket.error:
+                self._discard(smtp)
+                raise e
+            self.idle.put(smtp)
+            raise
+
+        self.idle.put(smtp)
+
+    @staticmethod
+    def _discard(smtp):
+        try:
+            smtp.close()
+        except Exception:
+            pass
+
+    def close(self):
+        while True:
+            try:
+                smtp = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                smtp.quit()
+            except Exception:
+                self._discard(smtp)
+
+
+class EmailDispatcher(object):
+    def __init__(self, from_address="no-reply@asf-hyp3", workers=None, rate=None, batch_size=None,
+                 lease_seconds=None):
+        if workers is None:
+            workers = int(get_config('general', 'email_workers', '4'))
+        if rate is None:
+            rate = float(get_config('general', 'email_rate', '0'))
+        if batch_size is None:
+            batch_size = int(get_config('general', 'email_batch_size', '100'))
+        if lease_seconds is None:
+            lease_seconds = int(get_config('general', 'email_lease_seconds', '600'))
+
+        self.from_address = from_address
+        self.workers = max(1, workers)
+        self.batch_size = max(1, batch_size)
+        self.lease_seconds = lease_seconds
+        self.bcc_addresses = get_bcc_addresses()
+        self.rate_limiter = RateLimiter(rate)
+        self.smtp = SMTPSessionPool(
+            get_config('general', 'smtp_host', 'localhost'), int(get_config('general', 'smtp_port', '25'))
+        )
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+
+    def send(self, to_address, subject, body):
+        """Send one email; returns (ok, error message) like hyp3proclib.emailer.send_email"""
+        message = build_message(self.from_address, to_address, subject, body)
+
+        self.rate_limiter.wait()
+        log.debug('Sending email from %s to %s', self.from_address, to_address)
+        try:
+            self.smtp.sendmail(self.from_address, [to_address] + self.bcc_addresses, message)
+        except socket.error as e:
+            msg = str(e)
+            log.error('Failed to notify user: %s', msg)
+            return False, msg
+
+        return True, None
+
+    def dispatch(self, conn, rows):
+        """Send the (id, local_queue_id, recipients, subject, message) email_queue rows
+
+        Rows are read lazily, so rows can be a stream_query generator. Their
+        statuses are written on conn in batches. Returns the number of rows.
+        """
+        pending = collections.deque()
+        statuses = []
+        count = 0
+
+        def add_status(status):
+            statuses.append(status)
+            if len(statuses) >= self.batch_size:
+                self._flush(conn, statuses)
+
+        def finish_oldest():
+            id_, future = pending.popleft()
+            ok, msg = future.result()
+            add_status((id_, 'SENT' if ok else 'FAILED', msg))
+
+        for r in rows:
+            count += 1
+            if not (r and r[0]):
+                continue
+            if not (r[2] and len(r[2]) > 0):
+                add_status((int(r[0]), 'FAILED', 'No recipients'))
+                continue
+
+            id_ = int(r[0])
+            lqid = int(r[1]) if r[1] is not None else None
+            log.info('Emailing %s for lqid: %s', r[2], lqid)
+            log.debug('Subject: %s', r[3])
+
+            pending.append((id_, self.executor.submit(self.send, r[2], r[3], r[4])))
+            # Keep only a few messages in flight so rows are read as we go
+            if len(pending) >= 2 * self.workers:
+                finish_oldest()
+
+        while pending:
+            finish_oldest()
+        self._flush(conn, statuses)
+
+        return count
+
+    def drain(self, conn):
+        """Claim and send batches of QUEUED emails until there are none; returns how many were sent"""
+        reclaim_stale_emails(conn)
+
+        count = 0
+        while True:
+            rows = claim_emails(conn, self.batch_size, self.lease_seconds)
+            if not rows:
+                break
+            log.debug('Claimed %s email(s)', len(rows))
+            count += self.dispatch(conn, rows)
+
+        return count
+
+    @staticmethod
+    def _flush(conn, statuses):
+        if statuses:
+            log.debug('Updating status of %s email(s)', len(statuses))
+            update_email_statuses(conn, statuses)
+            del statuses[:]
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.smtp.close()
@@ -12,12 +12,11 @@ except ImportError:
     # python 2 w/o futures
     from cgi import escape
 
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-
 from hyp3proclib.config import get_config
-from hyp3proclib.db import get_db_connection, get_user_info, query_database
+from hyp3proclib.db import get_db_connection, query_database
+from hyp3proclib.email_dispatch import EmailDispatcher, build_message, get_bcc_addresses
 from hyp3proclib.logger import log
+from hyp3proclib.queries import execute_query
 
 
 def queue_email(conn, lqid, to_address, subject, body):
@@ -38,42 +37,14 @@ def queue_email(conn, lqid, to_address, subject, body):
 
 def send_queued_emails():
     with get_db_connection('hyp3-db') as conn:
-        sql = '''
-            select id, local_queue_id, recipients, subject, message, attachment_filename, attachment, mime_type
-            from email_queue where status = 'QUEUED'
-        '''
-        recs = query_database(conn, sql)
-        if len(recs) == 0:
-            log.info('No emails to send')
-
-        for r in recs:
-            if r and r[0] and r[2] and len(r[2]) > 0:
-                id_ = int(r[0])
-                lqid = None
-                if r[1] is not None:
-                    lqid = int(r[1])
-                to = r[2]
-                subject = r[3]
-                body = r[4]
-
-                mime_type = "plain"
-                if r[7] is not None:
-                    mime_type = r[7]
-                if mime_type == "text":
-                    mime_type = "plain"
+        dispatcher = EmailDispatcher()
+        try:
+            count = dispatcher.drain(conn)
+        finally:
+            dispatcher.close()
 
-                log.info('Emailing ' + to + ' for lqid: ' + str(lqid))
-                log.debug('Subject: ' + subject)
-
-                ok, msg = send_email(to, subject, body, mime_type=mime_type)
-                if ok:
-                    status = 'SENT'
-                else:
-                    status = 'FAILED'
-
-                log.debug('Updating status to ' + status)
-                sql = "update email_queue set status = %(status)s, system_message = %(msg)s, processed_time = current_timestamp where id = %(id)s"
-                query_database(conn, sql, {'status': status, 'msg': msg, 'id': id_}, commit=True)
+        if count == 0:
+            log.info('No emails to send')
 
 
 def send_email(
@@ -97,32 +68,16 @@ def send_email(
 
     smtp = smtplib.SMTP("localhost")
 
-    msg = MIMEMultipart('related')
-    msg["Subject"] = subject
-    msg["From"] = from_address
-    msg["To"] = to_address
-    msg.preamble = 'This is a multi-part message in MIME format.'
-
-    msgAlt = MIMEMultipart('alternative')
-    msg.attach(msgAlt)
-
-    msgText = MIMEText('HyP3 product notification email')
-    msgAlt.attach(msgText)
-
-    msgText = MIMEText(body)
-    msgText.replace_header('Content-Type', 'text/html')
-    msgAlt.attach(msgText)
+    message = build_message(from_address, to_address, subject, body)
 
     log.debug("Sending email from {0} to {1}".format(from_address, to_address))
 
-    bcc_address = []
-    bcc = get_config('general', 'bcc', default='')
-    if len(bcc) > 0:
-        bcc_address += bcc.split(',')
+    bcc_address = get_bcc_addresses()
+    if bcc_address:
         log.debug("Bcc: " + str(bcc_address))
 
     try:
-        smtp.sendmail(from_address, [to_address] + bcc_address, msg.as_string())
+        smtp.sendmail(from_address, [to_address] + bcc_address, message)
     except smtplib.SMTPException as e:
         msg = str(e)
         log.error("Failed to notify user: " + msg)
@@ -138,6 +93,42 @@ def send_email(
     return True, None
 
 
+def get_notification_info(cfg, conn, only_if_wants_email=False, by_subscription=False):
+    """Look up the job's user and get its disable subscription link in one query.
+
+    Returns (username, email, wants_email, subscription_name, process_name,
+    hash id, hash); the one-time hash (see create_one_time_hash) is only made
+    for subscription jobs, and with only_if_wants_email only for users who
+    want email, otherwise its id and hash are None.
+
+    With by_subscription, the user and subscription are looked up by
+    cfg['user_id'] and cfg['sub_id'] rather than the job's cfg['id'], and None
+    is returned if they no longer exist.
+    """
+    recs = execute_query(
+        conn,
+        'subscription_notification_info' if by_subscription else 'notification_info',
+        {
+            'id': cfg.get('id'),
+            'user_id': cfg['user_id'],
+            'want_hash': cfg['sub_id'] > 0,
+            'only_if_wants_email': only_if_wants_email,
+            'action': 'disable_subscription',
+            'params': str(cfg['sub_id']),
+            'hashval': uuid.uuid4().hex,
+        },
+        commit=True,
+        returning=True,
+    )
+    if by_subscription and not recs:
+        return None
+    return recs[0]
+
+
+def disable_subscription_url(id_, hashval):
+    return "https://api.hyp3.asf.alaska.edu/onetime/disable_subscription?id={0}&key={1}".format(id_, hashval)
+
+
 def notify_user_failure(cfg, conn, msg):
     if cfg['notify_fail'] is False:
         log.info('Notifications for failures not turned on.')
@@ -145,42 +136,40 @@ def notify_user_failure(cfg, conn, msg):
 
     log.debug('Preparing to notify user of processing failure')
 
-    username, email, wants_email, subscription_name, process_name = get_user_info(cfg, conn)
+    username, email, wants_email, subscription_name, process_name, id_, hashval = \
+        get_notification_info(cfg, conn, only_if_wants_email=True)
 
     if wants_email:
         log.debug('Notifying {0}...'.format(username))
-        message = "Hi, {0}\n\n".format(username)
+        message = ["Hi, {0}\n\n".format(username)]
 
         if cfg['sub_id'] > 0:
-            message += "Your subscription '{0}' attempted to process a product but failed.\n\n".format(subscription_name)
+            message.append("Your subscription '{0}' attempted to process a product but failed.\n\n".format(subscription_name))
             subject = "[{0}] Failed processing for subscription '{1}'".format(cfg['subject_prefix'], subscription_name)
         else:
-            message += "Your one-time '{0}' processing request failed.\n\n".format(process_name)
+            message.append("Your one-time '{0}' processing request failed.\n\n".format(process_name))
             subject = "[{0}] Failed one-time processing for '{1}'".format(cfg['subject_prefix'], process_name)
 
         # if len(msg.strip())>0:
         #    message += "\n" + "Captured error message:\n" + msg + "\n\n"
 
         if 'granule_url' in cfg and len(cfg['granule_url']) > 0:
-            message += "You can download the original data here:<br>" + cfg['granule_url'] + "<br>"
+            message.append("You can download the original data here:<br>" + cfg['granule_url'] + "<br>")
             if cfg['other_granule_urls'] is not None:
                 for url in cfg['other_granule_urls']:
-                    message += url + "<br>"
+                    message.append(url + "<br>")
 
         if "email_text" in cfg and len(cfg["email_text"]) > 0:
-            message += "\n" + cfg["email_text"] + "\n\n"
+            message.append("\n" + cfg["email_text"] + "\n\n")
         else:
-            message += "\n"
+            message.append("\n")
 
         if cfg['sub_id'] > 0:
-            param = str(cfg['sub_id'])
-            id_, hashval = create_one_time_hash(conn, 'disable_subscription', cfg['user_id'], param)
-            message += "Disable this subscription:\n" \
-                "https://api.hyp3.asf.alaska.edu/onetime/disable_subscription?id="+str(id_)+"&key="+hashval+"\n\n"
+            message.append("Disable this subscription:\n" + disable_subscription_url(id_, hashval) + "\n\n")
 
         # message += "Captured processing info:\n\n" + cfg['log']
 
-        queue_email(conn, cfg['id'], email, subject, message)
+        queue_email(conn, cfg['id'], email, subject, ''.join(message))
     else:
         log.info("Email will not be sent to user {0} due to user preference".format(username))
 
@@ -196,8 +185,16 @@ def notify_user(product_url, queue_id, cfg, conn):
     granule.
 
     This function return True upon success and False upon failure.
+
+    With digest_window set, subscription products are recorded for the next
+    digest email instead (see hyp3proclib.digest).
     """
-    username, email, wants_email, subscription_name, process_name = get_user_info(cfg, conn)
+    if cfg.get('digest_window', 0) > 0 and cfg['sub_id'] > 0:
+        from hyp3proclib.digest import record_notification_event
+        record_notification_event(conn, cfg, product_url)
+        return
+
+    username, email, wants_email, subscription_name, process_name, id_, hashval = get_notification_info(cfg, conn)
 
     if cfg['sub_id'] > 0:
         title = "A new '{0}' product for your subscription '{1}' is ready.".format(process_name, subscription_name)
@@ -206,51 +203,51 @@ def notify_user(product_url, queue_id, cfg, conn):
         title = "A new product for your '{0}' one-time processing request has been generated.".format(process_name)
         subject = "[{0}] New {1} product available".format(cfg['subject_prefix'], process_name)
 
-    message = get_email_header(title)
+    message = [get_email_header(title)]
 
-    message += "<p>Hello HyP3-User!"
-    message += "<p>" + title + "\n"
+    message.append("<p>Hello HyP3-User!")
+    message.append("<p>" + title + "\n")
 
     if 'description' in cfg and cfg['description'] and len(cfg['description']) > 0:
-        message += "<p>" + escape(cfg['description'], quote=False).replace('\n', '<br>') + "<br>\n"
+        message.append("<p>" + escape(cfg['description'], quote=False).replace('\n', '<br>') + "<br>\n")
 
     if process_name != "Notify Only":
-        message += '<p>You can download it here:<br><a href="{0}">{1}</a><br><br>\n'.format(product_url, cfg['filename'])
+        message.append('<p>You can download it here:<br><a href="{0}">{1}</a><br><br>\n'.format(product_url, cfg['filename']))
 
         if 'browse_url' in cfg and cfg['browse_url'] is not None and len(cfg['browse_url']) > 0:
-            message += '<center><a href="{0}"><img src="{1}" width="80%" border="0"/></a></center><br>\n'.format(cfg['browse_url'], cfg['browse_url'])
+            message.append('<center><a href="{0}"><img src="{1}" width="80%" border="0"/></a></center><br>\n'.format(
+                cfg['browse_url'], cfg.get('email_browse_url') or cfg['browse_url']))
 
         if 'final_product_size' in cfg:
             sz = cfg['final_product_size'][0]
             mb = float(sz)/1024.0/1024.0
-            message += "<p>Size: %.2f MB<br><br>\n" % mb
+            message.append("<p>Size: %.2f MB<br><br>\n" % mb)
 
-        message += "You can find all of your products at the HyP3 website:<br>{0}/products<br>\n".format(cfg['hyp3_product_url'])
+        message.append("You can find all of your products at the HyP3 website:<br>{0}/products<br>\n".format(cfg['hyp3_product_url']))
 
         if 'granule_url' in cfg and len(str(cfg['granule_url'])) > 0 and 'Subscription: ' not in str(cfg['granule_url']):
-            message += "<p>You can download the original data from the ASF datapool here:<br>" + urlify(cfg['granule_url']) + "<br>\n"
+            message.append("<p>You can download the original data from the ASF datapool here:<br>" + urlify(cfg['granule_url']) + "<br>\n")
             if 'other_granule_urls' in cfg and cfg['other_granule_urls'] is not None:
                 for url in cfg['other_granule_urls']:
-                    message += urlify(url) + "<br>\n"
+                    message.append(urlify(url) + "<br>\n")
 
         if 'SLC' in cfg['granule']:
-            message += '<p>View this stack in the ASF baseline tool:<br>'
-            message += 'http://baseline.asf.alaska.edu/#baseline?granule={0}\n'.format(cfg['granule'])
+            message.append('<p>View this stack in the ASF baseline tool:<br>')
+            message.append('http://baseline.asf.alaska.edu/#baseline?granule={0}\n'.format(cfg['granule']))
     else:
-        message += "<p>You can download it here:<br>" + urlify(product_url) + "<br>"
+        message.append("<p>You can download it here:<br>" + urlify(product_url) + "<br>")
 
     if "email_text" in cfg and len(cfg["email_text"]) > 0:
-        message += "<p>" + cfg["email_text"] + "<br>"
+        message.append("<p>" + cfg["email_text"] + "<br>")
     if 'process_time' in cfg:
-        message += process_name + " processing time: " + str(datetime.timedelta(seconds=int(cfg['process_time']))) + "<br>\n"
+        message.append(process_name + " processing time: " + str(datetime.timedelta(seconds=int(cfg['process_time']))) + "<br>\n")
 
     if cfg['sub_id'] > 0:
-        param = str(cfg['sub_id'])
-        id_, hashval = create_one_time_hash(conn, 'disable_subscription', cfg['user_id'], param)
-        message += "<p>Done with this subscription?  Disable it with this link:<br>" \
-                   "https://api.hyp3.asf.alaska.edu/onetime/disable_subscription?id="+str(id_)+"&key="+hashval+"<br><br>\n"
+        message.append("<p>Done with this subscription?  Disable it with this link:<br>" +
+                       disable_subscription_url(id_, hashval) + "<br><br>\n")
 
-    message += get_email_footer()
+    message.append(get_email_footer())
+    message = ''.join(message)
 
     # message += "Hostname: " + socket.gethostname() + "\n"
     if wants_email:
@@ -305,15 +302,15 @@ def urlify(url):
     return '<a href="{0}">{1}</a>'.format(url, name)
 
 
-def get_email_header(title):
-    message = """
+# The static parts of the notification email, built once
+_email_header_top = """
         <!DOCTYPE html><html><head>
         <meta http-equiv="Content-Type" content="text/html;charset=utf-8" />
         <meta name="viewport" content="width=device-width,initial-scale=1.0"/>
         <title>{0}</title>
-    """.format(title)
+    """
 
-    message += """
+_email_header = """
         <style type="text/css">.ExternalClass {width:100%;}.ExternalClass,.ExternalClass p,.ExternalClass span,.ExternalClass font,.ExternalClass td,.ExternalClass div {line-height:100%;}table td {border-collapse:collapse;}.granule {display:inline;}.granule-small {display:none;}.granule-medium {display:none;}@media only screen and (max-width:750px) {.granule {display:none;}.granule-medium {display:inline;}.granule-small {display:none;}}@media only screen and (max-width:450px) {.granule {display:none;}.granule-medium {display:none;}.granule-small {display:inline;}}</style>
         </head>
         <body style="width:100% !important;-webkit-text-size-adjust:100%;-ms-text-size-adjust:100%;margin:0;padding:0;margin:0 auto">
@@ -342,11 +339,7 @@ def get_email_header(title):
               <table width="95%" style="border-collapse:collapse;mso-table-lspace:0pt;mso-table-rspace:0pt;" border="0" cellpadding="0" cellspacing="0" >
     """
 
-    return message
-
-
-def get_email_footer():
-    return """
+_email_footer = """
             </table>
             </center>
           </td>
@@ -376,3 +369,11 @@ def get_email_footer():
       </table><!-- End of wrapper table -->
       </body></html>
     """
+
+
+def get_email_header(title):
+    return _email_header_top.format(title) + _email_header
+
+
+def get_email_footer():
+    return _email_footer
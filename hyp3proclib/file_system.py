@@ -3,16 +3,20 @@
 from __future__ import print_function, absolute_import, division, unicode_literals
 
 import datetime
+import errno
+import fcntl
 import os
 import shutil
 import sys
+import time
 import uuid
 from contextlib import contextmanager
 
+from hyp3proclib.lease import stop_heartbeat
 from hyp3proclib.logger import log
 
 
-def setup_workdir(cfg):
+def setup_workdir(cfg, chdir=True):
     if cfg['user_workdir'] and len(cfg['workdir']) > 0:
         wd = cfg['workdir']
         log.info('Using previous working directory (will not process)')
@@ -36,7 +40,8 @@ def setup_workdir(cfg):
         os.mkdir(wd)
 
     # Some of the processes are location dependent!
-    os.chdir(wd)
+    if chdir:
+        os.chdir(wd)
 
 
 def random_string(string_length=4):
@@ -58,6 +63,7 @@ def cleanup_workdir(cfg):
 
 
 def cleanup_env(cfg):
+    stop_heartbeat(cfg)
     if 'browse_images' in cfg:
         del cfg['browse_images']
     cfg['browse_lat_min'] = None
@@ -65,9 +71,14 @@ def cleanup_env(cfg):
     cfg['browse_lon_min'] = None
     cfg['browse_lon_max'] = None
     cfg['browse_epsg'] = None
+    cfg.pop('email_browse', None)
+    cfg.pop('email_browse_url', None)
 
+    if hasattr(cfg, 'set_job'):
+        cfg.set_job(None)
     cfg['id'] = None
     cfg['granule'] = None
+    cfg['log'] = ''
 
     cfg['workdir'] = cfg['original_workdir']
 
@@ -79,42 +90,77 @@ def lockfile(cfg):
     cleanup_lockfile(cfg)
 
 
-def check_lockfile(cfg):
-    lock_file = os.path.join(cfg['lock_dir'], cfg['proc_name'] + '.lock')
-    cfg['lock_file'] = lock_file
+def slot_lock_file(cfg, slot):
+    # Slot 0 keeps the historical lock file name so existing tooling still finds it
+    if slot == 0:
+        name = cfg['proc_name'] + '.lock'
+    else:
+        name = '{0}.{1}.lock'.format(cfg['proc_name'], slot)
+    return os.path.join(cfg['lock_dir'], name)
+
 
-    if os.path.isfile(lock_file):
-        log.info('Lock file exists: ' + lock_file)
+def check_lockfile(cfg):
+    """Acquire one of the numbered lock slots for this process type.
+
+    Each slot is an flock on its own file in the lock directory, which the
+    kernel releases when the holding process dies, so a crashed worker no
+    longer blocks the node. Up to cfg['lock_slots'] workers of the same
+    process type may run at once.
+    """
+    slots = int(cfg.get('lock_slots', 1))
+
+    for slot in range(slots):
+        lock_file = slot_lock_file(cfg, slot)
+        fd = try_lock(lock_file)
+        if fd is not None:
+            break
+    else:
+        log.info('All {0} lock slot(s) for {1} are held'.format(slots, cfg['proc_name']))
         log.info('Exiting -- already running.')
         sys.exit(0)
 
-    # We use os.open with O_CREAT so that two ingests don't both do the
-    # above check, and pass, and then both try to create the lock file,
-    # and both succeed - this way one will fail
-    try:
-        o = os.open(lock_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL)
-        fd = os.fdopen(o, 'w')
-    except Exception as e:
-        log.warning('Failed to open lock file: ' + str(e))
-        fd = None
-
-    if not fd:
-        log.error('Could not open lock file: ' + lock_file)
-        sys.exit(1)
-
     pid = str(os.getpid())
-    fd.write(pid)
-    fd.close()
-
-    # Now check the file just in case...
-    with open(lock_file, 'r') as fd:
-        s = fd.read()
+    os.ftruncate(fd, 0)
+    os.write(fd, pid.encode('ascii'))
 
-    if s != pid:
-        log.error('Failed to correctly initialize lock file')
-        sys.exit(1)
-    else:
-        log.info('Acquired lock file, PID is ' + pid)
+    cfg['lock_file'] = lock_file
+    cfg['lock_fd'] = fd
+    cfg['lock_slot'] = slot
+    cfg['lock_time'] = time.time()
+    log.info('Acquired lock slot {0} ({1}), PID is {2}'.format(slot, lock_file, pid))
+
+
+def try_lock(lock_file):
+    """Return an fd holding an exclusive flock on lock_file, or None if it is taken"""
+    while True:
+        try:
+            fd = os.open(lock_file, os.O_RDWR | os.O_CREAT, 0o644)
+        except OSError as e:
+            log.warning('Failed to open lock file: ' + str(e))
+            return None
+
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError) as e:
+            os.close(fd)
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return None
+            raise
+
+        # The previous holder may have unlinked the file between our open and
+        # flock; only keep the lock if it is still the file on disk.
+        if is_same_file(fd, lock_file):
+            return fd
+        os.close(fd)
+
+
+def is_same_file(fd, path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return False
+    fst = os.fstat(fd)
+    return st.st_ino == fst.st_ino and st.st_dev == fst.st_dev
 
 
 def cleanup_lockfile(cfg):
@@ -128,48 +174,70 @@ def cleanup_lockfile(cfg):
         log.info('Internal error: no lock file set.')
         return
 
-    if os.path.isfile(lock_file):
-        log.info('Removing lock file ' + lock_file)
-        os.unlink(lock_file)
+    fd = cfg.get('lock_fd')
+    if fd is None or is_same_file(fd, lock_file):
+        if os.path.isfile(lock_file):
+            log.info('Removing lock file ' + lock_file)
+            os.unlink(lock_file)
+        else:
+            log.warn('Lock file not found: ' + lock_file)
     else:
-        log.warn('Lock file not found: ' + lock_file)
+        log.warn('Lock file no longer belongs to this process: ' + lock_file)
+
+    # Unlink before closing so a worker waiting on the old file can't keep a
+    # lock on an orphaned inode (see try_lock)
+    if fd is not None:
+        os.close(fd)
+        cfg['lock_fd'] = None
 
 
 def check_stop(cfg):
-    check_lockfile_exists(cfg['lock_file'])
+    check_lockfile_held(cfg)
 
     stopfile = os.path.join(os.path.dirname(cfg['lock_file']), 'stop')
     check_stopfile(cfg, stopfile)
 
-    check_lockfile_pid(cfg['lock_file'])
 
+def check_lockfile_held(cfg):
+    """Exit if our lock file was removed or replaced out from under us.
+
+    A single stat compared against the held fd; no need to reread the PID.
+    """
+    lock_file = cfg['lock_file']
+    fd = cfg.get('lock_fd')
 
-def check_lockfile_exists(lock_file):
     if not os.path.isfile(lock_file):
         log.info('Lock file does not exist')
         log.info('Stopping')
+        if fd is not None:
+            os.close(fd)
+            cfg['lock_fd'] = None
+        sys.exit(0)
+
+    if fd is not None and not is_same_file(fd, lock_file):
+        log.info('Lock file no longer belongs to this process: ' + lock_file)
+        log.info('Exiting without cleaning')
         sys.exit(0)
 
 
 def check_stopfile(cfg, stopfile):
-    if os.path.isfile(stopfile):
-        log.info('Found stopfile: ' + stopfile)
-        log.debug('Removing stopfile: ' + stopfile)
-        os.remove(stopfile)
-        log.info('Stopping')
-        cleanup_lockfile(cfg)
-        sys.exit(0)
+    """Stop if the stop file was touched after this worker took its lock.
 
+    The file is left in place so every worker sharing the lock directory sees
+    it; workers started afterwards ignore it.
+    """
+    try:
+        mtime = os.stat(stopfile).st_mtime
+    except OSError:
+        return
 
-def check_lockfile_pid(lock_file):
-    pid = str(os.getpid())
-    with open(lock_file, 'r') as lock:
-        lock_file_pid = lock.read()
-        if str(lock_file_pid) != str(pid):
-            log.info('Lock file does not contain process PID')
-            log.info('Process PID: "{}"   File PID: "{}"'.format(pid, lock_file_pid))
-            log.info('Exiting without cleaning')
-            sys.exit(0)
+    if mtime < cfg.get('lock_time', 0):
+        return
+
+    log.info('Found stopfile: ' + stopfile)
+    log.info('Stopping')
+    cleanup_lockfile(cfg)
+    sys.exit(0)
 
 
 def add_citation(cfg, dir_):
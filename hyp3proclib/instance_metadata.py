@@ -0,0 +1,117 @@
+"""Module for proc_lib EC2 instance metadata (IMDS) functions"""
+
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import socket
+import time
+
+from hyp3proclib.config import get_config
+from hyp3proclib.logger import log
+
+# 169.254.169.254 is EC2 metadata endpoint
+# https://docs.aws.amazon.com/AWSEC2/latest/UserGuide/ec2-instance-metadata.html
+default_metadata_url = 'http://169.254.169.254/latest'
+
+# Instance identity, once looked up, is fixed for the life of the process; see get_instance_identity
+_identity = None
+
+
+class MetadataClient(object):
+    """Minimal IMDSv2 client with short timeouts and retries.
+
+    The session token is requested once and reused until shortly before it
+    expires, so repeated lookups cost a single GET each.
+    """
+    token_ttl = 21600
+
+    def __init__(self, base_url=None, timeout=(1, 2), retries=3):
+        self.base_url = (base_url or default_metadata_url).rstrip('/')
+        self.timeout = timeout
+        self.retries = retries
+        self._token = None
+        self._token_expires = 0
+
+    def _get_token(self):
+        import requests
+
+        now = time.time()
+        if self._token is None or now >= self._token_expires:
+            r = requests.put(
+                self.base_url + '/api/token',
+                headers={'X-aws-ec2-metadata-token-ttl-seconds': str(self.token_ttl)},
+                timeout=self.timeout,
+            )
+            r.raise_for_status()
+            self._token = r.text
+            self._token_expires = now + self.token_ttl - 60
+        return self._token
+
+    def get(self, path):
+        """Return the metadata at path, or None if the service doesn't have it (404)"""
+        import requests
+
+        error = None
+        for attempt in range(self.retries):
+            if attempt > 0:
+                time.sleep(0.1 * 2 ** attempt)
+            try:
+                r = requests.get(
+                    self.base_url + '/' + path.lstrip('/'),
+                    headers={'X-aws-ec2-metadata-token': self._get_token()},
+                    timeout=self.timeout,
+                )
+            except requests.RequestException as e:
+                error = e
+                continue
+
+            if r.status_code == 401:
+                # Token expired or was revoked
+                self._token = None
+                error = Exception('Instance metadata token rejected')
+                continue
+            if r.status_code == 404:
+                return None
+            if r.status_code != 200:
+                error = Exception('Instance metadata returned HTTP {0} for {1}'.format(r.status_code, path))
+                continue
+            return r.text
+
+        raise Exception('Could not get instance metadata {0}: {1}'.format(path, error))
+
+
+def get_instance_identity(client=None, node_type=None):
+    """Return a dict with the instance_id and instance_type of this node.
+
+    Looked up from the metadata service once per process. Nodes whose
+    node_type (proc_node_type in the [general] section of proc.cfg) isn't
+    CLOUD get their hostname and an instance_type of 'on-prem' if the lookup
+    fails; on CLOUD nodes the error is raised, and the next call tries again.
+    """
+    global _identity
+    if _identity is not None:
+        return _identity
+
+    if client is None:
+        client = MetadataClient()
+    if node_type is None:
+        node_type = get_config('general', 'proc_node_type', '')
+
+    try:
+        instance_id = client.get('meta-data/instance-id')
+        instance_type = client.get('meta-data/instance-type')
+    except Exception as e:
+        if node_type == 'CLOUD':
+            raise
+        log.warning('Instance metadata not available, using hostname: %s', e)
+        instance_id = None
+        instance_type = None
+
+    if instance_id is None:
+        if node_type == 'CLOUD':
+            raise Exception('Instance metadata has no instance-id')
+        identity = {'instance_id': socket.gethostname(), 'instance_type': 'on-prem'}
+    else:
+        _identity = identity = {'instance_id': instance_id, 'instance_type': instance_type}
+
+    log.debug('Instance identity: %s', identity)
+    return identity
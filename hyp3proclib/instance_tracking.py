@@ -5,11 +5,11 @@ from __future__ import print_function, absolute_import, division, unicode_litera
 import socket
 from contextlib import contextmanager
 
-import requests
-
-from hyp3proclib.db import get_db_connection, query_database
+from hyp3proclib.db import get_db_connection, query_database, transaction
 from hyp3proclib.file_system import lockfile
+from hyp3proclib.instance_metadata import get_instance_identity
 from hyp3proclib.logger import log
+from hyp3proclib.queries import execute_query
 
 
 @contextmanager
@@ -96,12 +96,8 @@ def add_instance_record(cfg, conn):
     cfg['instance_record'] = instance_record
 
     try:
-        instance_record_sql = '''
-            insert into instance_records (instance_id, local_queue_id, start_time, instance_type)
-            values (%(instance_id)s, %(local_queue_id)s, current_timestamp, %(instance_type)s)
-        '''
-        query_database(conn=conn, query=instance_record_sql,
-                       params=instance_record, commit=True)
+        with transaction(conn):
+            execute_query(conn, 'instance_record_insert', instance_record, commit=True)
 
     except Exception:
         log.exception("Instance record could not be inserted")
@@ -114,9 +110,8 @@ def update_instance_record(cfg, conn):
     if 'instance_record' in cfg:
         instance_record = cfg['instance_record']
         try:
-            instance_record_sql = 'update instance_records set end_time=current_timestamp where (instance_id=%(instance_id)s and local_queue_id=%(local_queue_id)s);'
-            query_database(conn=conn, query=instance_record_sql,
-                           params=instance_record, commit=True)
+            with transaction(conn):
+                execute_query(conn, 'instance_record_end', instance_record, commit=True)
         except Exception:
             log.exception("Instance record for instance %s and job %s could not be updated with job completion time",
                           instance_record['instance_id'],
@@ -130,14 +125,8 @@ def update_instance_record(cfg, conn):
 
 
 def get_instance_id():
-    # 169.254.169.254 is EC2 metadata endpoint
-    # https://docs.aws.amazon.com/AWSEC2/latest/UserGuide/ec2-instance-metadata.html
-    return (requests.get('http://169.254.169.254/latest/meta-data/instance-id').text)
+    return get_instance_identity()['instance_id']
 
 
 def get_instance_type():
-    # 169.254.169.254 is EC2 metadata endpoint
-    # https://docs.aws.amazon.com/AWSEC2/latest/UserGuide/ec2-instance-metadata.html
-    return (requests.get('http://169.254.169.254/latest/meta-data/instance-type').text)
-
-
+    return get_instance_identity()['instance_type']
@@ -0,0 +1,152 @@
+"""Module for proc_lib queue job records"""
+
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import json
+
+from hyp3proclib.logger import set_log_context
+
+# Columns selected by get_queue_item, in the order JobRecord.from_row expects
+job_columns = '''
+    lq.granule, lq.granule_url, lq.other_granules, lq.other_granule_urls, lq.id,
+    s.priority as sub_priority, u.priority as user_priority, lq.priority as item_priority,
+    s.name as sub_name, s.id, u.username, u.id, p.name, p.suffix, p.id,
+    st_ymin(s.location) as min_lat, st_ymax(s.location) as max_lat,
+    st_xmin(s.location) as min_lon, st_xmax(s.location) as max_lon,
+    s.crop_to_selection, s.project_id, s.description,
+    round((EXTRACT(EPOCH FROM current_timestamp) - EXTRACT(EPOCH FROM request_time))/3600) as age_hours,
+    lq.extra_arguments, lq.attempts
+'''
+
+
+def _split(s):
+    return s.split(',') if (s is not None and len(s) > 0) else None
+
+
+class JobRecord(object):
+    """A local_queue job, built straight from a get_queue_item row.
+
+    The comma separated granule lists and the extra_arguments JSON are only
+    parsed when first used.
+    """
+    __slots__ = (
+        'granule', 'granule_url', 'id', 'sub_priority', 'user_priority', 'item_priority',
+        'sub_name', 'sub_id', 'username', 'user_id', 'process_name', 'suffix', 'proc_id',
+        'min_lat', 'max_lat', 'min_lon', 'max_lon', 'crop_to_selection', 'project_id',
+        'description', 'age_hours', 'attempts',
+        '_other_granules', '_other_granule_urls', '_extra_arguments',
+    )
+
+    # Fields exposed as cfg keys by JobConfig
+    cfg_keys = frozenset((
+        'granule', 'granule_url', 'other_granules', 'other_granule_urls', 'id',
+        'user_priority', 'item_priority', 'sub_name', 'sub_id', 'username', 'user_id',
+        'process_name', 'suffix', 'proc_id', 'min_lat', 'max_lat', 'min_lon', 'max_lon',
+        'crop_to_selection', 'project_id', 'description', 'extra_arguments', 'attempts',
+    ))
+
+    @classmethod
+    def from_row(cls, r):
+        job = cls()
+        job.granule = r[0]
+        job.granule_url = r[1]
+        job._other_granules = r[2]
+        job._other_granule_urls = r[3]
+        job.id = int(r[4])
+        job.sub_priority = int(r[5]) if r[5] is not None else None
+        job.user_priority = int(r[6])
+        job.item_priority = int(r[7])
+        if r[9] is not None:
+            job.sub_name = r[8]
+            job.sub_id = int(r[9])
+            job.min_lat = float(r[15])
+            job.max_lat = float(r[16])
+            job.min_lon = float(r[17])
+            job.max_lon = float(r[18])
+        else:
+            job.sub_name = 'One-Time'
+            job.sub_id = 0
+            job.min_lat = -90.0
+            job.max_lat = 90.0
+            job.min_lon = -180.0
+            job.max_lon = 180.0
+        job.username = r[10]
+        job.user_id = int(r[11])
+        job.process_name = r[12]
+        job.suffix = r[13]
+        job.proc_id = int(r[14])
+        job.crop_to_selection = bool(r[19])
+        job.project_id = int(r[20]) if r[20] is not None else -1
+        job.description = r[21] if r[21] is not None else ''
+        job.age_hours = r[22]
+        job._extra_arguments = r[23]
+        job.attempts = int(r[24]) if r[24] is not None else 0
+        return job
+
+    @property
+    def other_granules(self):
+        if not isinstance(self._other_granules, (list, type(None))):
+            self._other_granules = _split(self._other_granules)
+        return self._other_granules
+
+    @property
+    def other_granule_urls(self):
+        if not isinstance(self._other_granule_urls, (list, type(None))):
+            self._other_granule_urls = _split(self._other_granule_urls)
+        return self._other_granule_urls
+
+    @property
+    def extra_arguments(self):
+        if not isinstance(self._extra_arguments, dict):
+            if self._extra_arguments is None or len(str(self._extra_arguments)) <= 2:
+                self._extra_arguments = dict()
+            else:
+                self._extra_arguments = json.loads(self._extra_arguments)
+        return self._extra_arguments
+
+    def as_cfg(self):
+        return dict((key, getattr(self, key)) for key in self.cfg_keys)
+
+
+class JobConfig(dict):
+    """The cfg dict, with the fields of the current JobRecord as read-through keys.
+
+    cfg['granule'], 'granule' in cfg and cfg.get('granule') work as they
+    always have, but come from the job set with set_job, so switching jobs
+    replaces every job field at once. Assigning a job key stores it in the
+    dict, overriding the job's value until the next set_job.
+    """
+    job = None
+
+    def set_job(self, job):
+        for key in JobRecord.cfg_keys:
+            self.pop(key, None)
+        self.job = job
+
+    def __missing__(self, key):
+        if self.job is not None and key in JobRecord.cfg_keys:
+            return getattr(self.job, key)
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or (self.job is not None and key in JobRecord.cfg_keys)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def copy(self):
+        new = JobConfig(self)
+        new.job = self.job
+        return new
+
+
+def use_job(cfg, job):
+    """Make job the current job of cfg (and of this thread's log records)"""
+    set_log_context(local_queue_id=job.id, granule=job.granule)
+    if isinstance(cfg, JobConfig):
+        cfg.set_job(job)
+    else:
+        cfg.update(job.as_cfg())
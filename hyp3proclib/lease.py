@@ -0,0 +1,131 @@
+"""Module for proc_lib job lease functions
+
+Claimed (PROCESSING) jobs carry a lease in local_queue.lease_expires that a
+heartbeat thread keeps extending while the worker is alive. Jobs whose lease
+runs out belonged to a worker that died and are returned to the queue by
+reap_expired_leases. Requires:
+
+    ALTER TABLE local_queue ADD COLUMN lease_expires timestamp;
+    CREATE INDEX local_queue_lease_idx ON local_queue (lease_expires) WHERE status = 'PROCESSING';
+"""
+
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import threading
+
+from hyp3proclib.db import get_db_connection, query_database
+from hyp3proclib.logger import log
+
+
+def extend_lease(conn, queue_id, lease_seconds):
+    """Push the lease of a job we are processing out to lease_seconds from now.
+
+    Returns False if the job is no longer PROCESSING (e.g. it was reaped).
+    """
+    count = query_database(
+        conn,
+        '''
+            update local_queue set lease_expires = current_timestamp + %(lease)s * interval '1 second'
+            where id = %(id)s and status = 'PROCESSING'
+        ''',
+        {'id': queue_id, 'lease': lease_seconds},
+        commit=True,
+    )
+    return count > 0
+
+
+def reap_expired_leases(conn, cfg, status='RETRY'):
+    """Return every PROCESSING job with an expired lease to status, in bulk.
+
+    A lost lease counts as a failed attempt, as in hyp3proclib.failure: the
+    job is retried after the same backoff, or set to FAILED once it has had
+    retry_max_attempts. Their open instance_records rows are closed as well.
+    Returns the reaped local_queue ids.
+    """
+    recs = query_database(
+        conn,
+        '''
+            update local_queue
+                set status = case when coalesce(attempts, 0) + 1 >= %(max_attempts)s then 'FAILED'
+                                  else %(status)s end,
+                    lease_expires = null, message = 'Worker lease expired',
+                    attempts = coalesce(attempts, 0) + 1,
+                    not_before = current_timestamp
+                        + least(%(max_backoff)s, %(backoff)s * power(2, coalesce(attempts, 0))) * interval '1 second'
+            where status = 'PROCESSING' and lease_expires < current_timestamp
+            returning id, status
+        ''',
+        {
+            'status': status,
+            'max_attempts': cfg['retry_max_attempts'],
+            'backoff': cfg['retry_backoff'],
+            'max_backoff': cfg['retry_max_backoff'],
+        },
+        commit=True,
+        returning=True,
+    )
+    ids = [int(r[0]) for r in recs]
+
+    if ids:
+        failed = [int(r[0]) for r in recs if r[1] == 'FAILED']
+        log.info('Returned %s job(s) with expired leases to %s: %s', len(ids) - len(failed), status,
+                 [i for i in ids if i not in failed])
+        if failed:
+            log.warning('Failed %s job(s) that lost their lease %s times: %s', len(failed),
+                        cfg['retry_max_attempts'], failed)
+        query_database(
+            conn,
+            '''
+                update instance_records set end_time = current_timestamp
+                where local_queue_id = any(%(ids)s) and end_time is null
+            ''',
+            {'ids': ids},
+            commit=True,
+        )
+
+    return ids
+
+
+class LeaseHeartbeat(threading.Thread):
+    """Background thread that keeps the lease of the job being processed alive"""
+
+    def __init__(self, queue_id, lease_seconds, interval):
+        super(LeaseHeartbeat, self).__init__(name='lease-heartbeat-{0}'.format(queue_id))
+        self.daemon = True
+        self.queue_id = queue_id
+        self.lease_seconds = lease_seconds
+        self.interval = interval
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        conn = None
+        try:
+            while not self._stop_event.wait(self.interval):
+                try:
+                    if conn is None:
+                        conn = get_db_connection('hyp3-db')
+                    if not extend_lease(conn, self.queue_id, self.lease_seconds):
+                        log.warning('Job %s is no longer PROCESSING; stopping heartbeat', self.queue_id)
+                        return
+                except Exception as e:
+                    log.warning('Could not extend lease of job %s: %s', self.queue_id, e)
+                    conn = None
+        finally:
+            if conn is not None:
+                conn.close()
+
+
+def start_heartbeat(cfg):
+    stop_heartbeat(cfg)
+    heartbeat = LeaseHeartbeat(cfg['id'], cfg['lease_seconds'], cfg['heartbeat_interval'])
+    heartbeat.start()
+    cfg['heartbeat'] = heartbeat
+
+
+def stop_heartbeat(cfg):
+    heartbeat = cfg.pop('heartbeat', None)
+    if heartbeat is not None:
+        heartbeat.stop()
@@ -1,21 +1,124 @@
-"""Module for all proc_lib logging functions"""
+"""Module for all proc_lib logging functions
+
+setup_logger only puts a QueueHandler on the proc_lib logger. The log file and
+stdout handlers are run by a QueueListener thread, so logging never blocks the
+worker on a write. Records are formatted before they are queued, so pass
+arguments %-style (log.debug('Proc: %s', line)) to skip building messages for
+disabled levels.
+
+With log_format = json in the [general] section of proc.cfg, each record is
+written as one JSON object with the job context: proc_name and instance_id
+for the whole process, and local_queue_id, granule and stage as set for the
+logging thread by set_log_context.
+"""
 
 from __future__ import print_function, absolute_import, division, unicode_literals
 
+import atexit
+import copy
+import json
 import logging
 import os
 import sys
+import threading
 import time
+from logging.handlers import QueueHandler, QueueListener
+
+from six.moves import queue
 
 import hyp3proclib
 
 log = logging.getLogger(__file__)
 
+_queue_handler = None
+_listener = None
+
+# proc_name and instance_id, the same for every thread
+_process_context = {}
+_thread_context = threading.local()
+
+
+def set_log_context(**fields):
+    """Add fields (e.g. local_queue_id, granule, stage) to this thread's log records; None removes one"""
+    context = getattr(_thread_context, 'fields', None)
+    if context is None:
+        context = _thread_context.fields = {}
+    for key, value in fields.items():
+        if value is None:
+            context.pop(key, None)
+        else:
+            context[key] = value
+
+
+def clear_log_context():
+    """Remove the fields set by set_log_context on this thread"""
+    _thread_context.fields = {}
+
+
+class JobContextFilter(logging.Filter):
+    """Attaches the log context as record.context, in the thread that logs the record"""
+
+    def filter(self, record):
+        context = dict(_process_context)
+        context.update(getattr(_thread_context, 'fields', None) or {})
+        record.context = context
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as one line of JSON, with orjson if it is installed"""
+
+    def __init__(self):
+        super(JsonFormatter, self).__init__()
+        try:
+            import orjson
+            self.dumps = lambda obj: orjson.dumps(obj, default=str).decode('utf-8')
+        except ImportError:
+            self.dumps = lambda obj: json.dumps(obj, default=str, separators=(',', ':'))
+
+    def format(self, record):
+        obj = {
+            'time': '{0}.{1:03d}Z'.format(
+                time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)), int(record.msecs)),
+            'level': record.levelname,
+            'message': record.getMessage(),
+        }
+        obj.update(getattr(record, 'context', {}))
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            obj['exception'] = record.exc_text
+        return self.dumps(obj)
+
+
+class _QueueHandler(QueueHandler):
+    def prepare(self, record):
+        # Like QueueHandler.prepare, but keeps the traceback apart from the message for JsonFormatter
+        record = copy.copy(record)
+        record.message = record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = record.exc_text or logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
 
 def setup_logger(cfg, verbose):
+    """Log to stdout, and the process log file if write_log_file, at INFO or DEBUG if verbose
+
+    Records are JSON, with the job context, if cfg['log_format'] is json.
 
-    formatter = logging.Formatter('%(asctime)s [%(levelname)s] %(message)s')
-    formatter.converter = time.gmtime
+    Can be called again (e.g. when a daemon reloads its configuration); the
+    previous handlers are flushed and replaced rather than added to.
+    """
+    global _queue_handler, _listener
+
+    json_format = cfg.get('log_format', 'text') == 'json'
+    if json_format:
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter('%(asctime)s [%(levelname)s] %(message)s')
+        formatter.converter = time.gmtime
 
     if verbose:
         lvl = logging.DEBUG
@@ -24,12 +127,62 @@ def setup_logger(cfg, verbose):
 
     log.setLevel(lvl)
 
+    handlers = []
     if cfg['write_log_file'] is True:
         log_file = os.path.join(hyp3proclib.default_log_dir, cfg['proc_name'] + '.log')
-        handler_file = logging.FileHandler(filename=log_file)
-        handler_file.setFormatter(formatter)
-        log.addHandler(handler_file)
+        handlers.append(logging.FileHandler(filename=log_file))
+    handlers.append(logging.StreamHandler(sys.stdout))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    shutdown_logger()
+
+    _queue_handler = _QueueHandler(queue.Queue(-1))
+    _listener = QueueListener(_queue_handler.queue, *handlers)
+    log.addHandler(_queue_handler)
+    _listener.start()
+
+    if json_format:
+        from hyp3proclib.instance_metadata import get_instance_identity
+
+        log.addFilter(_context_filter)
+        _process_context['proc_name'] = cfg['proc_name']
+        try:
+            _process_context['instance_id'] = get_instance_identity(node_type=cfg.get('proc_node_type'))['instance_id']
+        except Exception as e:
+            log.warning('Logging without an instance_id: %s', e)
+            _process_context.pop('instance_id', None)
+
+
+def shutdown_logger():
+    """Write out any queued records and close the handlers set up by setup_logger"""
+    global _queue_handler, _listener
+
+    log.removeFilter(_context_filter)
+    if _queue_handler is not None:
+        log.removeHandler(_queue_handler)
+        _queue_handler = None
+
+    if _listener is not None:
+        listener, _listener = _listener, None
+        listener.stop()
+        for handler in listener.handlers:
+            log.removeHandler(handler)
+            handler.close()
+
+
+def _log_directly_after_fork():
+    # Forked children (e.g. clip workers) have no listener thread, so they write synchronously
+    global _queue_handler, _listener
+
+    if _queue_handler is not None:
+        log.removeHandler(_queue_handler)
+        for handler in _listener.handlers:
+            log.addHandler(handler)
+        _queue_handler = _listener = None
+
+
+_context_filter = JobContextFilter()
 
-    handler_stream = logging.StreamHandler(sys.stdout)
-    handler_stream.setFormatter(formatter)
-    log.addHandler(handler_stream)
+atexit.register(shutdown_logger)
+os.register_at_fork(after_in_child=_log_directly_after_fork)
@@ -0,0 +1,114 @@
+"""Module for proc_lib queue prefetching
+
+While a job is in its last stage (see upload_product), a JobPrefetcher claims
+the next job(s) in the background, each with its own lease and work directory,
+so the worker can start on the next job as soon as the current one is done.
+"""
+
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import collections
+import datetime
+import shutil
+import threading
+
+import hyp3proclib
+from hyp3proclib.db import get_db_connection
+from hyp3proclib.file_system import cleanup_env, setup_workdir
+from hyp3proclib.lease import stop_heartbeat
+from hyp3proclib.logger import log
+
+# Per-job cfg entries that must not be shared between the running and a prefetched job
+_job_keys = ('heartbeat', 'prefetcher', 'instance_record', 'browse_images')
+
+
+class JobPrefetcher(object):
+    """Claims up to depth jobs ahead of the one being processed.
+
+    remaining bounds the number of jobs still wanted by the worker (None for
+    no limit), so a worker asked to process -n jobs never hoards more.
+    """
+
+    def __init__(self, cfg, depth):
+        self.cfg = cfg
+        self.depth = depth
+        self.remaining = None
+        self._jobs = collections.deque()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        """Start claiming jobs in the background, if there is room in the buffer"""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            if self._wanted() <= 0:
+                return
+            self._thread = threading.Thread(target=self._fill, name='job-prefetcher')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _wanted(self):
+        wanted = self.depth - len(self._jobs)
+        if self.remaining is not None:
+            wanted = min(wanted, self.remaining - len(self._jobs))
+        return wanted
+
+    def _fill(self):
+        while self._wanted() > 0:
+            job = new_job_cfg(self.cfg)
+            try:
+                found = hyp3proclib.get_queue_item(job, exit=False, make_workdir=False, stop_check=False)
+                if not found:
+                    return
+                setup_workdir(job, chdir=False)
+            except Exception:
+                log.exception('Failed to prefetch a job')
+                return
+
+            log.info('Prefetched job %s: %s', job['id'], job['granule'])
+            self._jobs.append(job)
+
+    def next_job(self):
+        """Return the cfg of the oldest prefetched job, or None.
+
+        Waits for a claim already in progress, so a job isn't claimed twice.
+        """
+        thread = self._thread
+        if thread is not None:
+            thread.join()
+
+        try:
+            job = self._jobs.popleft()
+        except IndexError:
+            return None
+
+        job['process_start_time'] = datetime.datetime.now()
+        return job
+
+    def release(self):
+        """Give all prefetched jobs back to the queue"""
+        thread = self._thread
+        if thread is not None:
+            thread.join()
+
+        while self._jobs:
+            job = self._jobs.popleft()
+            stop_heartbeat(job)
+            status = 'RETRY' if job['retry'] else 'QUEUED'
+            log.info('Returning prefetched job %s to %s', job['id'], status)
+            try:
+                with get_db_connection('hyp3-db') as conn:
+                    hyp3proclib.update_queue_status(conn, job, status)
+            except Exception:
+                log.exception('Could not return prefetched job %s', job['id'])
+            shutil.rmtree(job['workdir'], ignore_errors=True)
+
+
+def new_job_cfg(cfg):
+    """A copy of cfg to claim a job into, without the running job's state"""
+    job = cfg.copy()
+    for key in _job_keys:
+        job.pop(key, None)
+    cleanup_env(job)
+    return job
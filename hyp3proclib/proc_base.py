@@ -2,11 +2,19 @@
 
 from __future__ import print_function, absolute_import, division, unicode_literals
 
+import gc
+import os
+import signal
 import time
 
-from hyp3proclib import get_queue_item, setup
-from hyp3proclib.logger import log
+from hyp3proclib import get_queue_item, load_db_config, load_general_config, setup
+from hyp3proclib.config import init_config, is_config
+from hyp3proclib.file_system import check_stop, cleanup_env
+from hyp3proclib.job import JobConfig
+from hyp3proclib.logger import clear_log_context, log, set_log_context, setup_logger
 from hyp3proclib.instance_tracking import manage_instance_and_lockfile
+from hyp3proclib.prefetch import JobPrefetcher
+from hyp3proclib.spot import SpotInterruptionWatcher
 
 
 class Processor(object):
@@ -23,22 +31,45 @@ class Processor(object):
         self.cli_args = cli_args
         self.sci_version = sci_version
         self.cfg = None
+        self.reload_requested = False
+        self.config_loaded_at = None
+        self.prefetcher = None
 
     def run(self):
         self.cfg = setup(self.proc_name, cli_args=self.cli_args, sci_version=self.sci_version)
         
         with manage_instance_and_lockfile(self.cfg):
-            total = self.cfg['num_to_process']
+            if self.cfg['spot']:
+                SpotInterruptionWatcher(self.cfg).start()
 
-            log.info('Starting')
-            log.debug('Processing {0} products.'.format(total))
+            if self.cfg['prefetch_depth'] > 0 and not self.force_proc and self.cfg['queue_id'] is None:
+                self.prefetcher = JobPrefetcher(self.cfg, self.cfg['prefetch_depth'])
+                self.cfg['prefetcher'] = self.prefetcher
 
-            self._process_all(total)
+            try:
+                if self.cfg['daemon']:
+                    log.info('Starting in daemon mode')
+                    self._process_forever()
+                    return
 
-            log.info('Done')
+                total = self.cfg['num_to_process']
+
+                log.info('Starting')
+                log.debug('Processing {0} products.'.format(total))
+
+                self._process_all(total)
+
+                log.info('Done')
+            finally:
+                if self.prefetcher is not None:
+                    self.prefetcher.release()
 
     def _process_all(self, total):
         for n in range(total):
+            if self.prefetcher is not None:
+                # Never prefetch more than the jobs left after this one
+                self.prefetcher.remaining = total - n - 1
+
             found = self._process_one(n)
 
             log.info('Processed {0}/{1} products.'.format(n + 1, total))
@@ -49,14 +80,101 @@ class Processor(object):
             if not found and self.stop_if_none:
                 break
 
+    def _process_forever(self):
+        """Claim and process jobs until stopped (see hyp3proclib.file_system.check_stop).
+
+        Setup and locking happen once. Configuration (proc.cfg, except the
+        lock directory, and the hyp3-db config) is reloaded on SIGHUP or once
+        db_config_ttl has passed, and the idle sleep doubles from
+        daemon_idle_sleep up to daemon_max_idle_sleep while the queue is empty.
+        """
+        signal.signal(signal.SIGHUP, self._request_reload)
+        self.config_loaded_at = time.time()
+        start_dir = os.getcwd()
+
+        idle_sleep = self.cfg['daemon_idle_sleep']
+        n = 0
+        while True:
+            self._refresh_config()
+
+            found = self._process_one(n)
+            self._reset_after_job(start_dir)
+
+            if found:
+                n += 1
+                log.info('Processed {0} products.'.format(n))
+                idle_sleep = self.cfg['daemon_idle_sleep']
+                if self.sleep_time > 0:
+                    time.sleep(self.sleep_time)
+            else:
+                log.debug('Nothing to process, sleeping {0} seconds'.format(idle_sleep))
+                time.sleep(idle_sleep)
+                idle_sleep = min(idle_sleep * 2, self.cfg['daemon_max_idle_sleep'])
+
+    def _request_reload(self, signum, frame):
+        log.info('Received a SIGHUP; reloading configuration before the next job.')
+        self.reload_requested = True
+
+    def _refresh_config(self):
+        ttl = self.cfg['db_config_ttl']
+        expired = ttl > 0 and time.time() - self.config_loaded_at > ttl
+        if not (self.reload_requested or expired):
+            return
+
+        log.info('Reloading configuration')
+        init_config()
+
+        # The held lock lives in the lock directory, so it stays as it is
+        lock_dir, lock_slots = self.cfg['lock_dir'], self.cfg['lock_slots']
+        load_general_config(self.cfg)
+        self.cfg['lock_dir'], self.cfg['lock_slots'] = lock_dir, lock_slots
+        if not self.cfg['user_workdir']:
+            self.cfg['original_workdir'] = self.cfg['workdir']
+        if self.prefetcher is not None:
+            self.prefetcher.depth = self.cfg['prefetch_depth']
+        setup_logger(self.cfg, self.cfg['cli_verbose'] or is_config('general', 'verbose'))
+
+        # An explicit reload shouldn't be answered from another worker's cache
+        load_db_config(self.cfg, use_cache=not self.reload_requested)
+
+        self.reload_requested = False
+        self.config_loaded_at = time.time()
+
+    def _reset_after_job(self, start_dir):
+        # Don't carry job state, a removed workdir as cwd, or garbage between jobs
+        cleanup_env(self.cfg)
+        os.chdir(start_dir)
+        gc.collect()
+
+    def _take_prefetched_job(self):
+        if self.prefetcher is None:
+            return False
+
+        # Before taking the job, so a stop leaves it for prefetcher.release() to return
+        check_stop(self.cfg)
+        job = self.prefetcher.next_job()
+        if job is None:
+            return False
+
+        log.info('Starting prefetched job for %s', job['granule'])
+        self.cfg.update(job)
+        if isinstance(job, JobConfig):
+            self.cfg.set_job(job.job)
+        self.cfg['prefetcher'] = self.prefetcher
+        if os.path.isdir(self.cfg['workdir']):
+            os.chdir(self.cfg['workdir'])
+        return True
+
     def _process_one(self, n):
-        if self.force_proc:
-            self.proc_func(self.cfg, n)
-        else:
-            is_found = get_queue_item(self.cfg, exit=False)
-            if not is_found:
-                return False
+        try:
+            if not self.force_proc:
+                is_found = self._take_prefetched_job() or get_queue_item(self.cfg, exit=False)
+                if not is_found:
+                    return False
 
+            set_log_context(local_queue_id=self.cfg.get('id'), granule=self.cfg.get('granule'), stage='process')
             self.proc_func(self.cfg, n)
+        finally:
+            clear_log_context()
 
         return True
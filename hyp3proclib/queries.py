@@ -0,0 +1,270 @@
+"""Module for proc_lib named, prepared queries
+
+Hot queries are registered here by name. execute_query PREPAREs each one the
+first time it is used on a connection and then runs it with EXECUTE, so
+Postgres parses and plans it once per connection instead of on every call.
+Call counts and cumulative latency are kept per query (see query_stats).
+
+Turn prepared statements off (e.g. behind a transaction pooling PgBouncer)
+with prepared_statements = no in the [general] section of proc.cfg; queries
+are then sent as plain text, still with statistics.
+"""
+
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import hashlib
+import re
+import threading
+import time
+import weakref
+
+from hyp3proclib.config import get_config, is_yes
+from hyp3proclib.db import query_database, transaction
+from hyp3proclib.logger import log
+
+_param_re = re.compile(r'%\((\w+)\)s|%s|%%')
+
+# {statement name: whether PREPARE worked} for each connection
+_prepared = weakref.WeakKeyDictionary()
+
+_stats_lock = threading.Lock()
+
+
+class Query(object):
+    """A registered query, with %(name)s style parameters"""
+
+    def __init__(self, name, sql):
+        self.name = name
+        self.sql = sql
+        self.calls = 0
+        self.total_time = 0.0
+
+        args = []
+        positional = [0]
+
+        def to_placeholder(m):
+            if m.group(0) == '%%':
+                return '%'
+            if m.group(1) is None:
+                positional[0] += 1
+                args.append(None)
+                return '${0}'.format(positional[0])
+            if m.group(1) not in args:
+                args.append(m.group(1))
+            return '${0}'.format(args.index(m.group(1)) + 1)
+
+        self.prepare_sql = 'PREPARE {0} AS {1}'.format(name, _param_re.sub(to_placeholder, sql))
+
+        if not args:
+            self.execute_sql = 'EXECUTE {0}'.format(name)
+        elif None in args:
+            self.execute_sql = 'EXECUTE {0} ({1})'.format(name, ', '.join(['%s'] * len(args)))
+        else:
+            self.execute_sql = 'EXECUTE {0} ({1})'.format(name, ', '.join('%({0})s'.format(a) for a in args))
+
+    def record(self, elapsed):
+        with _stats_lock:
+            self.calls += 1
+            self.total_time += elapsed
+
+
+queries = dict()
+
+
+def register_query(name, sql):
+    """Register sql under name (idempotent) and return the Query"""
+    query = queries.get(name)
+    if query is None or query.sql != sql:
+        query = Query(name, sql)
+        queries[name] = query
+    return query
+
+
+def register_dynamic_query(prefix, sql):
+    """Register a query built at run time under a name derived from its text"""
+    digest = hashlib.md5(sql.encode('utf-8')).hexdigest()[:12]
+    return register_query('{0}_{1}'.format(prefix, digest), sql)
+
+
+def use_prepared_statements():
+    return is_yes(get_config('general', 'prepared_statements', 'yes'))
+
+
+def prepare(conn, query):
+    """PREPARE query on conn unless it already is; returns whether it is prepared
+
+    A query that failed to prepare is sent as text on that connection only,
+    so a transient error doesn't turn preparing off for the whole process.
+    """
+    try:
+        states = _prepared.setdefault(conn, {})
+    except TypeError:
+        # Not a connection we can track (no weakref support)
+        return False
+
+    if query.name in states:
+        return states[query.name]
+
+    try:
+        # A savepoint inside an open unit of work, so a failure doesn't abort it
+        with transaction(conn):
+            query_database(conn, query.prepare_sql, commit=True)
+    except Exception as e:
+        log.warning('Could not prepare query {0}, sending it as text: {1}'.format(query.name, e))
+        states[query.name] = False
+        return False
+
+    states[query.name] = True
+    return True
+
+
+def execute_query(conn, name, params=None, commit=False, returning=False):
+    """Run the registered query name on conn, like hyp3proclib.db.query_database"""
+    query = queries[name]
+
+    start = time.time()
+    try:
+        if use_prepared_statements() and prepare(conn, query):
+            return query_database(conn, query.execute_sql, params, commit=commit, returning=returning)
+        return query_database(conn, query.sql, params, commit=commit, returning=returning)
+    finally:
+        query.record(time.time() - start)
+
+
+def query_stats():
+    """Return {name: (calls, total seconds)} for every query run so far"""
+    with _stats_lock:
+        return dict((q.name, (q.calls, q.total_time)) for q in queries.values() if q.calls > 0)
+
+
+def log_query_stats():
+    for name, (calls, total) in sorted(query_stats().items(), key=lambda x: -x[1][1]):
+        log.debug('Query %s: %s call(s), %.3f s total, %.2f ms/call', name, calls, total, 1000.0 * total / calls)
+
+
+register_query('claim_job', '''
+    update local_queue
+        set status = 'PROCESSING', processed_time = current_timestamp,
+            lease_expires = current_timestamp + %(lease)s * interval '1 second'
+    where id = %(id)s and status = %(status)s
+''')
+
+register_query(
+    'queue_status',
+    "update local_queue set status = %(status)s, lease_expires = null where id = %(id)s"
+)
+register_query(
+    'queue_status_complete',
+    "update local_queue set status = %(status)s, lease_expires = null, completed_time = current_timestamp "
+    "where id = %(id)s"
+)
+register_query(
+    'queue_status_failed',
+    "update local_queue set status = %(status)s, lease_expires = null, message = %(msg)s, "
+    "completed_time = current_timestamp where id = %(id)s"
+)
+register_query(
+    'queue_status_message',
+    "update local_queue set status = %(status)s, lease_expires = null, message = %(msg)s where id = %(id)s"
+)
+register_query('queue_status_retry', '''
+    update local_queue
+        set status = %(status)s, lease_expires = null, message = %(msg)s,
+            attempts = coalesce(attempts, 0) + 1,
+            not_before = current_timestamp + %(delay)s * interval '1 second'
+    where id = %(id)s
+''')
+
+register_query('instance_record_insert', '''
+    insert into instance_records (instance_id, local_queue_id, start_time, instance_type)
+    values (%(instance_id)s, %(local_queue_id)s, current_timestamp, %(instance_type)s)
+''')
+register_query(
+    'instance_record_end',
+    'update instance_records set end_time=current_timestamp '
+    'where (instance_id=%(instance_id)s and local_queue_id=%(local_queue_id)s)'
+)
+
+register_query('browse_insert', '''
+    INSERT INTO browse(type, product_id, name, url)
+    VALUES (%(browse_type)s, %(product_id)s, %(name)s, %(url)s)
+''')
+register_query('browse_insert_geo', '''
+    INSERT INTO browse(type, product_id, name, url, lat_min, lat_max, lon_min, lon_max, epsg)
+    VALUES (%(browse_type)s, %(product_id)s, %(name)s, %(url)s,
+                     %(lat_min)s, %(lat_max)s, %(lon_min)s, %(lon_max)s, %(epsg)s)
+''')
+
+register_query('product_insert', '''
+    INSERT INTO products (subscription_id, name, url, browse_url, hash, hash_type,
+              size, creation_date, user_id, process_id, proc_node_type, local_queue_id,
+                              ok_to_duplicate, path, frame)
+    VALUES (%(sub_id)s, %(name)s, %(url)s, %(browse_url)s,
+        %(hash)s, %(hash_type)s, %(size)s, current_timestamp, %(user_id)s, %(process_id)s,
+        %(proc_node_type)s, %(local_queue_id)s, True, %(path)s, %(frame)s)
+''')
+register_query('product_update', '''
+    UPDATE products
+        SET
+            subscription_id = %(sub_id)s,
+            name = %(name)s,
+            url = %(url)s,
+            browse_url = %(browse_url)s,
+            hash = %(hash)s,
+            hash_type = %(hash_type)s,
+            size = %(size)s,
+            creation_date = current_timestamp,
+            user_id = %(user_id)s,
+            process_id = %(process_id)s,
+            proc_node_type = %(proc_node_type)s,
+            local_queue_id = %(local_queue_id)s,
+            path = %(path)s,
+            frame = %(frame)s
+        WHERE id = %(id)s
+''')
+
+# The job's user, and its one-time action hash, renewed or created as in emailer.create_one_time_hash
+_notification_info = '''
+    with info as ({0}
+    ), wanted as (
+        select 1 from info
+        where %(want_hash)s::boolean and (info.wants_email or not %(only_if_wants_email)s::boolean)
+    ), renewed as (
+        update one_time_actions set expires = now() + interval '30' day
+        where user_id = %(user_id)s and action = %(action)s and params = %(params)s
+            and exists (select 1 from wanted)
+        returning id, hash
+    ), created as (
+        insert into one_time_actions(hash, user_id, action, params, expires)
+        select %(hashval)s::text, %(user_id)s, %(action)s, %(params)s, current_timestamp + interval '30' day
+        where exists (select 1 from wanted) and not exists (select 1 from renewed)
+        returning id, hash
+    )
+    select info.username, info.email, info.wants_email, info.sub_name, info.process_name, h.id, h.hash
+    from info
+        left join (select id, hash from renewed union all select id, hash from created) h on true
+    limit 1
+'''
+register_query('notification_info', _notification_info.format('''
+        select users.username, users.email, users.wants_email, subscriptions.name as sub_name,
+               processes.name as process_name
+        from local_queue
+            left join subscriptions on local_queue.sub_id = subscriptions.id
+            join users on local_queue.user_id = users.id
+            join processes on local_queue.process_id = processes.id
+        where local_queue.id = %(id)s'''))
+# The same, for a subscription rather than one of its jobs
+register_query('subscription_notification_info', _notification_info.format('''
+        select users.username, users.email, users.wants_email, subscriptions.name as sub_name,
+               processes.name as process_name
+        from subscriptions
+            join users on subscriptions.user_id = users.id
+            join processes on subscriptions.process_id = processes.id
+        where subscriptions.id = %(sub_id)s and users.id = %(user_id)s'''))
+
+# The subscription's ROI, hashed so a cached shapefile can be checked without fetching it
+register_query(
+    'roi_hash',
+    'select md5(ST_AsBinary(location)), ST_SRID(location) from subscriptions where id = %(sub_id)s'
+)
+register_query('roi_wkb', 'select ST_AsBinary(location), ST_SRID(location) from subscriptions where id = %(sub_id)s')
@@ -0,0 +1,189 @@
+"""Module for proc_lib region of interest (ROI) shapefiles
+
+Clipping a subscription's products needs its location as a shapefile.
+ShapefileCache keeps simplified ROI shapefiles on the node, in roi_cache_dir,
+one directory per subscription id and md5 of the location's WKB. For a
+subscription it has seen, a job only asks the database for that hash; otherwise
+the WKB is fetched with plain SQL and written out with OGR. The roi_cache_size
+most recently used entries are kept. Both are read from the [general] section
+of proc.cfg.
+"""
+
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import glob
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from hyp3proclib.config import get_config
+from hyp3proclib.logger import log
+from hyp3proclib.queries import execute_query
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+# Build directories older than this were left by a worker that died
+_stale_build_seconds = 3600
+
+
+def write_shapefile(wkb, srid, shapefile):
+    """Write the geometry wkb, in EPSG:srid (4326 if not set), as shapefile"""
+    from osgeo import ogr, osr
+
+    geometry = ogr.CreateGeometryFromWkb(wkb)
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(srid or 4326)
+    if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+        srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+
+    driver = ogr.GetDriverByName('ESRI Shapefile')
+    ds = driver.CreateDataSource(shapefile)
+    layer_name = os.path.splitext(os.path.basename(shapefile))[0]
+    layer = ds.CreateLayer(layer_name, srs, geom_type=geometry.GetGeometryType())
+    feature = ogr.Feature(layer.GetLayerDefn())
+    feature.SetGeometry(geometry)
+    layer.CreateFeature(feature)
+
+    # Dereferencing closes the data source, which writes the files
+    feature = None
+    ds = None
+
+
+def simplify(shapefile, out_shapefile):
+    """Simplify complex shapefiles (over 300 points) into out_shapefile"""
+    from hyp3lib.simplify_shapefile import simplify_shapefile
+    simplify_shapefile(shapefile, out_shapefile)
+
+
+def copy_shapefile(shapefile, out_shapefile):
+    """Copy shapefile and its sidecar files (.shx, .dbf, .prj, ...) to out_shapefile
+
+    Raises IOError if shapefile doesn't exist.
+    """
+    base = os.path.splitext(shapefile)[0]
+    out_base = os.path.splitext(out_shapefile)[0]
+    files = glob.glob(base + '.*')
+    if shapefile not in files:
+        raise IOError('No shapefile at {0}'.format(shapefile))
+    for f in files:
+        shutil.copy(f, out_base + os.path.splitext(f)[1])
+
+
+class ShapefileCache(object):
+    """Simplified ROI shapefiles kept in cache_dir, evicting the least recently used beyond size"""
+
+    def __init__(self, cache_dir=None, size=None):
+        if cache_dir is None:
+            cache_dir = get_config(
+                'general', 'roi_cache_dir', os.path.join(os.path.expanduser('~'), '.hyp3', 'roi_cache'))
+        if size is None:
+            size = int(get_config('general', 'roi_cache_size', '64'))
+
+        self.cache_dir = cache_dir
+        self.size = max(1, size)
+        if not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                # Made by another worker in the meantime
+                if not os.path.isdir(cache_dir):
+                    raise
+
+    def entry(self, sub_id, hashval):
+        return os.path.join(self.cache_dir, '{0}-{1}'.format(int(sub_id), hashval))
+
+    def get(self, conn, sub_id):
+        """Return the path of the subscription's ROI shapefile, fetching it on a cache miss"""
+        recs = execute_query(conn, 'roi_hash', {'sub_id': sub_id}, returning=True)
+        if not recs or recs[0][0] is None:
+            raise Exception('Subscription {0} has no location'.format(sub_id))
+
+        entry = self.entry(sub_id, recs[0][0])
+        shapefile = os.path.join(entry, 'roi.shp')
+        if os.path.isfile(shapefile):
+            log.debug('Using cached ROI shapefile %s', shapefile)
+            os.utime(entry, None)
+            return shapefile
+
+        return self.add(conn, sub_id)
+
+    def copy(self, conn, sub_id, out_shapefile):
+        """Copy the subscription's ROI shapefile to out_shapefile
+
+        The entry is fetched again if another worker evicts it before the copy
+        is done.
+        """
+        shapefile = self.get(conn, sub_id)
+        try:
+            copy_shapefile(shapefile, out_shapefile)
+        except (IOError, OSError) as e:
+            log.debug('Cached ROI shapefile went away while copying it (%s); fetching it again', e)
+            copy_shapefile(self.add(conn, sub_id), out_shapefile)
+
+    def add(self, conn, sub_id):
+        """Fetch the subscription's location and cache it; returns the shapefile path"""
+        recs = execute_query(conn, 'roi_wkb', {'sub_id': sub_id}, returning=True)
+        if not recs or recs[0][0] is None:
+            raise Exception('Subscription {0} has no location'.format(sub_id))
+
+        wkb, srid = bytes(recs[0][0]), recs[0][1]
+        entry = self.entry(sub_id, hashlib.md5(wkb).hexdigest())
+        log.debug('Caching ROI shapefile of subscription %s in %s', sub_id, entry)
+
+        # Built under a hidden name and renamed into place, so other workers only see whole entries
+        build_dir = tempfile.mkdtemp(prefix='.' + os.path.basename(entry) + '.', dir=self.cache_dir)
+        try:
+            raw = os.path.join(build_dir, 'raw.shp')
+            write_shapefile(wkb, srid, raw)
+            simplify(raw, os.path.join(build_dir, 'roi.shp'))
+            for f in glob.glob(os.path.join(build_dir, 'raw.*')):
+                os.remove(f)
+
+            try:
+                os.rename(build_dir, entry)
+            except OSError:
+                log.debug('ROI shapefile was cached by another worker')
+                os.utime(entry, None)
+        finally:
+            if os.path.isdir(build_dir):
+                shutil.rmtree(build_dir, ignore_errors=True)
+
+        self.evict(keep=os.path.basename(entry))
+        return os.path.join(entry, 'roi.shp')
+
+    def evict(self, keep=None):
+        """Remove entries beyond size, least recently used first, and other versions of keep's subscription"""
+        now = time.time()
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            try:
+                mtime = os.path.getmtime(path)
+            except OSError:
+                continue
+
+            if name.startswith('.'):
+                if now - mtime > _stale_build_seconds:
+                    shutil.rmtree(path, ignore_errors=True)
+            elif keep and name != keep and name.split('-')[0] == keep.split('-')[0]:
+                log.debug('Removing outdated ROI shapefile %s', name)
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                entries.append((name == keep, mtime, name))
+
+        entries.sort(reverse=True)
+        for _, _, name in entries[self.size:]:
+            log.debug('Evicting ROI shapefile %s', name)
+            shutil.rmtree(os.path.join(self.cache_dir, name), ignore_errors=True)
+
+
+def get_shapefile_cache():
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = ShapefileCache()
+    return _default_cache
@@ -0,0 +1,73 @@
+"""Module for proc_lib spot instance interruption handling"""
+
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import os
+import signal
+import threading
+
+from hyp3proclib import terminate_running_processes, update_queue_status
+from hyp3proclib.db import get_db_connection
+from hyp3proclib.instance_metadata import MetadataClient
+from hyp3proclib.logger import log
+
+
+class SpotInterruptionWatcher(threading.Thread):
+    """Background thread watching for a spot interruption notice.
+
+    AWS gives a two minute warning through the metadata service's
+    spot/instance-action document. When it appears, the running command is
+    stopped, the current job is put back in the queue (closing its
+    instance_records row), and the worker is sent a SIGTERM so it exits
+    without uploading anything.
+    """
+
+    def __init__(self, cfg, client=None, interval=5, exit_process=True):
+        super(SpotInterruptionWatcher, self).__init__(name='spot-interruption-watcher')
+        self.daemon = True
+        self.cfg = cfg
+        self.client = client if client is not None else MetadataClient()
+        self.interval = interval
+        self.exit_process = exit_process
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        log.debug('Watching for spot interruption notices every {0} seconds'.format(self.interval))
+        while not self._stop_event.wait(self.interval):
+            try:
+                notice = self.client.get('meta-data/spot/instance-action')
+            except Exception as e:
+                log.warning('Could not check for spot interruption: ' + str(e))
+                continue
+
+            if notice:
+                self.handle_interruption(notice)
+                return
+
+    def handle_interruption(self, notice):
+        log.critical('Spot interruption notice received: ' + notice)
+        self.cfg['spot_interrupted'] = True
+
+        terminate_running_processes()
+        requeue_interrupted_job(self.cfg)
+
+        if self.exit_process:
+            os.kill(os.getpid(), signal.SIGTERM)
+
+
+def requeue_interrupted_job(cfg):
+    queue_id = cfg.get('id')
+    if queue_id is None:
+        log.info('No job in progress to requeue')
+        return
+
+    status = 'RETRY' if cfg['retry'] else 'QUEUED'
+    log.info('Returning local_queue id={0} to {1}'.format(queue_id, status))
+    try:
+        with get_db_connection('hyp3-db') as conn:
+            update_queue_status(conn, cfg, status, msg='Spot instance interrupted', queue_id=queue_id)
+    except Exception:
+        log.exception('Could not requeue interrupted job')
@@ -29,12 +29,13 @@ setup(
         'License :: OSI Approved :: BSD License',
         'Natural Language :: English',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.6',
         'Programming Language :: Python :: 3.7',
         'Programming Language :: Python :: 3.8',
         'Topic :: Software Development :: Libraries',
         ],
 
+    python_requires='>=3.7',
+
     install_requires=[
         'boto3',
         'hyp3lib~=1.0',
@@ -0,0 +1,210 @@
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import threading
+
+import pytest
+from six.moves import socketserver
+from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+
+class FakeMetadataServer(object):
+    """Local stand-in for the EC2 instance metadata service (IMDSv2)"""
+    token = 'fake-token'
+
+    def __init__(self):
+        self.paths = {
+            'meta-data/instance-id': 'i-0123456789abcdef0',
+            'meta-data/instance-type': 'c5.xlarge',
+        }
+        self.requests = []
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, code, body=''):
+                body = body.encode('utf-8')
+                self.send_response(code)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_PUT(self):
+                server.requests.append(('PUT', self.path))
+                if self.path == '/latest/api/token':
+                    self._reply(200, server.token)
+                else:
+                    self._reply(404)
+
+            def do_GET(self):
+                server.requests.append(('GET', self.path))
+                if self.headers.get('X-aws-ec2-metadata-token') != server.token:
+                    self._reply(401)
+                    return
+                path = self.path[len('/latest/'):]
+                if path in server.paths:
+                    self._reply(200, server.paths[path])
+                else:
+                    self._reply(404)
+
+        self.httpd = HTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{0}/latest'.format(self.httpd.server_port)
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+
+    def gets(self, path):
+        return self.requests.count(('GET', '/latest/' + path))
+
+
+class FakeSMTPServer(object):
+    """Local stand-in for an SMTP server that records the messages it accepts"""
+
+    def __init__(self):
+        self.messages = []
+        self.connections = 0
+        self.refuse = set()
+        self.sockets = []
+
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def reply(self, line):
+                self.wfile.write((line + '\r\n').encode('utf-8'))
+
+            def handle(self):
+                server.connections += 1
+                server.sockets.append(self.request)
+                self.reply('220 fake ESMTP')
+                mail_from, rcpts = None, []
+                for line in self.rfile:
+                    command = line.decode('utf-8').strip()
+                    verb = command.split(' ')[0].upper()
+                    if verb in ('EHLO', 'HELO', 'NOOP'):
+                        self.reply('250 fake')
+                    elif verb == 'MAIL':
+                        mail_from, rcpts = command[10:].strip('<>'), []
+                        self.reply('250 OK')
+                    elif verb == 'RCPT':
+                        rcpt = command[8:].strip('<>')
+                        if rcpt in server.refuse:
+                            self.reply('550 No such user')
+                        else:
+                            rcpts.append(rcpt)
+                            self.reply('250 OK')
+                    elif verb == 'DATA':
+                        self.reply('354 End data with <CR><LF>.<CR><LF>')
+                        data = []
+                        for data_line in self.rfile:
+                            if data_line.rstrip(b'\r\n') == b'.':
+                                break
+                            data.append(data_line)
+                        server.messages.append((mail_from, rcpts, b''.join(data)))
+                        self.reply('250 OK')
+                    elif verb == 'RSET':
+                        mail_from, rcpts = None, []
+                        self.reply('250 OK')
+                    elif verb == 'QUIT':
+                        self.reply('221 Bye')
+                        return
+                    else:
+                        self.reply('502 Not implemented')
+
+        self.tcpd = socketserver.ThreadingTCPServer(('127.0.0.1', 0), Handler)
+        self.tcpd.daemon_threads = True
+        self.port = self.tcpd.server_address[1]
+        self.thread = threading.Thread(target=self.tcpd.serve_forever)
+        self.thread.daemon = True
+
+    def drop_connections(self):
+        """Close every open session, as a restarted mail server would"""
+        for sock in self.sockets:
+            try:
+                sock.shutdown(2)
+            except Exception:
+                pass
+        self.sockets = []
+
+
+class FakeCursor(object):
+    def __init__(self, connection, name=None):
+        self.connection = connection
+        self.name = name
+        self.rows = []
+        self.rowcount = -1
+
+    def execute(self, query, params=None):
+        self.connection.queries.append((query, params))
+        if query.startswith('PREPARE '):
+            self.rows = []
+        else:
+            self.rows = self.connection.results.pop(0) if self.connection.results else []
+        self.rowcount = len(self.rows)
+
+    def fetchall(self):
+        return self.rows
+
+    def fetchmany(self, size):
+        self.connection.fetches.append(size)
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+    def close(self):
+        pass
+
+
+class FakeConnection(object):
+    """Stand-in for a psycopg2 connection that records queries.
+
+    Each execute returns the next list of rows from results (or no rows).
+    """
+
+    def __init__(self, results=None):
+        self.results = list(results or [])
+        self.queries = []
+        self.commits = 0
+        self.rollbacks = 0
+        self.fetches = []
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def cursor(self, name=None, withhold=False):
+        return FakeCursor(self, name)
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def fake_connection():
+    return FakeConnection()
+
+
+@pytest.fixture
+def fake_smtp():
+    server = FakeSMTPServer()
+    server.thread.start()
+    yield server
+    server.tcpd.shutdown()
+    server.tcpd.server_close()
+
+
+@pytest.fixture
+def fake_metadata():
+    server = FakeMetadataServer()
+    server.thread.start()
+    yield server
+    server.httpd.shutdown()
+    server.httpd.server_close()
@@ -0,0 +1,107 @@
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import asyncio
+import os
+import threading
+import time
+
+from hyp3proclib import aio
+from hyp3proclib.instance_metadata import MetadataClient
+
+
+def _run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+def test_pool_runs_queries_concurrently(monkeypatch):
+    from conftest import FakeConnection
+
+    connections = threading.local()
+    opened = []
+
+    def get_db_connection(section):
+        if not hasattr(connections, 'conn'):
+            connections.conn = FakeConnection()
+            opened.append(connections.conn)
+        time.sleep(0.05)
+        return connections.conn
+
+    monkeypatch.setattr(aio, 'get_db_connection', get_db_connection)
+    monkeypatch.setattr(aio, 'get_config', lambda section, key, default=None: default)
+
+    async def main():
+        async with aio.AsyncConnectionPool(size=4) as pool:
+            start = time.time()
+            await asyncio.gather(*[
+                aio.query_database(pool, 'update email_queue set status = %s where id = %s', ('SENT', n), commit=True)
+                for n in range(8)
+            ])
+            return time.time() - start
+
+    elapsed = _run(main())
+
+    assert len(opened) == 4
+    assert sorted(q[1][1] for c in opened for q in c.queries) == list(range(8))
+    assert all(c.closed for c in opened)
+    # 8 queries on 4 connections take 2 rounds, not 8
+    assert elapsed < 8 * 0.05
+
+
+def test_http_get(fake_metadata, monkeypatch):
+    monkeypatch.setattr(aio, 'get_config', lambda section, key, default=None: default)
+    token = MetadataClient(fake_metadata.url)._get_token()
+    url = fake_metadata.url + '/meta-data/instance-type'
+
+    async def main():
+        return await asyncio.gather(*[aio.http_get(url, headers={'X-aws-ec2-metadata-token': token})
+                                      for _ in range(3)])
+
+    assert _run(main()) == [b'c5.xlarge'] * 3
+
+
+def test_claim_job_keeps_working_directory(tmp_path, monkeypatch):
+    import hyp3proclib
+
+    calls = []
+
+    def get_queue_item(cfg, exit=True, make_workdir=True, stop_check=True):
+        calls.append((make_workdir, stop_check))
+        cfg['id'] = 1
+        return True
+
+    monkeypatch.setattr(hyp3proclib, 'get_queue_item', get_queue_item)
+    monkeypatch.chdir(tmp_path)
+    cfg = {'proc_name': 'test_claim', 'user_workdir': False, 'workdir': str(tmp_path)}
+
+    async def main():
+        async with aio.AsyncConnectionPool(size=1) as pool:
+            return await aio.claim_job(pool, cfg, make_workdir=True)
+
+    assert _run(main())
+    assert calls == [(False, False)]
+    assert os.path.isdir(cfg['workdir']) and cfg['workdir'] != str(tmp_path)
+    assert os.getcwd() == str(tmp_path)
+
+
+def test_unshared_connections_are_closed(monkeypatch):
+    from conftest import FakeConnection
+
+    opened = []
+
+    def get_db_connection(section):
+        opened.append(FakeConnection())
+        return opened[-1]
+
+    monkeypatch.setattr(aio, 'get_db_connection', get_db_connection)
+    monkeypatch.setattr(aio, 'get_config', lambda section, key, default=None: 'no')
+
+    async def main():
+        async with aio.AsyncConnectionPool(size=2) as pool:
+            await aio.query_database(pool, 'select 1')
+            return [c.closed for c in opened]
+
+    assert _run(main()) == [True]
@@ -0,0 +1,105 @@
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import os
+
+import pytest
+from PIL import Image
+
+from hyp3proclib import browse
+
+
+def _config(monkeypatch, **config):
+    monkeypatch.setattr(browse, 'get_config', lambda section, key, default=None: config.get(key, default))
+
+
+def test_build_browse_pyramid(tmp_path, monkeypatch):
+    _config(monkeypatch, low_res_browse_size='512', browse_email_width='400')
+    path = os.path.join(str(tmp_path), 'product.jpg')
+    Image.new('RGB', (4000, 2000), (40, 80, 120)).save(path, 'JPEG')
+
+    decoded = []
+    shrink = browse.shrink
+
+    def spy(im, box):
+        decoded.append(im.size)
+        return shrink(im, box)
+
+    monkeypatch.setattr(browse, 'shrink', spy)
+
+    cfg = {'browse_images': {}}
+    paths = browse.build_browse_pyramid(cfg, path)
+
+    # Decoded at 1/2 scale rather than 4000x2000
+    assert decoded[0] == (2000, 1000)
+    assert paths == {'LOW-RES': os.path.join(str(tmp_path), 'product.low.jpg'),
+                     'THUMBNAIL': os.path.join(str(tmp_path), 'product.thumb.png')}
+    assert cfg['browse_images'] == {'LOW-RES': [paths['LOW-RES']], 'THUMBNAIL': [paths['THUMBNAIL']]}
+    assert Image.open(paths['LOW-RES']).size == (512, 256)
+    assert Image.open(paths['THUMBNAIL']).size == (200, 100)
+    assert Image.open(cfg['email_browse']).size == (400, 200)
+
+
+def test_small_png_browse_is_kept(tmp_path, monkeypatch):
+    _config(monkeypatch, low_res_browse_size='1024')
+    path = os.path.join(str(tmp_path), 'product.png')
+    Image.new('P', (600, 300)).save(path, 'PNG')
+
+    cfg = {'browse_images': {'THUMBNAIL': ['existing.thumb.png']}}
+    assert browse.build_browse_pyramid(cfg, path) == {'LOW-RES': path}
+    assert cfg['browse_images']['THUMBNAIL'] == ['existing.thumb.png']
+    assert Image.open(cfg['email_browse']).size == (600, 300)
+
+
+def test_oversized_browse_is_kept(tmp_path, monkeypatch):
+    _config(monkeypatch)
+    path = os.path.join(str(tmp_path), 'product.png')
+    Image.new('RGB', (600, 300)).save(path, 'PNG')
+    monkeypatch.setattr(Image, 'MAX_IMAGE_PIXELS', 1000)
+    added = []
+    monkeypatch.setattr('hyp3proclib.add_browse', lambda cfg, type_, path: added.append((type_, path)))
+
+    cfg = {'browse_images': {}, 'email_browse': 'previous.email.jpg'}
+    assert browse.build_browse_pyramid(cfg, path) == {'LOW-RES': path}
+    assert added == [('LOW-RES', path)]
+    assert 'email_browse' not in cfg
+
+
+def test_reproject_image_without_gdal_bindings(monkeypatch):
+    import hyp3proclib
+
+    monkeypatch.setattr(hyp3proclib, 'warp_to_png', lambda in_image, out_image, epsg: False)
+    commands = []
+    monkeypatch.setattr(hyp3proclib, 'execute', lambda cfg, cmd, expected=None: commands.append(cmd))
+
+    assert hyp3proclib.reproject_image({}, 'browse.png', 'browse_merc.png', 3857)
+    assert commands == [
+        'gdalwarp -t_srs EPSG:3857 browse.png browse_merc.tif',
+        'gdal_translate -of PNG browse_merc.tif browse_merc.png',
+    ]
+
+
+def test_warp_to_png(tmp_path):
+    gdal = pytest.importorskip('osgeo.gdal')
+    from osgeo import osr
+
+    in_image = os.path.join(str(tmp_path), 'browse.tif')
+    ds = gdal.GetDriverByName('GTiff').Create(in_image, 64, 64, 1, gdal.GDT_Byte)
+    ds.SetGeoTransform((-147.8, 0.01, 0, 64.9, 0, -0.01))
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    ds.SetProjection(srs.ExportToWkt())
+    ds = None
+
+    out_image = os.path.join(str(tmp_path), 'browse_merc.png')
+    use_exceptions = gdal.GetUseExceptions()
+    assert browse.warp_to_png(in_image, out_image, 3857)
+    assert gdal.GetUseExceptions() == use_exceptions
+    assert os.path.isfile(out_image)
+    assert not os.path.exists(os.path.join(str(tmp_path), 'browse_merc.tif'))
+
+    # The georeferencing goes in the PNG's sidecar
+    assert os.path.isfile(out_image + '.aux.xml')
+    ds = gdal.Open(out_image)
+    assert '3857' in ds.GetProjection()
+    assert ds.GetGeoTransform() != (0, 1, 0, 0, 0, 1)
+    ds = None
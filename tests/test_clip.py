@@ -0,0 +1,32 @@
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import os
+
+import hyp3proclib
+
+
+def _fake_clip(conn, cfg, path, shapefile=None):
+    assert shapefile == os.path.join(os.path.dirname(path), 'roi.shp')
+    with open(path + '.clipped', 'w') as f:
+        f.write(str(os.getpid()))
+
+
+def test_clip_tiffs_to_roi(tmp_path, monkeypatch):
+    monkeypatch.setattr(hyp3proclib, 'generate_shapefile', lambda conn, cfg, shapefile: None)
+    for name in ('clip_geotiff', 'clip_geo_jpg', 'clip_geo_png'):
+        monkeypatch.setattr(hyp3proclib, name, _fake_clip)
+
+    path = str(tmp_path)
+    for name in ('VV.tif', 'VH.tif', 'browse.jpg', 'browse.jpg.aux.xml', 'browse_large.png', 'other.png'):
+        open(os.path.join(path, name), 'w').close()
+
+    cfg = {'crop_to_selection': True, 'workdir': path, 'clip_workers': 2}
+    timings = hyp3proclib.clip_tiffs_to_roi(cfg, None, path)
+
+    clipped = sorted(os.path.basename(f) for f in timings)
+    assert clipped == ['VH.tif', 'VV.tif', 'browse.jpg']
+    pids = set()
+    for name in clipped:
+        with open(os.path.join(path, name + '.clipped')) as f:
+            pids.add(int(f.read()))
+    assert os.getpid() not in pids
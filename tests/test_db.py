@@ -0,0 +1,150 @@
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import os
+import time
+
+import psycopg2
+import pytest
+
+from conftest import FakeConnection
+from hyp3proclib import db
+
+
+def test_get_db_configs(fake_connection):
+    fake_connection.results = [[
+        ('config', 'product_hash_type', 'md5'),
+        ('config', 'jers_whitelist', ''),
+        ('process', 'rtc_gamma', '1'),
+        ('process', 'notify', '5'),
+    ]]
+
+    config, process_ids = db.get_db_configs(fake_connection, ['product_hash_type', 'jers_whitelist'])
+
+    assert len(fake_connection.queries) == 1
+    assert config == {'product_hash_type': 'md5'}
+    assert process_ids == {'rtc_gamma': 1, 'notify': 5}
+
+
+def test_load_db_configs_cache(tmp_path, monkeypatch, fake_connection):
+    rows = [('config', 'product_hash_type', 'md5'), ('process', 'rtc_gamma', '1')]
+    fake_connection.results = [rows, rows]
+    monkeypatch.setattr(db, 'get_db_connection', lambda s: fake_connection)
+    cache_file = os.path.join(str(tmp_path), 'db_config.json')
+
+    first = db.load_db_configs(['product_hash_type'], cache_file=cache_file, ttl=60)
+    second = db.load_db_configs(['product_hash_type'], cache_file=cache_file, ttl=60)
+
+    assert first == second == ({'product_hash_type': 'md5'}, {'rtc_gamma': 1})
+    assert len(fake_connection.queries) == 1
+
+    # Keys not covered by the cache force a reload
+    db.load_db_configs(['product_hash_type', 'bucket_lifecycle'], cache_file=cache_file, ttl=60)
+    assert len(fake_connection.queries) == 2
+
+
+def test_transaction_commits_once(fake_connection):
+    with db.transaction(fake_connection):
+        db.query_database(fake_connection, 'update local_queue set status = %s', ('COMPLETE',), commit=True)
+        db.query_database(fake_connection, 'select id from products')
+        db.query_database(fake_connection, 'insert into email_queue default values', commit=True)
+
+    assert fake_connection.commits == 1
+    assert fake_connection.rollbacks == 0
+
+    with pytest.raises(ValueError):
+        with db.transaction(fake_connection):
+            db.query_database(fake_connection, 'update local_queue set status = %s', ('COMPLETE',), commit=True)
+            raise ValueError('upload failed')
+
+    assert fake_connection.commits == 1
+    assert fake_connection.rollbacks == 1
+    assert not db.in_transaction(fake_connection)
+
+
+def test_nested_transaction_uses_savepoint(fake_connection):
+    with db.transaction(fake_connection):
+        try:
+            with db.transaction(fake_connection):
+                raise ValueError('instance record failed')
+        except ValueError:
+            pass
+        db.query_database(fake_connection, 'update local_queue set status = %s', ('COMPLETE',), commit=True)
+
+    sent = [q for q, _ in fake_connection.queries]
+    assert sent[:2] == ['SAVEPOINT hyp3proclib_1', 'ROLLBACK TO SAVEPOINT hyp3proclib_1']
+    assert fake_connection.commits == 1
+    assert fake_connection.rollbacks == 0
+
+
+def test_stream_query(fake_connection):
+    fake_connection.results = [[(n,) for n in range(5)]]
+
+    rows = db.stream_query(fake_connection, 'select id from email_queue', fetch_size=2)
+    assert next(rows) == (0,)
+    assert fake_connection.fetches == [2]
+
+    assert list(rows) == [(1,), (2,), (3,), (4,)]
+    assert fake_connection.fetches == [2, 2, 2, 2]
+    assert fake_connection.rollbacks == 1
+
+
+class DroppableConnection(FakeConnection):
+    dropped = False
+    status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def get_transaction_status(self):
+        return self.status
+
+    def rollback(self):
+        super(DroppableConnection, self).rollback()
+        self.status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def cursor(self, name=None, withhold=False):
+        if self.dropped:
+            raise psycopg2.OperationalError('server closed the connection unexpectedly')
+        return super(DroppableConnection, self).cursor(name, withhold)
+
+
+def test_dropped_connection_is_replaced(monkeypatch):
+    config = {'reuse_db_connections': 'yes', 'db_ping_interval': '0'}
+    monkeypatch.setattr(db, 'get_config', lambda section, key, default=None: config.get(key, 'test'))
+    monkeypatch.setattr(db, '_connections', type(db._connections)())
+    opened = []
+
+    def connect(dsn, connection_factory=None):
+        opened.append(DroppableConnection())
+        return opened[-1]
+
+    monkeypatch.setattr(psycopg2, 'connect', connect)
+
+    first = db.get_db_connection('hyp3-db')
+    assert db.get_db_connection('hyp3-db') is first
+    assert first.queries == [('SELECT 1', None)]
+
+    first.dropped = True
+    second = db.get_db_connection('hyp3-db')
+    assert second is not first
+    assert first.closed
+    assert len(opened) == 2
+
+
+def test_aborted_connection_is_rolled_back(monkeypatch):
+    config = {'reuse_db_connections': 'yes', 'db_ping_interval': '30'}
+    monkeypatch.setattr(db, 'get_config', lambda section, key, default=None: config.get(key, 'test'))
+    monkeypatch.setattr(db, '_connections', type(db._connections)())
+    monkeypatch.setattr(psycopg2, 'connect', lambda dsn, connection_factory=None: DroppableConnection())
+
+    conn = db.get_db_connection('hyp3-db')
+    conn.checked_at = time.time()
+    conn.status = psycopg2.extensions.TRANSACTION_STATUS_INERROR
+    assert db.get_db_connection('hyp3-db') is conn
+    assert conn.rollbacks == 1
+    assert conn.status == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    # Not while a transaction() block owns it
+    conn.status = psycopg2.extensions.TRANSACTION_STATUS_INERROR
+    with pytest.raises(ValueError):
+        with db.transaction(conn):
+            assert db.get_db_connection('hyp3-db') is conn
+            assert conn.rollbacks == 1
+            raise ValueError
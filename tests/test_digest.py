@@ -0,0 +1,69 @@
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import datetime
+
+from hyp3proclib import digest, emailer, queries
+
+
+def test_notify_user_records_event(fake_connection):
+    cfg = {'id': 42, 'user_id': 3, 'sub_id': 12, 'filename': 'product.zip', 'digest_window': 3600}
+    emailer.notify_user('https://example.com/product.zip', 12, cfg, fake_connection)
+
+    assert len(fake_connection.queries) == 1
+    sql, params = fake_connection.queries[0]
+    assert 'insert into notification_events' in sql
+    assert params['product_url'] == 'https://example.com/product.zip'
+
+
+def test_send_digests(fake_connection, monkeypatch):
+    monkeypatch.setattr(queries, 'use_prepared_statements', lambda: False)
+    monkeypatch.setattr(digest, 'get_db_connection', lambda s: fake_connection)
+
+    t = datetime.datetime(2020, 1, 1)
+    fake_connection.results = [
+        [
+            (3, 12, 42, 'https://example.com/b.zip', 'b.zip', t + datetime.timedelta(hours=1)),
+            (5, 20, 50, 'https://example.com/c.zip', 'c.zip', t),
+            (3, 12, 41, 'https://example.com/a.zip', 'a.zip', t),
+        ],
+        [('alice', 'alice@example.com', True, 'Track 64', 'RTC GAMMA', 7, 'abc123')],
+        [],
+        [('bob', 'bob@example.com', True, 'Track 65', 'RTC GAMMA', 8, 'def456')],
+        [],
+    ]
+    cfg = {'digest_window': 3600, 'subject_prefix': 'HyP3', 'hyp3_product_url': 'https://hyp3.asf.alaska.edu'}
+
+    assert digest.send_digests(cfg) == 2
+
+    assert fake_connection.queries[0][1] == {'window': 3600}
+    assert fake_connection.queries[1][1]['params'] == '12'
+    assert fake_connection.queries[1][1]['user_id'] == 3
+    alice = fake_connection.queries[2][1]
+    assert alice['recipients'] == 'alice@example.com'
+    assert alice['subject'] == "[HyP3] 2 new product(s) for subscription 'Track 64'"
+    assert alice['message'].index('a.zip') < alice['message'].index('b.zip')
+    assert 'disable_subscription?id=7&key=abc123' in alice['message']
+    assert fake_connection.queries[4][1]['recipients'] == 'bob@example.com'
+    # Everything is committed together
+    assert fake_connection.commits == 1
+
+
+def test_digest_of_deleted_subscription_is_dropped(fake_connection, monkeypatch):
+    monkeypatch.setattr(queries, 'use_prepared_statements', lambda: False)
+    monkeypatch.setattr(digest, 'get_db_connection', lambda s: fake_connection)
+
+    t = datetime.datetime(2020, 1, 1)
+    fake_connection.results = [
+        [
+            (3, 12, None, 'https://example.com/a.zip', 'a.zip', t),
+            (5, 20, 50, 'https://example.com/c.zip', 'c.zip', t),
+        ],
+        [],
+        [('bob', 'bob@example.com', True, 'Track 65', 'RTC GAMMA', 8, 'def456')],
+        [],
+    ]
+    cfg = {'digest_window': 3600, 'subject_prefix': 'HyP3', 'hyp3_product_url': 'https://hyp3.asf.alaska.edu'}
+
+    assert digest.send_digests(cfg) == 1
+    assert fake_connection.queries[3][1]['recipients'] == 'bob@example.com'
+    assert fake_connection.commits == 1
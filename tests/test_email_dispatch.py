@@ -0,0 +1,79 @@
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import time
+
+from hyp3proclib import email_dispatch
+
+
+def _dispatcher(monkeypatch, fake_smtp, bcc='', **kwargs):
+    config = {'smtp_host': '127.0.0.1', 'smtp_port': str(fake_smtp.port), 'bcc': bcc}
+    monkeypatch.setattr(email_dispatch, 'get_config', lambda section, key, default=None: config.get(key, default))
+    return email_dispatch.EmailDispatcher(**kwargs)
+
+
+def test_dispatch(monkeypatch, fake_smtp, fake_connection):
+    fake_smtp.refuse.add('nobody@example.com')
+    dispatcher = _dispatcher(monkeypatch, fake_smtp, workers=2, batch_size=3)
+
+    rows = [(n, 100 + n, 'user{0}@example.com'.format(n), 'Subject {0}'.format(n), '<p>Body') for n in range(1, 5)]
+    rows.append((5, None, 'nobody@example.com', 'Subject 5', '<p>Body'))
+    rows.append((6, None, '', 'No recipient', '<p>Body'))
+    try:
+        assert dispatcher.dispatch(fake_connection, iter(rows)) == 6
+    finally:
+        dispatcher.close()
+
+    assert len(fake_smtp.messages) == 4
+    # Sessions are reused rather than opened per message
+    assert fake_smtp.connections <= 2
+
+    updates = [params for sql, params in fake_connection.queries]
+    assert [len(p) // 3 for p in updates] == [3, 3]
+    statuses = dict((p[i], p[i + 1]) for p in updates for i in range(0, len(p), 3))
+    assert statuses == {1: 'SENT', 2: 'SENT', 3: 'SENT', 4: 'SENT', 5: 'FAILED', 6: 'FAILED'}
+
+
+def test_reconnect_after_dropped_session(monkeypatch, fake_smtp):
+    dispatcher = _dispatcher(monkeypatch, fake_smtp, bcc='audit@example.com', workers=1)
+    try:
+        assert dispatcher.send('one@example.com', 'One', '<p>Body') == (True, None)
+        fake_smtp.drop_connections()
+        assert dispatcher.send('two@example.com', 'Two', '<p>Body') == (True, None)
+    finally:
+        dispatcher.close()
+
+    assert [rcpts for _, rcpts, _ in fake_smtp.messages] == [
+        ['one@example.com', 'audit@example.com'], ['two@example.com', 'audit@example.com']
+    ]
+    assert fake_smtp.connections == 2
+
+
+def test_rate_limiter():
+    limiter = email_dispatch.RateLimiter(50)
+    start = time.time()
+    for _ in range(6):
+        limiter.wait()
+    assert time.time() - start >= 5 / 50.0
+
+
+def test_drain_claims_batches(monkeypatch, fake_smtp, fake_connection):
+    dispatcher = _dispatcher(monkeypatch, fake_smtp, workers=2, batch_size=2)
+
+    fake_connection.results = [
+        [(7,)],  # reclaimed
+        [(1, 10, 'one@example.com', 'One', '<p>Body'), (2, 11, '', 'No recipient', '<p>Body')],
+        [],  # statuses
+        [(3, 12, 'three@example.com', 'Three', '<p>Body')],
+        [],  # statuses
+        [],  # nothing left to claim
+    ]
+    try:
+        assert dispatcher.drain(fake_connection) == 3
+    finally:
+        dispatcher.close()
+
+    assert len(fake_smtp.messages) == 2
+    sent = [sql for sql, _ in fake_connection.queries]
+    assert 'SENDING' in sent[0] and 'lease_expires < current_timestamp' in sent[0]
+    assert sum('for update skip locked' in sql for sql in sent) == 3
+    assert fake_connection.queries[2][1] == [2, 'FAILED', 'No recipients', 1, 'SENT', None]
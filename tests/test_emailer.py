@@ -0,0 +1,31 @@
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+from hyp3proclib import emailer, queries
+
+
+def test_notify_user(fake_connection, monkeypatch):
+    monkeypatch.setattr(queries, 'use_prepared_statements', lambda: False)
+    fake_connection.results = [[('alice', 'alice@example.com', True, 'Track 64', 'RTC GAMMA', 7, 'abc123')]]
+
+    cfg = {
+        'id': 42, 'user_id': 3, 'sub_id': 12, 'subject_prefix': 'HyP3', 'filename': 'product.zip',
+        'granule': 'S1A_IW_GRDH_1SDV', 'hyp3_product_url': 'https://hyp3.asf.alaska.edu',
+        'browse_url': 'https://example.com/product.png', 'email_browse_url': 'https://example.com/product.email.jpg',
+    }
+    emailer.notify_user('https://example.com/product.zip', 12, cfg, fake_connection)
+
+    # User lookup and one-time hash in one query, then the email
+    assert len(fake_connection.queries) == 2
+    lookup = fake_connection.queries[0][1]
+    assert (lookup['id'], lookup['want_hash'], lookup['params']) == (42, True, '12')
+
+    email = fake_connection.queries[1][1]
+    assert email['recipients'] == 'alice@example.com'
+    assert email['subject'] == "[HyP3] New product for subscription 'Track 64'"
+    assert email['message'].startswith(emailer.get_email_header(
+        "A new 'RTC GAMMA' product for your subscription 'Track 64' is ready."))
+    assert email['message'].endswith(emailer.get_email_footer())
+    assert '<p>Hello alice!' in email['message']
+    assert 'disable_subscription?id=7&key=abc123' in email['message']
+    assert ('<a href="https://example.com/product.png"><img src="https://example.com/product.email.jpg"'
+            in email['message'])
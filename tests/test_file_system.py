@@ -0,0 +1,76 @@
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import os
+import time
+
+import pytest
+
+from hyp3proclib import file_system
+
+
+def _cfg(tmp_path, slots=1):
+    return {'proc_name': 'test_proc', 'lock_dir': str(tmp_path), 'lock_slots': slots}
+
+
+def test_lock_slots(tmp_path):
+    first = _cfg(tmp_path, slots=2)
+    second = _cfg(tmp_path, slots=2)
+    third = _cfg(tmp_path, slots=2)
+
+    file_system.check_lockfile(first)
+    file_system.check_lockfile(second)
+    assert first['lock_slot'] == 0
+    assert second['lock_slot'] == 1
+    assert os.path.basename(first['lock_file']) == 'test_proc.lock'
+
+    with pytest.raises(SystemExit):
+        file_system.check_lockfile(third)
+
+    file_system.cleanup_lockfile(first)
+    assert not os.path.exists(first['lock_file'])
+
+    file_system.check_lockfile(third)
+    assert third['lock_slot'] == 0
+
+    file_system.cleanup_lockfile(second)
+    file_system.cleanup_lockfile(third)
+
+
+def test_stale_lockfile_is_reclaimed(tmp_path):
+    # Left behind by a worker that died without cleaning up
+    with open(os.path.join(str(tmp_path), 'test_proc.lock'), 'w') as f:
+        f.write('99999999')
+
+    cfg = _cfg(tmp_path)
+    file_system.check_lockfile(cfg)
+    with open(cfg['lock_file']) as f:
+        assert f.read() == str(os.getpid())
+
+    file_system.cleanup_lockfile(cfg)
+
+
+def test_check_stop(tmp_path):
+    stopfile = os.path.join(str(tmp_path), 'stop')
+    with open(stopfile, 'w'):
+        pass
+    os.utime(stopfile, (time.time() - 60, time.time() - 60))
+
+    cfg = _cfg(tmp_path)
+    file_system.check_lockfile(cfg)
+
+    # Stop file older than the lock is ignored
+    file_system.check_stop(cfg)
+
+    os.utime(stopfile, (time.time() + 1, time.time() + 1))
+    with pytest.raises(SystemExit):
+        file_system.check_stop(cfg)
+    assert not os.path.exists(cfg['lock_file'])
+
+
+def test_check_stop_lockfile_removed(tmp_path):
+    cfg = _cfg(tmp_path)
+    file_system.check_lockfile(cfg)
+    os.unlink(cfg['lock_file'])
+
+    with pytest.raises(SystemExit):
+        file_system.check_stop(cfg)
@@ -0,0 +1,40 @@
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import subprocess
+import sys
+
+# Cumulative `import hyp3proclib` time budget, in microseconds, as reported by
+# `python -X importtime`. Generous enough for a cold CI runner; the heavy
+# dependencies below blow well past it on their own.
+IMPORT_TIME_BUDGET_US = 500000
+
+# Must only be imported when the functions that need them are called
+HEAVY_MODULES = ('boto3', 'botocore', 'PIL', 'psycopg2', 'requests', 'osgeo')
+
+
+def _import_times(module):
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True,
+    )
+
+    times = dict()
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def test_import_hyp3proclib_is_lazy():
+    times = _import_times('hyp3proclib')
+
+    heavy = [name for name in times if name.split('.')[0] in HEAVY_MODULES]
+    assert heavy == []
+
+
+def test_import_hyp3proclib_time_budget():
+    times = _import_times('hyp3proclib')
+
+    assert times['hyp3proclib'] < IMPORT_TIME_BUDGET_US
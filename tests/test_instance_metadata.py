@@ -0,0 +1,61 @@
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import socket
+
+import pytest
+
+from hyp3proclib import instance_metadata
+
+
+def test_get_instance_identity(fake_metadata, monkeypatch):
+    monkeypatch.setattr(instance_metadata, '_identity', None)
+    client = instance_metadata.MetadataClient(base_url=fake_metadata.url)
+
+    identity = instance_metadata.get_instance_identity(client, node_type='CLOUD')
+    assert identity == {'instance_id': 'i-0123456789abcdef0', 'instance_type': 'c5.xlarge'}
+
+    # Fetched once per process, with one token for both lookups
+    assert instance_metadata.get_instance_identity(client, node_type='CLOUD') is identity
+    assert fake_metadata.gets('meta-data/instance-id') == 1
+    assert fake_metadata.requests.count(('PUT', '/latest/api/token')) == 1
+
+
+def test_metadata_client_refreshes_rejected_token(fake_metadata):
+    client = instance_metadata.MetadataClient(base_url=fake_metadata.url)
+    assert client.get('meta-data/instance-type') == 'c5.xlarge'
+
+    fake_metadata.token = 'rotated-token'
+    assert client.get('meta-data/instance-type') == 'c5.xlarge'
+    assert client.get('meta-data/spot/instance-action') is None
+
+
+def _unreachable_client():
+    # Nothing listening here
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+
+    return instance_metadata.MetadataClient(
+        base_url='http://127.0.0.1:{0}/latest'.format(port), timeout=0.5, retries=1
+    )
+
+
+def test_get_instance_identity_on_prem(monkeypatch):
+    monkeypatch.setattr(instance_metadata, '_identity', None)
+
+    identity = instance_metadata.get_instance_identity(_unreachable_client(), node_type='ON-PREM')
+    assert identity == {'instance_id': socket.gethostname(), 'instance_type': 'on-prem'}
+    assert instance_metadata._identity is None
+
+
+def test_get_instance_identity_cloud_failure_not_cached(fake_metadata, monkeypatch):
+    monkeypatch.setattr(instance_metadata, '_identity', None)
+
+    with pytest.raises(Exception):
+        instance_metadata.get_instance_identity(_unreachable_client(), node_type='CLOUD')
+    assert instance_metadata._identity is None
+
+    client = instance_metadata.MetadataClient(base_url=fake_metadata.url)
+    identity = instance_metadata.get_instance_identity(client, node_type='CLOUD')
+    assert identity == {'instance_id': 'i-0123456789abcdef0', 'instance_type': 'c5.xlarge'}
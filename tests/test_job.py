@@ -0,0 +1,57 @@
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+from hyp3proclib.file_system import cleanup_env
+from hyp3proclib.job import JobConfig, JobRecord, use_job
+
+ROW = (
+    'S1A_IW_SLC__1SDV_20200101T000000', 'https://example.com/one.zip', 'S1B_TWO,S1B_THREE', None, '7',
+    None, 20, 10,
+    None, None, 'someone', 3, 'RTC GAMMA', '-rtc', 1,
+    None, None, None, None,
+    None, None, None,
+    12.0,
+    '{"resolution": "10m"}', None,
+)
+
+
+def test_job_record_from_row():
+    job = JobRecord.from_row(ROW)
+
+    assert job.id == 7
+    assert job.sub_name == 'One-Time'
+    assert job.sub_id == 0
+    assert (job.min_lat, job.max_lat) == (-90.0, 90.0)
+    assert job.project_id == -1
+    assert job.attempts == 0
+    assert job.other_granules == ['S1B_TWO', 'S1B_THREE']
+    assert job.other_granule_urls is None
+    assert job.extra_arguments == {'resolution': '10m'}
+    assert job.extra_arguments is job.extra_arguments
+
+
+def test_job_config_view():
+    cfg = JobConfig(proc_name='rtc_gamma', workdir='/tmp', original_workdir='/tmp')
+    assert 'granule' not in cfg
+
+    use_job(cfg, JobRecord.from_row(ROW))
+    assert cfg['granule'] == ROW[0]
+    assert 'extra_arguments' in cfg
+    assert cfg.get('sub_id') == 0
+    assert cfg['proc_name'] == 'rtc_gamma'
+
+    cfg['description'] = 'overridden'
+    assert cfg['description'] == 'overridden'
+
+    cleanup_env(cfg)
+    assert cfg['granule'] is None
+    assert cfg['id'] is None
+    assert 'extra_arguments' not in cfg
+    assert cfg.get('description') is None
+
+
+def test_use_job_plain_dict():
+    cfg = dict()
+    use_job(cfg, JobRecord.from_row(ROW))
+
+    assert cfg['id'] == 7
+    assert cfg['other_granules'] == ['S1B_TWO', 'S1B_THREE']
@@ -0,0 +1,56 @@
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+from hyp3proclib import lease
+
+
+CFG = {'retry_max_attempts': 2, 'retry_backoff': 300, 'retry_max_backoff': 21600}
+
+
+def test_reap_expired_leases(fake_connection):
+    fake_connection.results = [[(3, 'RETRY'), (7, 'RETRY')]]
+
+    ids = lease.reap_expired_leases(fake_connection, CFG)
+
+    assert ids == [3, 7]
+    (reap_sql, reap_params), (records_sql, records_params) = fake_connection.queries
+    assert "status = 'PROCESSING' and lease_expires < current_timestamp" in reap_sql
+    assert 'attempts = coalesce(attempts, 0) + 1' in reap_sql
+    assert reap_params == {'status': 'RETRY', 'max_attempts': 2, 'backoff': 300, 'max_backoff': 21600}
+    assert 'update instance_records' in records_sql
+    assert records_params == {'ids': [3, 7]}
+
+
+def test_reap_fails_jobs_out_of_attempts(fake_connection, caplog):
+    fake_connection.results = [[(3, 'RETRY'), (7, 'FAILED')]]
+
+    assert lease.reap_expired_leases(fake_connection, CFG) == [3, 7]
+
+    reap_sql = fake_connection.queries[0][0]
+    assert "when coalesce(attempts, 0) + 1 >= %(max_attempts)s then 'FAILED'" in reap_sql
+    # Both still have their instance records closed
+    assert fake_connection.queries[1][1] == {'ids': [3, 7]}
+    assert 'lost their lease 2 times: [7]' in caplog.text
+
+
+def test_reap_nothing_expired(fake_connection):
+    assert lease.reap_expired_leases(fake_connection, CFG, status='QUEUED') == []
+    assert len(fake_connection.queries) == 1
+
+
+def test_heartbeat(fake_connection, monkeypatch):
+    # Two successful extensions, then the job is no longer ours
+    fake_connection.results = [[(1,)], [(1,)], []]
+    monkeypatch.setattr(lease, 'get_db_connection', lambda s: fake_connection)
+
+    cfg = {'id': 42, 'lease_seconds': 300, 'heartbeat_interval': 0.01}
+    lease.start_heartbeat(cfg)
+    heartbeat = cfg['heartbeat']
+    heartbeat.join(timeout=10)
+
+    assert not heartbeat.is_alive()
+    assert len(fake_connection.queries) == 3
+    assert fake_connection.queries[0][1] == {'id': 42, 'lease': 300}
+    assert fake_connection.closed
+
+    lease.stop_heartbeat(cfg)
+    assert 'heartbeat' not in cfg
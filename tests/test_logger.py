@@ -0,0 +1,84 @@
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import json
+import os
+from logging.handlers import QueueHandler
+
+import hyp3proclib
+from hyp3proclib import instance_metadata, logger
+from hyp3proclib.logger import clear_log_context, log, set_log_context, setup_logger, shutdown_logger
+
+
+class Recorder(object):
+    def __init__(self):
+        self.calls = 0
+
+    def __str__(self):
+        self.calls += 1
+        return 'recorded'
+
+
+def test_setup_logger_is_idempotent(tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(hyp3proclib, 'default_log_dir', str(tmp_path))
+    cfg = {'write_log_file': True, 'proc_name': 'test'}
+
+    try:
+        setup_logger(cfg, False)
+        setup_logger(cfg, False)
+        assert len([h for h in log.handlers if isinstance(h, QueueHandler)]) == 1
+
+        recorder = Recorder()
+        log.debug('Not written: %s', recorder)
+        log.info('Written: %s', 'once')
+        assert recorder.calls == 0
+    finally:
+        shutdown_logger()
+
+    assert capsys.readouterr().out.count('Written: once') == 1
+    with open(os.path.join(str(tmp_path), 'test.log')) as f:
+        assert f.read().count('Written: once') == 1
+    assert not any(isinstance(h, QueueHandler) for h in log.handlers)
+
+
+def test_forked_child_logs_directly(tmp_path, monkeypatch):
+    monkeypatch.setattr(hyp3proclib, 'default_log_dir', str(tmp_path))
+
+    try:
+        setup_logger({'write_log_file': True, 'proc_name': 'test'}, False)
+        handlers = list(logger._listener.handlers)
+        logger._log_directly_after_fork()
+        assert handlers == [h for h in log.handlers if not isinstance(h, QueueHandler)]
+    finally:
+        for handler in handlers:
+            log.removeHandler(handler)
+            handler.close()
+        shutdown_logger()
+
+
+def test_json_records_carry_job_context(monkeypatch, capsys):
+    monkeypatch.setattr(instance_metadata, 'get_instance_identity', lambda node_type=None: {'instance_id': 'i-0123'})
+    cfg = {'write_log_file': False, 'proc_name': 'rtc_gamma', 'log_format': 'json'}
+
+    try:
+        setup_logger(cfg, False)
+        set_log_context(local_queue_id=42, granule='S1A_TEST', stage='process')
+        log.info('Processing %s', 'S1A_TEST')
+        try:
+            raise ValueError('bad input')
+        except ValueError:
+            log.exception('Failed')
+    finally:
+        clear_log_context()
+        shutdown_logger()
+
+    records = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert records[0]['message'] == 'Processing S1A_TEST'
+    assert records[0]['level'] == 'INFO'
+    assert records[0]['time'].endswith('Z')
+    for record in records:
+        assert {k: record[k] for k in ('proc_name', 'instance_id', 'local_queue_id', 'granule', 'stage')} == {
+            'proc_name': 'rtc_gamma', 'instance_id': 'i-0123', 'local_queue_id': 42, 'granule': 'S1A_TEST',
+            'stage': 'process',
+        }
+    assert records[1]['message'] == 'Failed'
+    assert 'ValueError: bad input' in records[1]['exception']
@@ -0,0 +1,49 @@
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import os
+
+import hyp3proclib
+from hyp3proclib import prefetch
+
+
+def _claim(cfg, exit=True, make_workdir=True, stop_check=True):
+    claimed = _claim.jobs.pop(0) if _claim.jobs else None
+    if claimed is None:
+        return False
+    cfg['id'], cfg['granule'] = claimed
+    return True
+
+
+def test_prefetch(tmp_path, monkeypatch, fake_connection):
+    _claim.jobs = [(1, 'S1A_ONE'), (2, 'S1A_TWO'), (3, 'S1A_THREE')]
+    monkeypatch.setattr(hyp3proclib, 'get_queue_item', _claim)
+    released = []
+    monkeypatch.setattr(
+        hyp3proclib, 'update_queue_status', lambda conn, cfg, status: released.append((cfg['id'], status))
+    )
+    monkeypatch.setattr(prefetch, 'get_db_connection', lambda s: fake_connection)
+
+    cfg = {
+        'id': 99, 'granule': 'S1A_RUNNING', 'proc_name': 'test_prefetch', 'retry': False,
+        'user_workdir': False, 'workdir': str(tmp_path), 'original_workdir': str(tmp_path),
+        'browse_lat_min': 10.0, 'heartbeat': object(),
+    }
+    prefetcher = prefetch.JobPrefetcher(cfg, depth=2)
+    prefetcher.start()
+
+    job = prefetcher.next_job()
+    assert (job['id'], job['granule']) == (1, 'S1A_ONE')
+    assert os.path.isdir(job['workdir'])
+    assert job['browse_lat_min'] is None
+    assert 'heartbeat' not in job
+    # The running job is untouched
+    assert cfg['id'] == 99
+
+    # Depth is bounded by the jobs still wanted
+    prefetcher.remaining = 1
+    prefetcher.start()
+    prefetcher.release()
+
+    assert released == [(2, 'QUEUED')]
+    assert _claim.jobs == [(3, 'S1A_THREE')]
+
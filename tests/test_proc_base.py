@@ -0,0 +1,86 @@
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import pytest
+
+import hyp3proclib
+from hyp3proclib import prefetch, proc_base
+
+
+class StopDaemon(Exception):
+    pass
+
+
+def test_daemon_idle_backoff(tmp_path, monkeypatch):
+    sleeps = []
+
+    def fake_sleep(seconds):
+        sleeps.append(seconds)
+        if len(sleeps) == 5:
+            raise StopDaemon()
+
+    monkeypatch.setattr(proc_base, 'get_queue_item', lambda cfg, exit: False)
+    monkeypatch.setattr(proc_base.time, 'sleep', fake_sleep)
+    monkeypatch.setattr(proc_base.signal, 'signal', lambda signum, handler: None)
+    monkeypatch.chdir(tmp_path)
+
+    processor = proc_base.Processor('test_daemon', lambda cfg, n: None)
+    processor.cfg = {
+        'daemon_idle_sleep': 5.0, 'daemon_max_idle_sleep': 30.0, 'db_config_ttl': 0,
+        'original_workdir': str(tmp_path), 'workdir': str(tmp_path),
+    }
+
+    with pytest.raises(StopDaemon):
+        processor._process_forever()
+
+    assert sleeps == [5.0, 10.0, 20.0, 30.0, 30.0]
+
+
+def test_stop_returns_prefetched_job(tmp_path, monkeypatch, fake_connection):
+    released = []
+    monkeypatch.setattr(
+        hyp3proclib, 'update_queue_status', lambda conn, cfg, status: released.append((cfg['id'], status))
+    )
+    monkeypatch.setattr(prefetch, 'get_db_connection', lambda s: fake_connection)
+
+    lock_file = tmp_path / 'test_stop.lock'
+    lock_file.write_text('')
+    (tmp_path / 'stop').write_text('')
+    workdir = tmp_path / 'prefetched'
+    workdir.mkdir()
+
+    processor = proc_base.Processor('test_stop', lambda cfg, n: None)
+    processor.cfg = {'lock_file': str(lock_file), 'lock_time': 0}
+    processor.prefetcher = prefetch.JobPrefetcher(processor.cfg, depth=1)
+    processor.prefetcher._jobs.append({'id': 7, 'granule': 'S1A_NEXT', 'retry': False, 'workdir': str(workdir)})
+
+    with pytest.raises(SystemExit):
+        processor._take_prefetched_job()
+    processor.prefetcher.release()
+
+    assert released == [(7, 'QUEUED')]
+    assert not workdir.exists()
+
+
+def test_reload_applies_general_config(tmp_path, monkeypatch):
+    from six.moves.configparser import ConfigParser
+
+    parser = ConfigParser()
+    parser.optionxform = str
+    parser.read_string('[general]\nlease_seconds = 900\nlock_dir = {0}\n'.format(tmp_path / 'elsewhere'))
+    monkeypatch.setattr(hyp3proclib, 'default_cfg', hyp3proclib.default_cfg)
+    monkeypatch.setattr(proc_base, 'init_config', lambda: setattr(hyp3proclib, 'default_cfg', parser))
+    monkeypatch.setattr(proc_base, 'load_db_config', lambda cfg, use_cache: None)
+    loggers = []
+    monkeypatch.setattr(proc_base, 'setup_logger', lambda cfg, verbose: loggers.append(verbose))
+
+    processor = proc_base.Processor('test_reload', lambda cfg, n: None)
+    processor.cfg = {
+        'lock_dir': str(tmp_path), 'lock_slots': 1, 'lease_seconds': 600, 'workdir': str(tmp_path),
+        'user_workdir': False, 'cli_verbose': True, 'db_config_ttl': 0,
+    }
+    processor.reload_requested = True
+    processor._refresh_config()
+
+    assert processor.cfg['lease_seconds'] == 900
+    assert processor.cfg['lock_dir'] == str(tmp_path)
+    assert loggers == [True]
@@ -0,0 +1,89 @@
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import os
+import time
+
+import pytest
+
+from conftest import FakeConnection
+from hyp3proclib import queries
+
+
+def test_placeholders_are_numbered():
+    query = queries.Query('test_named', "select %(a)s, %(b)s, %(a)s where x like 'a%%'")
+    assert query.prepare_sql == "PREPARE test_named AS select $1, $2, $1 where x like 'a%'"
+    assert query.execute_sql == 'EXECUTE test_named (%(a)s, %(b)s)'
+
+    query = queries.Query('test_positional', 'select %s, %s')
+    assert query.prepare_sql == 'PREPARE test_positional AS select $1, $2'
+    assert query.execute_sql == 'EXECUTE test_positional (%s, %s)'
+
+    query = queries.Query('test_no_args', 'select 1')
+    assert query.execute_sql == 'EXECUTE test_no_args'
+
+
+def test_prepared_once_per_connection(fake_connection, monkeypatch):
+    monkeypatch.setattr(queries, 'use_prepared_statements', lambda: True)
+    queries.register_query('test_select', 'select id from local_queue where id = %(id)s')
+
+    fake_connection.results = [[(1,)], [(2,)]]
+    assert queries.execute_query(fake_connection, 'test_select', {'id': 1}) == [(1,)]
+    assert queries.execute_query(fake_connection, 'test_select', {'id': 2}) == [(2,)]
+
+    sent = [q for q, _ in fake_connection.queries]
+    assert sent == [
+        'PREPARE test_select AS select id from local_queue where id = $1',
+        'EXECUTE test_select (%(id)s)',
+        'EXECUTE test_select (%(id)s)',
+    ]
+    assert queries.query_stats()['test_select'][0] == 2
+
+
+def test_falls_back_to_text_when_prepare_fails(fake_connection, monkeypatch):
+    monkeypatch.setattr(queries, 'use_prepared_statements', lambda: True)
+    query = queries.register_query('test_fallback', 'select %(id)s')
+
+    def execute(sql, params=None):
+        if sql.startswith('PREPARE'):
+            raise Exception('prepared statements not supported')
+        fake_connection.queries.append((sql, params))
+
+    cursor = fake_connection.cursor()
+    cursor.execute = execute
+    fake_connection.cursor = lambda: cursor
+
+    queries.execute_query(fake_connection, 'test_fallback', {'id': 1})
+    queries.execute_query(fake_connection, 'test_fallback', {'id': 2})
+    assert fake_connection.queries == [('select %(id)s', {'id': 1}), ('select %(id)s', {'id': 2})]
+
+    # Only that connection falls back
+    other = FakeConnection()
+    queries.execute_query(other, 'test_fallback', {'id': 3})
+    assert [q for q, _ in other.queries] == [query.prepare_sql, query.execute_sql]
+
+
+@pytest.mark.skipif('HYP3PROCLIB_TEST_DSN' not in os.environ,
+                    reason='set HYP3PROCLIB_TEST_DSN to benchmark against a database')
+def test_prepared_statement_benchmark(monkeypatch):
+    import psycopg2
+
+    sql = '''
+        select n, md5(n::text) from generate_series(1, 20) n
+        where n > %(low)s and n < %(high)s order by n
+    '''
+    queries.register_query('test_benchmark', sql)
+    conn = psycopg2.connect(os.environ['HYP3PROCLIB_TEST_DSN'])
+    params = {'low': 2, 'high': 18}
+
+    def timed(prepared):
+        monkeypatch.setattr(queries, 'use_prepared_statements', lambda: prepared)
+        start = time.time()
+        for _ in range(500):
+            rows = queries.execute_query(conn, 'test_benchmark', params)
+        assert len(rows) == 15
+        return time.time() - start
+
+    plain, prepared = timed(False), timed(True)
+    conn.close()
+    # Generous, so scheduling noise doesn't fail the run; prepared is usually faster
+    assert prepared <= plain * 1.5
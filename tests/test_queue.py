@@ -0,0 +1,105 @@
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import pytest
+
+import hyp3proclib
+
+
+@pytest.fixture
+def status_updates(monkeypatch, fake_connection):
+    updates = []
+
+    def fake_update(conn, cfg, new_status, msg=None, queue_id=None, retry_delay=None):
+        updates.append((new_status, retry_delay))
+
+    monkeypatch.setattr(hyp3proclib, 'get_db_connection', lambda s, shared=True: fake_connection)
+    monkeypatch.setattr(hyp3proclib, 'update_queue_status', fake_update)
+    monkeypatch.setattr(hyp3proclib, 'notify_user_failure', lambda cfg, conn, msg: None)
+    return updates
+
+
+def _cfg(attempts, retry=False):
+    return {
+        'id': 1, 'granule': 'S1A_IW_GRDH', 'retry': retry, 'attempts': attempts,
+        'retry_max_attempts': 4, 'retry_backoff': 300, 'retry_max_backoff': 1000,
+    }
+
+
+def test_retry_delay():
+    cfg = _cfg(0)
+    assert [hyp3proclib.retry_delay(cfg, n) for n in range(4)] == [300, 600, 1000, 1000]
+
+
+def test_failure_schedules_retry(status_updates):
+    hyp3proclib.failure(_cfg(0), 'Could not download orbit')
+    hyp3proclib.failure(_cfg(1, retry=True), 'Could not download orbit')
+    hyp3proclib.failure(_cfg(3, retry=True), 'Could not download orbit')
+
+    assert status_updates == [('RETRY', 300), ('RETRY', 600), ('FAILED', None)]
+
+
+def test_failure_permanent(status_updates):
+    hyp3proclib.failure(_cfg(0), 'get_dem.py: ERROR: Failed to find a DEM')
+
+    assert status_updates == [('FAILED', None)]
+
+
+def test_failure_uses_its_own_connection(monkeypatch, status_updates):
+    from conftest import FakeConnection
+
+    connections = []
+
+    def get_db_connection(s, shared=True):
+        assert not shared
+        connections.append(FakeConnection())
+        return connections[-1]
+
+    monkeypatch.setattr(hyp3proclib, 'get_db_connection', get_db_connection)
+    hyp3proclib.failure(_cfg(0), 'Could not download orbit')
+
+    assert status_updates == [('RETRY', 300)]
+    assert connections[0].commits == 1
+    assert connections[0].closed
+
+
+def test_claim_drops_previous_job_context(monkeypatch):
+    from hyp3proclib import logger
+
+    def stop(cfg):
+        raise SystemExit
+
+    monkeypatch.setattr(hyp3proclib, 'check_stop', stop)
+    logger.set_log_context(local_queue_id=42, granule='S1A_TEST', stage='process')
+    try:
+        with pytest.raises(SystemExit):
+            hyp3proclib.get_queue_item({})
+        assert logger._thread_context.fields == {'stage': 'claim'}
+    finally:
+        logger.clear_log_context()
+
+
+def test_get_top_queue_items(monkeypatch, fake_connection):
+    fake_connection.results = [[('rtc_gamma', 7), ('insar_gamma', 3)]]
+    monkeypatch.setattr(hyp3proclib, 'get_db_connection', lambda s: fake_connection)
+
+    top = hyp3proclib.get_top_queue_items(num=10, procs=["rtc_gamma", "x'); drop table users; --"])
+
+    assert top == 'rtc_gamma'
+    sql, params = fake_connection.queries[0]
+    assert 'drop table' not in sql
+    assert params == {
+        'status': 'QUEUED', 'num': 10, 'procs': ['rtc_gamma', "x'); drop table users; --"],
+    }
+
+
+def test_get_queue_stats(monkeypatch, fake_connection):
+    fake_connection.results = [[('rtc_gamma', 12, 1.5, 2.0, 10.5, 30.0)]]
+    monkeypatch.setattr(hyp3proclib, 'get_db_connection', lambda s: fake_connection)
+
+    stats = hyp3proclib.get_queue_stats(retry=True)
+
+    assert stats == [{
+        'text_id': 'rtc_gamma', 'depth': 12, 'weighted_depth': 1.5,
+        'age_p50': 2.0, 'age_p90': 10.5, 'age_max': 30.0,
+    }]
+    assert fake_connection.queries[0][1] == {'status': 'RETRY'}
@@ -0,0 +1,91 @@
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import hashlib
+import os
+import shutil
+
+import pytest
+
+from hyp3proclib import queries, roi
+
+WKB = b'\x01\x03\x00\x00\x00'
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(queries, 'use_prepared_statements', lambda: False)
+
+    def fake_write(wkb, srid, shapefile):
+        base = os.path.splitext(shapefile)[0]
+        for ext in ('.shp', '.shx', '.dbf'):
+            with open(base + ext, 'wb') as f:
+                f.write(wkb)
+
+    monkeypatch.setattr(roi, 'write_shapefile', fake_write)
+    monkeypatch.setattr(roi, 'simplify', roi.copy_shapefile)
+    return roi.ShapefileCache(str(tmp_path / 'cache'), size=2)
+
+
+def test_fetched_once_per_geometry(cache, fake_connection, tmp_path):
+    hashval = hashlib.md5(WKB).hexdigest()
+    fake_connection.results = [[(hashval, 4326)], [(memoryview(WKB), 4326)], [(hashval, 4326)]]
+
+    first = cache.get(fake_connection, 7)
+    assert first == os.path.join(cache.cache_dir, '7-' + hashval, 'roi.shp')
+    assert sorted(os.listdir(os.path.dirname(first))) == ['roi.dbf', 'roi.shp', 'roi.shx']
+
+    assert cache.get(fake_connection, 7) == first
+    assert ['ST_AsBinary(location), ' in q for q, _ in fake_connection.queries] == [False, True, False]
+
+    out = str(tmp_path / 'work' / 'roi.shp')
+    os.mkdir(os.path.dirname(out))
+    roi.copy_shapefile(first, out)
+    assert sorted(os.listdir(os.path.dirname(out))) == ['roi.dbf', 'roi.shp', 'roi.shx']
+
+
+def test_changed_geometry_replaces_entry(cache, fake_connection):
+    new_wkb = WKB + b'\x01'
+    fake_connection.results = [
+        [('unknown', 4326)], [(WKB, 4326)], [('changed', 4326)], [(new_wkb, 4326)],
+    ]
+
+    old = cache.get(fake_connection, 7)
+    new = cache.get(fake_connection, 7)
+    assert old != new
+    assert os.listdir(cache.cache_dir) == [os.path.basename(os.path.dirname(new))]
+
+
+def test_least_recently_used_evicted(cache, fake_connection):
+    entries = []
+    for sub_id in (1, 2, 1, 3):
+        hashval = hashlib.md5(WKB).hexdigest()
+        if os.path.isdir(cache.entry(sub_id, hashval)):
+            fake_connection.results.append([(hashval, 4326)])
+        else:
+            fake_connection.results.extend([[('unknown', 4326)], [(WKB, 4326)]])
+        entries.append(os.path.dirname(cache.get(fake_connection, sub_id)))
+        os.utime(entries[-1], (len(entries), len(entries)))
+
+    assert sorted(os.listdir(cache.cache_dir)) == sorted(os.path.basename(e) for e in (entries[2], entries[3]))
+
+
+def test_evicted_while_copying_is_fetched_again(cache, fake_connection, monkeypatch, tmp_path):
+    hashval = hashlib.md5(WKB).hexdigest()
+    fake_connection.results = [[(hashval, 4326)], [(WKB, 4326)], [(hashval, 4326)], [(WKB, 4326)]]
+    cache.get(fake_connection, 7)
+
+    # Another worker evicts the entry between get and the copy
+    get = cache.get
+
+    def get_then_evict(conn, sub_id):
+        shapefile = get(conn, sub_id)
+        shutil.rmtree(os.path.dirname(shapefile))
+        return shapefile
+
+    monkeypatch.setattr(cache, 'get', get_then_evict)
+    out = str(tmp_path / 'roi.shp')
+    cache.copy(fake_connection, 7, out)
+    assert sorted(os.listdir(str(tmp_path))) == ['cache', 'roi.dbf', 'roi.shp', 'roi.shx']
+
+    with pytest.raises(IOError):
+        roi.copy_shapefile(str(tmp_path / 'missing.shp'), str(tmp_path / 'out.shp'))
@@ -0,0 +1,60 @@
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import signal
+import subprocess
+
+import pytest
+
+import hyp3proclib
+from hyp3proclib import spot
+from hyp3proclib.instance_metadata import MetadataClient
+
+
+def test_spot_interruption(fake_metadata, monkeypatch):
+    requeued = []
+    monkeypatch.setattr(spot, 'requeue_interrupted_job', lambda cfg: requeued.append(cfg['id']))
+
+    # Stands in for a long running science command started by execute
+    pipe = subprocess.Popen('sleep 60', shell=True, start_new_session=True)
+    hyp3proclib.running_processes.add(pipe)
+
+    cfg = {'id': 42, 'retry': False}
+    watcher = spot.SpotInterruptionWatcher(
+        cfg, client=MetadataClient(base_url=fake_metadata.url), interval=0.05, exit_process=False
+    )
+    watcher.start()
+
+    fake_metadata.paths['meta-data/spot/instance-action'] = '{"action": "terminate", "time": "2020-01-01T00:02:00Z"}'
+    watcher.join(timeout=10)
+    hyp3proclib.running_processes.discard(pipe)
+
+    assert not watcher.is_alive()
+    assert cfg['spot_interrupted'] is True
+    assert requeued == [42]
+    assert pipe.wait(timeout=10) != 0
+
+
+def test_no_interruption(fake_metadata):
+    cfg = {'id': 42, 'retry': False}
+    watcher = spot.SpotInterruptionWatcher(
+        cfg, client=MetadataClient(base_url=fake_metadata.url), interval=0.05, exit_process=False
+    )
+    watcher.start()
+    watcher._stop_event.wait(0.3)
+    watcher.stop()
+    watcher.join(timeout=10)
+
+    assert 'spot_interrupted' not in cfg
+    assert fake_metadata.gets('meta-data/spot/instance-action') > 1
+
+
+def test_signal_handler_stops_running_commands():
+    pipe = subprocess.Popen('sleep 60', shell=True, start_new_session=True)
+    hyp3proclib.running_processes.add(pipe)
+    try:
+        with pytest.raises(SystemExit):
+            hyp3proclib.signal_handler(signal.SIGTERM, None)
+    finally:
+        hyp3proclib.running_processes.discard(pipe)
+
+    assert pipe.wait(timeout=10) == -signal.SIGTERM